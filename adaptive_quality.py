@@ -0,0 +1,99 @@
+"""
+Адаптивное снижение качества анализа под нагрузкой
+
+Когда очередь растет, лучше быстро получить чуть более грубые измерения,
+чем точные через час. Политика - упорядоченный список уровней; уровень
+включается, если заполненность очереди или p95 задержки заданий (от
+постановки в очередь до завершения) достигли его порога. Из включенных
+уровней действует самый строгий.
+
+Уровень может ограничить разрешение анализа (max_resolution; обработка по
+тайлам при этом отключается - иначе крупные изображения обрабатывались бы
+без уменьшения), прореживать кадры видео (frame_skip не меньше заданного)
+и отключить рисование измерений (overlay: False - их можно перерисовать
+позже через /results/<job_id>/overlay).
+"""
+
+
+class QualityGovernor:
+    """
+    Выбор уровня снижения качества по загрузке очереди
+
+    policy: {'enabled': bool, 'levels': [{'queue_fill': доля ANALYSIS_QUEUE_SIZE,
+    'latency_p95_seconds': сек, 'max_resolution': (w, h), 'frame_skip': n,
+    'overlay': bool}, ...]} - уровни от мягкого к строгому.
+    """
+
+    def __init__(self, policy):
+        self.enabled = bool(policy.get('enabled', False))
+        self.levels = list(policy.get('levels', []))
+
+    def select(self, load):
+        """
+        Уровень для задания, запускаемого при загрузке load (см. JobManager.load)
+
+        Возвращает (номер уровня, причины); 0 - полное качество.
+        """
+        if not self.enabled:
+            return 0, {}
+
+        queue_fill = load['pending'] / max(1, load['max_queue_size'])
+        latency = load.get('latency_p95')
+        selected = 0
+        for number, level in enumerate(self.levels, start=1):
+            if queue_fill >= level.get('queue_fill', float('inf')) or (
+                    latency is not None and latency >= level.get('latency_p95_seconds', float('inf'))):
+                selected = number
+        if not selected:
+            return 0, {}
+        return selected, {
+            'queue_fill': round(queue_fill, 3),
+            'latency_p95_seconds': round(latency, 1) if latency is not None else None
+        }
+
+    def overrides(self, number, file_type, analysis_config):
+        """
+        Измененные настройки анализа для уровня number
+
+        Возвращает (overrides по разделам DISTANCE_ANALYSIS_CONFIG, applied) -
+        applied перечисляет только то, что действительно стало грубее для
+        этого типа файла.
+        """
+        if not number:
+            return {}, {}
+
+        level = self.levels[number - 1]
+        image_config = analysis_config.get('image_processing', {})
+        video_config = analysis_config.get('video_processing', {})
+        overrides, applied = {}, {}
+
+        limit = level.get('max_resolution')
+        current = image_config.get('max_resolution')
+        if limit and current:
+            limit = (min(limit[0], current[0]), min(limit[1], current[1]))
+        if limit and (tuple(limit) != tuple(current or ()) or image_config.get('tiled_processing', False)):
+            limit = tuple(limit)
+            overrides['image_processing'] = {'max_resolution': limit, 'tiled_processing': False}
+            applied['max_resolution'] = list(limit)
+
+        frame_skip = level.get('frame_skip')
+        if file_type == 'video' and frame_skip and frame_skip > video_config.get('frame_skip', 1):
+            overrides['video_processing'] = {'frame_skip': frame_skip}
+            applied['frame_skip'] = frame_skip
+
+        output_config = analysis_config.get('output', {})
+        if level.get('overlay', True) is False and output_config.get('overlay_measurements', True):
+            overrides['output'] = {'overlay_measurements': False}
+            applied['overlay'] = False
+
+        return overrides, applied
+
+
+def apply_overrides(analysis_config, overrides):
+    """Копия analysis_config с замененными параметрами разделов"""
+    if not overrides:
+        return analysis_config
+    merged = dict(analysis_config)
+    for section, values in overrides.items():
+        merged[section] = {**analysis_config.get(section, {}), **values}
+    return merged
@@ -0,0 +1,232 @@
+"""
+Точка входа анализа расстояний
+
+Функции этого модуля выполняются в процессах пула анализа (analysis_pool),
+поэтому модуль не должен иметь побочных эффектов при импорте и не зависит
+от Flask-приложения: все настройки передаются аргументом settings.
+
+Кеш этапов анализа (stage_cache) создается при первом анализе и живет,
+пока жив процесс пула. Шаблоны эталонов для калибровки масштаба строятся
+при старте процесса (init_worker).
+"""
+import logging
+import os
+import time
+import uuid
+
+from adaptive_quality import apply_overrides
+from analysis_pool import report_progress
+from artifacts import file_sha256, materialize, MATERIALIZE_STRATEGIES
+from calibration import ReferenceCalibrator
+from config import DISTANCE_ANALYSIS_CONFIG
+from distance_analyzer import DistanceAnalyzer
+from geometry import build_geometry
+from profiling import start_profile
+from stage_cache import StageCache
+from video_pipeline import VideoDecoderUnavailable, process_video
+
+logger = logging.getLogger(__name__)
+
+_stage_cache = None
+_calibrator = None
+
+
+def get_stage_cache(max_bytes):
+    """Кеш этапов этого процесса"""
+    global _stage_cache
+    if _stage_cache is None or _stage_cache.max_bytes != max_bytes:
+        _stage_cache = StageCache(max_bytes)
+    return _stage_cache
+
+
+def get_calibrator():
+    """Калибратор этого процесса с заранее построенными шаблонами эталонов"""
+    global _calibrator
+    if _calibrator is None:
+        _calibrator = ReferenceCalibrator(DISTANCE_ANALYSIS_CONFIG)
+    return _calibrator
+
+
+def init_worker():
+    """Подготовка процесса пула анализа (initializer для AnalysisPool)"""
+    get_calibrator()
+
+
+def analyze_file(file_path, file_type, settings, content_hash=None):
+    """
+    Анализирует файл и сохраняет результат в settings['processed_folder']
+
+    settings: units, timeout, processed_folder, debug, materialize_strategies,
+    stage_cache_max_bytes, degradation (снижение качества под нагрузкой:
+    overrides к DISTANCE_ANALYSIS_CONFIG и описание для analysis_config),
+    profile (профилирование задачи, см. profiling.start_profile)
+    content_hash: SHA-256 исходного файла, если он уже известен
+    """
+    profile = start_profile(settings.get('profile'))
+    if profile is None:
+        return select_analysis(file_path, file_type, settings, content_hash)
+
+    result = None
+    try:
+        result = select_analysis(file_path, file_type, settings, content_hash)
+    finally:
+        profile.stop()
+        # Профиль сохраняется и для упавшего анализа - он может объяснить ошибку
+        try:
+            files = profile.save(settings['processed_folder'], {'file_type': file_type,
+                                                                'succeeded': result is not None})
+        except OSError as e:
+            logger.error(f"Не удалось сохранить профиль {profile.name}: {e}")
+            files = None
+    if files:
+        result['profile'] = files
+    return result
+
+
+def select_analysis(file_path, file_type, settings, content_hash):
+    """Анализ изображения, видео или заглушка, если видео нечем декодировать"""
+    degradation = settings.get('degradation') or {}
+    analysis_config = apply_overrides(DISTANCE_ANALYSIS_CONFIG, degradation.get('overrides'))
+
+    # Генерируем уникальное имя для обработанного файла
+    # ВАЖНО: Сохраняем исходное расширение файла
+    original_extension = os.path.splitext(file_path)[1]  # Получаем .jpg, .png, .mp4 и т.д.
+    analysis_filename = f"distance_analysis_{uuid.uuid4().hex}{original_extension}"
+    analysis_path = os.path.join(settings['processed_folder'], analysis_filename)
+
+    if file_type == 'image':
+        return analyze_image_file(file_path, settings, analysis_config, content_hash,
+                                  analysis_filename, analysis_path)
+
+    try:
+        return analyze_video_file(file_path, settings, analysis_config, analysis_filename, analysis_path)
+    except VideoDecoderUnavailable as e:
+        logger.warning(f"{e}, результатом будет исходный файл")
+
+    return analyze_placeholder(file_path, file_type, settings, analysis_config, content_hash,
+                               analysis_filename, analysis_path)
+
+
+def build_analysis_config(file_type, settings, analysis_config):
+    """Настройки, с которыми выполнен анализ (попадают в ответ API)"""
+    degradation = settings.get('degradation') or {}
+    return {
+        'units': settings['units'],
+        'timeout': settings['timeout'],
+        'algorithm_config': analysis_config.get('algorithms', {}),
+        'processing_config': analysis_config.get(
+            'image_processing' if file_type == 'image' else 'video_processing', {}),
+        # Что из настроек огрублено из-за нагрузки (пустой applied - полное качество)
+        'degradation': {
+            'level': degradation.get('level', 0),
+            'applied': degradation.get('applied', {}),
+            'reasons': degradation.get('reasons', {})
+        }
+    }
+
+
+def analyze_image_file(file_path, settings, analysis_config, content_hash, analysis_filename, analysis_path):
+    """Анализ изображения модулем distance_analyzer"""
+    analyzer = DistanceAnalyzer(config=analysis_config,
+                                stage_cache=get_stage_cache(settings.get('stage_cache_max_bytes', 0)),
+                                calibrator=get_calibrator())
+    result = run_analysis(
+        lambda temp_path: analyzer.process_file(file_path, 'image', settings['units'], temp_path, content_hash,
+                                                report_progress),
+        'image', settings, analysis_config, analysis_filename, analysis_path)
+
+    # Исходник рядом с результатом: из него и геометрии перерисовываются измерения.
+    # Имя по хешу содержимого, поэтому повторные загрузки не создают копий
+    content_hash = content_hash or file_sha256(file_path)
+    source_file = f"source_{content_hash}{os.path.splitext(file_path)[1].lower()}"
+    source_path = os.path.join(settings['processed_folder'], source_file)
+    if not os.path.exists(source_path):
+        materialize(file_path, source_path, settings.get('materialize_strategies', MATERIALIZE_STRATEGIES))
+    result['geometry'] = build_geometry(result['measurements'], source_file)
+    return result
+
+
+def analyze_video_file(file_path, settings, analysis_config, analysis_filename, analysis_path):
+    """Покадровый анализ видео потоковым конвейером video_pipeline"""
+    return run_analysis(
+        lambda temp_path: process_video(file_path, temp_path, analysis_config, settings['units'],
+                                        get_calibrator(), report_progress),
+        'video', settings, analysis_config, analysis_filename, analysis_path)
+
+
+def run_analysis(process, file_type, settings, analysis_config, analysis_filename, analysis_path):
+    """
+    Выполняет process(temp_path) и публикует результат и JSON метаданных
+
+    Результат пишется во временный файл: процесс могут убить по таймауту
+    посреди записи, и недописанный файл не должен попасть в processed_folder.
+    """
+    temp_path = analysis_path + '.part' + os.path.splitext(analysis_path)[1]
+    # Файлы рядом с результатом: JSON метаданных и CSV по кадрам видео
+    temp_sidecars = {extension: os.path.splitext(temp_path)[0] + extension for extension in ('.json', '.csv')}
+    sidecars = {}
+    try:
+        measurements = process(temp_path)
+        started = time.perf_counter()
+        os.replace(temp_path, analysis_path)
+        for extension, temp_sidecar in temp_sidecars.items():
+            if os.path.exists(temp_sidecar):
+                sidecars[extension] = os.path.splitext(analysis_filename)[0] + extension
+                os.replace(temp_sidecar, os.path.join(settings['processed_folder'], sidecars[extension]))
+    finally:
+        # После ошибки в process() недописанные файлы не ждут очистки при старте
+        for path in (temp_path, *temp_sidecars.values()):
+            if os.path.exists(path):
+                os.remove(path)
+
+    processed_sha256 = file_sha256(analysis_path)
+    # Публикация результата (переименование и хеш для ETag) - часть записи артефакта
+    measurements.setdefault('timings_ms', {})['publish'] = round((time.perf_counter() - started) * 1000, 2)
+    logger.info(f"Анализ расстояний выполнен: {analysis_path}")
+
+    return {
+        'success': True,
+        'processed_file': analysis_filename,
+        'processed_sha256': processed_sha256,
+        'metadata_file': sidecars.get('.json'),
+        'frames_csv_file': sidecars.get('.csv'),
+        'message': f'Анализ расстояний выполнен (units: {measurements["units"]})',
+        'distances_calculated': True,
+        'is_placeholder': False,
+        'measurements': measurements,
+        'analysis_config': build_analysis_config(file_type, settings, analysis_config)
+    }
+
+
+def analyze_placeholder(file_path, file_type, settings, analysis_config, content_hash,
+                        analysis_filename, analysis_path):
+    """Заглушка для видео, которое нечем декодировать (нет ffmpeg)"""
+    # ВРЕМЕННАЯ ЗАГЛУШКА - возвращаем исходный файл
+    units = settings['units']
+
+    logger.info(f"[ЗАГЛУШКА] Имитируем анализ расстояний для файла: {file_path}")
+    logger.info(f"[ЗАГЛУШКА] Настройки анализа: units={units}, timeout={settings['timeout']}")
+
+    # Имитируем время анализа - используем настройку из конфига или 2 секунды по умолчанию
+    analysis_time = 2 if settings['debug'] else 3
+    time.sleep(analysis_time)
+
+    # ЗАГЛУШКА: исходный файл становится результатом с сохранением формата.
+    # Копия не нужна - materialize() по возможности создает жесткую ссылку или reflink
+    strategy = materialize(file_path, analysis_path,
+                           settings.get('materialize_strategies', MATERIALIZE_STRATEGIES))
+
+    logger.info(f"[ЗАГЛУШКА] Файл сохранен как результат анализа ({strategy}): {analysis_path}")
+
+    # Возвращаем результат в формате, который ожидает система
+    return {
+        'success': True,
+        'processed_file': analysis_filename,
+        # Заглушка отдает копию исходного файла, поэтому хеш совпадает
+        'processed_sha256': content_hash,
+        'materialization': strategy,  # Как создан артефакт: hardlink, reflink, ..., copy
+        'message': f'[ЗАГЛУШКА] Анализ расстояний выполнен (units: {units})',
+        'distances_calculated': True,  # Флаг успешного вычисления расстояний
+        'is_placeholder': True,  # Флаг того, что это заглушка
+        'analysis_config': build_analysis_config(file_type, settings, analysis_config)
+    }
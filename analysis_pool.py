@@ -0,0 +1,310 @@
+"""
+Пул процессов для анализа расстояний
+
+Анализ выполняется в отдельных процессах, чтобы тяжелые вычисления не держали
+GIL процесса Flask. Каждое задание получает жесткий дедлайн: при превышении
+ANALYSIS_TIMEOUT или отмене процесс-исполнитель убивается и заменяется новым.
+
+Задача может сообщать о ходе выполнения через report_progress(): сообщения
+идут по тому же каналу до результата и передаются в on_progress вызова run().
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+AFFINITY_HISTORY = 256  # Сколько последних ключей привязки помнит процесс
+PARENT_CHECK_INTERVAL = 1.0  # Как часто простаивающий процесс проверяет, жив ли родитель (сек)
+
+_progress_conn = None  # Канал текущего процесса-исполнителя (только в дочернем процессе)
+
+
+class AnalysisTimeoutError(Exception):
+    """Анализ не уложился в отведенное время"""
+
+
+class AnalysisCancelledError(Exception):
+    """Анализ отменен пользователем"""
+
+
+class AnalysisWorkerError(Exception):
+    """Процесс анализа завершился аварийно или вернул ошибку"""
+
+
+def report_progress(data):
+    """Отправляет прогресс текущей задачи в процесс Flask (вне пула ничего не делает)"""
+    if _progress_conn is None:
+        return
+    try:
+        _progress_conn.send(('progress', data))
+    except (OSError, ValueError):
+        pass
+
+
+def _worker_main(conn, log_level, initializer):
+    """Цикл процесса-исполнителя: получает задачу, возвращает результат"""
+    global _progress_conn
+    # При fork обработчик SIGTERM наследуется от родителя (воркера serve.py), а пул
+    # прерывает зависший или отмененный анализ именно SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    _progress_conn = conn
+    parent_pid = os.getppid()
+    if initializer is not None:
+        initializer()
+
+    while True:
+        try:
+            # При fork соседние процессы пула держат копию нашего канала, и EOF после
+            # гибели родителя может не прийти - поэтому проверяем родителя сами
+            if not conn.poll(PARENT_CHECK_INTERVAL):
+                if os.getppid() != parent_pid:
+                    break
+                continue
+            message = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        if message is None:
+            break
+
+        func, args, kwargs = message
+        try:
+            conn.send(('ok', func(*args, **kwargs)))
+        except Exception as e:
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+
+
+class _Worker:
+    """Один процесс-исполнитель и его канал связи"""
+
+    def __init__(self, context, log_level, initializer=None):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main,
+                                       args=(child_conn, log_level, initializer),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task_id = None
+        self.affinity = deque(maxlen=AFFINITY_HISTORY)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def kill(self):
+        """Немедленно останавливает процесс"""
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        """Мягко завершает свободный процесс"""
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        self.kill()
+
+
+class AnalysisPool:
+    """
+    Пул из size процессов-исполнителей
+
+    run() блокирует вызывающий поток до результата, поэтому число потоков,
+    одновременно вызывающих run(), должно совпадать с размером пула.
+    initializer - функция уровня модуля, выполняемая в каждом процессе
+    при старте (в том числе в процессах, заменивших убитые).
+    """
+
+    def __init__(self, size, start_method='spawn', log_level=logging.INFO, initializer=None):
+        self.size = size
+        self._context = multiprocessing.get_context(start_method)
+        self._log_level = log_level
+        self._initializer = initializer
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()  # Первый запуск процессов (без _lock: stats() и cancel() не ждут)
+        self._idle = []
+        self._busy = {}
+        self._slots = threading.Semaphore(size)
+        self._closed = False
+        self._started = False
+        self.start_method = start_method
+        self.recycled = 0
+
+    def start(self):
+        """
+        Запускает процессы пула
+
+        Вызывается лазиво при первом задании: при spawn дочерний процесс
+        импортирует __main__ заново, и запуск процессов при импорте модуля
+        приложения привел бы к рекурсии.
+        """
+        with self._start_lock:
+            with self._lock:
+                if self._started or self._closed:
+                    return
+            workers = [self._spawn() for _ in range(self.size)]
+            with self._lock:
+                self._started = True
+                if not self._closed:
+                    self._idle.extend(workers)
+                    workers = []
+            for worker in workers:
+                worker.stop()
+
+        logger.info(f"Пул анализа запущен: {self.size} процессов ({self.start_method})")
+
+    def run(self, task_id, func, args=(), kwargs=None, timeout=None, is_cancelled=None, affinity=None,
+            on_progress=None):
+        """
+        Выполняет func(*args, **kwargs) в процессе пула
+
+        affinity - ключ привязки (например, хеш файла): если свободен процесс,
+        уже выполнявший задачу с тем же ключом, задача отправляется ему.
+        on_progress(data) вызывается в потоке run() для каждого report_progress(data).
+
+        Исключения: AnalysisTimeoutError при превышении timeout,
+        AnalysisCancelledError при отмене, AnalysisWorkerError при ошибке в процессе.
+        """
+        self.start()
+        self._slots.acquire()
+        worker = None
+        sent = received = False
+        try:
+            with self._lock:
+                if self._closed:
+                    raise AnalysisWorkerError('Пул анализа остановлен')
+                worker = self._take_idle(affinity)
+            if worker is None:
+                # Запуск процесса - без блокировки, cancel() и stats() его не ждут
+                worker = self._spawn()
+            with self._lock:
+                if self._closed:
+                    raise AnalysisWorkerError('Пул анализа остановлен')
+                worker.task_id = task_id
+                if affinity is not None:
+                    worker.affinity.append(affinity)
+                self._busy[task_id] = worker
+                # Отмена могла прийти до регистрации задачи
+                if is_cancelled is not None and is_cancelled():
+                    raise AnalysisCancelledError('Анализ отменен')
+
+            worker.conn.send((func, args, kwargs or {}))
+            sent = True
+            deadline = time.monotonic() + timeout if timeout else None
+
+            status, payload = self._wait(worker, deadline, is_cancelled, on_progress)
+            received = True
+            if status == 'error':
+                raise AnalysisWorkerError(payload)
+            return payload
+
+        except (AnalysisTimeoutError, AnalysisCancelledError, AnalysisWorkerError, OSError):
+            # Процесс в неизвестном состоянии - заменяем его новым
+            if worker is not None and sent and not received:
+                self._recycle(worker)
+                worker = None
+            raise
+
+        finally:
+            with self._lock:
+                self._busy.pop(task_id, None)
+                if worker is not None:
+                    worker.task_id = None
+                    if self._closed:
+                        worker.stop()
+                    else:
+                        self._idle.append(worker)
+            self._slots.release()
+
+    def cancel(self, task_id):
+        """Убивает процесс, выполняющий задачу; возвращает True, если задача найдена"""
+        with self._lock:
+            worker = self._busy.get(task_id)
+            if worker is None:
+                return False
+            logger.info(f"Отмена задачи {task_id}: останавливаем процесс {worker.pid}")
+            worker.process.terminate()
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'processes': self.size,
+                'busy': len(self._busy),
+                'idle': len(self._idle),
+                'recycled': self.recycled
+            }
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            busy = list(self._busy.values())
+        for worker in idle:
+            worker.stop()
+        for worker in busy:
+            worker.process.terminate()
+
+    def _wait(self, worker, deadline, is_cancelled, on_progress):
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+
+            try:
+                if not worker.conn.poll(remaining):
+                    raise AnalysisTimeoutError('Превышено время анализа')
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                # Процесс убит отменой или упал
+                if is_cancelled is not None and is_cancelled():
+                    raise AnalysisCancelledError('Анализ отменен')
+                raise AnalysisWorkerError(
+                    f'Процесс анализа завершился аварийно (код {worker.process.exitcode})')
+
+            if message[0] != 'progress':
+                return message
+            if on_progress is not None:
+                try:
+                    on_progress(message[1])
+                except Exception as e:
+                    logger.warning(f"Ошибка обработчика прогресса задачи {worker.task_id}: {e}")
+
+    def _take_idle(self, affinity):
+        """Свободный процесс, по возможности с той же привязкой, или None (вызывается под _lock)"""
+        if not self._idle:
+            return None
+        if affinity is not None:
+            for i, worker in enumerate(self._idle):
+                if affinity in worker.affinity:
+                    return self._idle.pop(i)
+        return self._idle.pop()
+
+    def _spawn(self):
+        return _Worker(self._context, self._log_level, self._initializer)
+
+    def _recycle(self, worker):
+        logger.warning(f"Процесс анализа {worker.pid} остановлен и будет заменен")
+        worker.kill()
+        with self._lock:
+            self.recycled += 1
+            if self._closed:
+                return
+        # Новый процесс запускается без блокировки; слот задачи еще занят, лишних процессов не будет
+        replacement = self._spawn()
+        with self._lock:
+            if not self._closed:
+                self._idle.append(replacement)
+                return
+        replacement.stop()
@@ -1,56 +1,152 @@
-from flask import Flask, request, jsonify, send_file, url_for
+from flask import (Blueprint, Flask, current_app, request, jsonify, send_file, url_for, Response,
+                   stream_with_context, g)
 from flask_cors import CORS
 import os
 import uuid
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.local import LocalProxy
+from werkzeug.wsgi import get_input_stream
 import requests
-import tempfile
 import logging
 from datetime import datetime
 import mimetypes
+import atexit
+import functools
+import hmac
+import io
+import ipaddress
+import json
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 # Импортируем конфигурацию
 from config import get_config, DISTANCE_ANALYSIS_CONFIG, API_CONFIG, NOTIFICATION_CONFIG
+from jobs import (JobManager, JobCancelled, QueueFullError, JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED,
+                  EVENT_PROGRESS, EVENT_STATUS)
+from analysis_pool import AnalysisPool, AnalysisTimeoutError, AnalysisCancelledError
+from analysis import analyze_file, init_worker
+from artifacts import ArtifactRegistry
+from result_cache import ResultCache, make_cache_key
+from job_index import JobIndex
+from sweeper import RetentionSweeper
+from stage_cache import StageCache
+from geometry import (GeometryError, OUTPUT_OVERRIDES, convert_measurements, load_base_image,
+                      render, units_per_pixel)
+from scheduler import Scheduler
+from rate_limit import RateLimiter
+from adaptive_quality import QualityGovernor
+from video_io import probe_video
+from ingest import check_url, download_url, iter_multipart_files, save_stream, UploadError, UploadTooLargeError
+from metrics import MetricsRegistry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from profiling import PROFILE_PREFIX, profile_name, profile_request, request_trigger
 
-# Получаем конфигурацию на основе окружения
-config_class = get_config()
-config = config_class()
-
-# Настройка логирования из конфига
-logging.basicConfig(
-    level=getattr(logging, config.LOG_LEVEL),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(config.LOG_FILE) if hasattr(config, 'LOG_FILE') else logging.NullHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# Маршруты сервиса; регистрируются на приложении в create_app()
+api = Blueprint('api', __name__)
 
-# Применяем конфигурацию к Flask приложению
-app.config.from_object(config)
+# Ключ сервисов приложения в app.extensions
+EXTENSION = 'distance'
 
-# Настройка CORS с конфигурацией
-cors_origins = getattr(config, 'CORS_ORIGINS', ['http://localhost:3000', 'http://127.0.0.1:3000'])
 
-# Добавляем file:// протокол для локальной разработки
-cors_origins.extend(['file://', 'null'])
+def get_services(flask_app=None):
+    """Сервисы приложения flask_app (по умолчанию - текущего, в контексте приложения)"""
+    return (flask_app or current_app).extensions[EXTENSION]
 
-CORS(app,
-     origins=['*'],
-     allow_headers=['Content-Type', 'Authorization'],
-     methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
-     supports_credentials=True)
 
-# Создаем папки из конфигурации
-os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(config.PROCESSED_FOLDER, exist_ok=True)
+def service_proxy(name):
+    """Сервис текущего приложения по имени атрибута Services - для обработчиков запросов"""
+    return LocalProxy(lambda: getattr(get_services(), name))
 
-logger.info(f"Запуск в режиме: {config.__class__.__name__}")
-logger.info(f"Upload folder: {config.UPLOAD_FOLDER}")
-logger.info(f"Processed folder: {config.PROCESSED_FOLDER}")
+
+# Конфигурация и сервисы текущего приложения: импорт модуля ничего не создает и не запускает
+config = service_proxy('config')
+metrics = service_proxy('metrics')
+job_index = service_proxy('job_index')
+artifact_registry = service_proxy('artifact_registry')
+upload_registry = service_proxy('upload_registry')
+sweeper = service_proxy('sweeper')
+result_cache = service_proxy('result_cache')
+render_cache = service_proxy('render_cache')
+analysis_pool = service_proxy('analysis_pool')
+job_manager = service_proxy('job_manager')
+quality_governor = service_proxy('quality_governor')
+rate_limiter = service_proxy('rate_limiter')
+
+
+def configure_logging(config):
+    """Настройка логирования из конфига"""
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(config.LOG_FILE) if hasattr(config, 'LOG_FILE') else logging.NullHandler()
+        ]
+    )
+
+
+def create_app(config_object=None, start=True):
+    """
+    Создает приложение: конфигурация, логирование, CORS, папки, маршруты и сервисы
+
+    config_object - класс или экземпляр конфигурации (по умолчанию - по FLASK_ENV).
+    Каждый вызов создает новое приложение со своими сервисами
+    (app.extensions['distance']); у приложений в одном процессе должны быть
+    разные каталоги данных. start=False - не запускать потоки и процессы
+    сервисов: пре-форк сервер создает приложение в мастере, а
+    start_services() вызывает в каждом воркере.
+    """
+    if config_object is None:
+        config_object = get_config()
+    settings = config_object() if isinstance(config_object, type) else config_object
+
+    configure_logging(settings)
+
+    flask_app = Flask(__name__)
+
+    # Применяем конфигурацию к Flask приложению
+    flask_app.config.from_object(settings)
+    flask_app.config['USE_X_SENDFILE'] = settings.DOWNLOAD_OFFLOAD == 'x-sendfile'
+
+    # Настройка CORS с конфигурацией
+    cors_origins = list(getattr(settings, 'CORS_ORIGINS', ['http://localhost:3000', 'http://127.0.0.1:3000']))
+
+    # Добавляем file:// протокол для локальной разработки
+    cors_origins.extend(['file://', 'null'])
+
+    CORS(flask_app,
+         origins=['*'],
+         allow_headers=['Content-Type', 'Authorization'],
+         methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
+         supports_credentials=True)
+
+    # Создаем папки из конфигурации
+    os.makedirs(settings.UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(settings.PROCESSED_FOLDER, exist_ok=True)
+
+    logger.info(f"Запуск в режиме: {settings.__class__.__name__}")
+    logger.info(f"Upload folder: {settings.UPLOAD_FOLDER}")
+    logger.info(f"Processed folder: {settings.PROCESSED_FOLDER}")
+
+    flask_app.register_blueprint(api)
+    flask_app.extensions[EXTENSION] = Services(flask_app, settings)
+    if start:
+        start_services(flask_app)
+    return flask_app
+
+
+def with_app_context(func, flask_app=None):
+    """func, выполняемая в контексте приложения (по умолчанию - текущего): для фоновых потоков"""
+    flask_app = flask_app or current_app._get_current_object()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with flask_app.app_context():
+            return func(*args, **kwargs)
+    return wrapper
 
 
 def allowed_file(filename):
@@ -99,84 +195,463 @@ def get_supported_formats_json():
     return convert_sets_to_lists(config.ALLOWED_EXTENSIONS)
 
 
-def send_to_distance_analysis_service(file_path, file_type):
+def get_analysis_settings():
+    """Настройки, передаваемые в процесс анализа"""
+    return {
+        'units': config.DEFAULT_UNITS,
+        'timeout': config.ANALYSIS_TIMEOUT,
+        'processed_folder': config.PROCESSED_FOLDER,
+        'debug': config.DEBUG,
+        'materialize_strategies': config.ARTIFACT_MATERIALIZE_STRATEGIES,
+        'stage_cache_max_bytes': config.STAGE_CACHE_MAX_BYTES
+    }
+
+
+def unsupported_format_message():
+    """Сообщение об ошибке со списком поддерживаемых форматов"""
+    # Конвертируем set в list для JSON сериализации
+    all_formats = []
+    for extensions in config.ALLOWED_EXTENSIONS.values():
+        all_formats.extend(list(extensions))
+    supported_formats = ', '.join(all_formats)
+
+    return f'Неподдерживаемый тип файла для анализа расстояний. Поддерживаются: {supported_formats}'
+
+
+def upload_destination(filename):
+    """Проверяет имя загружаемого файла и возвращает путь для его сохранения"""
+    if filename == '':
+        raise UploadError('Файл не выбран')
+
+    # Проверяем тип файла на основе конфигурации до записи на диск
+    is_allowed, _ = allowed_file(filename)
+    if not is_allowed:
+        raise UploadError(unsupported_format_message())
+
+    # Создаем безопасное имя файла
+    unique_filename = f"{uuid.uuid4().hex}_{secure_filename(filename)}"
+    return os.path.join(config.UPLOAD_FOLDER, unique_filename)
+
+
+def receive_uploaded_file():
     """
-    Отправляет файл в сервис анализа расстояний
+    Принимает файл из тела текущего запроса напрямую в UPLOAD_FOLDER
 
-    TODO: Здесь будет подключен отдельный Python файл с анализом расстояний
-    Например: from distance_analyzer import analyze_distances
+    Поддерживается multipart/form-data с полем file, а также загрузка
+    "сырого" тела с именем файла в заголовке X-Filename или параметре filename.
+    Возвращает IngestedFile или None, если файла в запросе нет.
+    """
+    max_size = config.MAX_CONTENT_LENGTH
+
+    if request.mimetype == 'multipart/form-data':
+        files = iter_multipart_files(
+            request.stream,
+            request.content_type,
+            lambda field, filename: upload_destination(filename) if field == 'file' else None,
+            max_size=max_size
+        )
+        try:
+            return next(files, None)
+        finally:
+            files.close()
 
-    Пример интеграции:
-    ------------------------
-    from distance_analyzer import DistanceAnalyzer
+    filename = request.headers.get('X-Filename') or request.args.get('filename')
+    if not filename:
+        return None
 
-    analyzer = DistanceAnalyzer(config=DISTANCE_ANALYSIS_CONFIG)
-    result = analyzer.process_file(
-        file_path=file_path,
-        file_type=file_type,
-        units=config.DEFAULT_UNITS,
-        timeout=config.ANALYSIS_TIMEOUT
-    )
+    return save_stream(request.stream, filename, upload_destination(filename), max_size=max_size)
 
-    Или функциональный подход:
-    ------------------------
-    from distance_analysis import calculate_distances
 
-    distances_result = calculate_distances(
-        input_file=file_path,
-        file_type=file_type,
-        units=config.DEFAULT_UNITS,
-        config=DISTANCE_ANALYSIS_CONFIG,
-        timeout=config.ANALYSIS_TIMEOUT
-    )
+def send_to_distance_analysis_service(file_path, file_type, job=None):
+    """
+    Отправляет файл в сервис анализа расстояний
+
+    Анализ выполняется в процессе из analysis_pool с жестким дедлайном
+    ANALYSIS_TIMEOUT. Сама точка входа - analysis.analyze_file().
+    Анализ изображений - distance_analyzer.DistanceAnalyzer, видео -
+    video_pipeline.process_video; выбор и настройки - в analysis.py.
+    job - задание очереди: отмена, прогресс, снижение качества, профилирование.
     """
+    task_id = job.id if job is not None else uuid.uuid4().hex
+    is_cancelled = (lambda: job.cancel_requested) if job is not None else None
+    content_hash = job.file_info.get('sha256') if job is not None else None
+    settings = get_analysis_settings()
+    # Прогресс приходит из потока пула анализа, вне контекста приложения
+    manager = get_services().job_manager
+    if job is not None:
+        settings['degradation'] = select_degradation(job)
+        settings['profile'] = build_profile_options(job)
+
     try:
-        # ВРЕМЕННАЯ ЗАГЛУШКА - возвращаем исходный файл
-        # В дальнейшем здесь будет вызов вашего модуля анализа расстояний
-        import time
-        import shutil
+        return analysis_pool.run(
+            task_id,
+            analyze_file,
+            args=(file_path, file_type, settings, content_hash),
+            timeout=config.ANALYSIS_TIMEOUT,
+            is_cancelled=is_cancelled,
+            # Тот же файл - в тот же процесс: там уже лежат результаты его этапов
+            affinity=content_hash,
+            on_progress=(lambda data: manager.publish(job, EVENT_PROGRESS, data)) if job is not None else None
+        )
+
+    except AnalysisTimeoutError:
+        logger.error(f"Анализ файла {file_path} превысил таймаут {config.ANALYSIS_TIMEOUT} сек")
+        raise AnalysisTimeoutError(f'Превышено время анализа ({config.ANALYSIS_TIMEOUT} сек)')
+
+    except AnalysisCancelledError:
+        raise JobCancelled()
 
-        logger.info(f"[ЗАГЛУШКА] Имитируем анализ расстояний для файла: {file_path}")
-        logger.info(f"[ЗАГЛУШКА] Настройки анализа: units={config.DEFAULT_UNITS}, timeout={config.ANALYSIS_TIMEOUT}")
+    except Exception as e:
+        logger.error(f"Ошибка в сервисе анализа расстояний: {e}")
+        raise
 
-        # Имитируем время анализа - используем настройку из конфига или 2 секунды по умолчанию
-        analysis_time = 2 if config.DEBUG else 3
-        time.sleep(analysis_time)
 
-        # Генерируем уникальное имя для "обработанного" файла
-        # ВАЖНО: Сохраняем исходное расширение файла
-        original_extension = os.path.splitext(file_path)[1]  # Получаем .jpg, .png, .mp4 и т.д.
-        analysis_filename = f"distance_analysis_{uuid.uuid4().hex}{original_extension}"
-        analysis_path = os.path.join(config.PROCESSED_FOLDER, analysis_filename)
+def build_profile_options(job):
+    """Профилирование анализа задания (settings['profile']) или None - без накладных расходов"""
+    slow_job_seconds = config.PROFILING.get('slow_job_seconds')
+    if job.profile is None and not slow_job_seconds:
+        return None
+    return {
+        'name': profile_name(job.id),
+        'trigger': job.profile,
+        'slow_job_seconds': slow_job_seconds,
+        'sample_interval': config.PROFILING.get('sample_interval', 0.01)
+    }
 
-        # ЗАГЛУШКА: просто копируем исходный файл с сохранением формата
-        # TODO: Заменить на реальный анализ расстояний
-        # Важно: ваш модуль анализа должен также сохранять исходный формат или
-        # возвращать результат в подходящем формате
-        shutil.copy2(file_path, analysis_path)
 
-        logger.info(f"[ЗАГЛУШКА] Файл скопирован как результат анализа: {analysis_path}")
+def select_degradation(job):
+    """Снижение качества анализа для запускаемого задания по текущей загрузке очереди"""
+    level, reasons = quality_governor.select(job_manager.load())
+    overrides, applied = quality_governor.overrides(level, job.file_type, DISTANCE_ANALYSIS_CONFIG)
+    if not applied:
+        return None
 
-        # Возвращаем результат в формате, который ожидает система
-        return {
-            'success': True,
-            'processed_file': analysis_filename,
-            'message': f'[ЗАГЛУШКА] Анализ расстояний выполнен (units: {config.DEFAULT_UNITS})',
-            'distances_calculated': True,  # Флаг успешного вычисления расстояний
-            'is_placeholder': True,  # Флаг того, что это заглушка
-            'analysis_config': {
-                'units': config.DEFAULT_UNITS,
-                'timeout': config.ANALYSIS_TIMEOUT,
-                'algorithm_config': DISTANCE_ANALYSIS_CONFIG.get('algorithms', {}),
-                'processing_config': DISTANCE_ANALYSIS_CONFIG.get(
-                    'image_processing' if file_type == 'image' else 'video_processing', {})
-            }
-        }
+    job.quality_level = level
+    logger.info(f"Задание {job.id}: качество анализа снижено до уровня {level} ({applied}, {reasons})")
+    return {'level': level, 'reasons': reasons, 'overrides': overrides, 'applied': applied}
 
-    except Exception as e:
-        logger.error(f"Ошибка в заглушке анализа расстояний: {e}")
+
+def run_analysis_job(job):
+    """Выполняет анализ для задания из очереди (вызывается в рабочем потоке)"""
+    try:
+        analysis_result = send_to_distance_analysis_service(job.file_path, job.file_type, job)
+    except Exception:
+        remove_upload(job.file_path)
         raise
 
+    if not analysis_result['success']:
+        # Удаляем загруженный файл при ошибке
+        remove_upload(job.file_path)
+        raise RuntimeError('Ошибка анализа расстояний')
+
+    record_analysis_metrics(job, analysis_result)
+    artifact = register_artifacts(job, analysis_result)
+    # Огрубленный под нагрузкой результат не кешируем: повторная загрузка получит полное качество
+    if not job.quality_level:
+        # Профиль относится к этому заданию, а не к повторным загрузкам
+        cached_result = {key: value for key, value in analysis_result.items() if key != 'profile'}
+        result_cache.put(get_cache_key(job.file_info['sha256'], job.file_type), cached_result, artifact['size'])
+    return analysis_result
+
+
+def record_analysis_metrics(job, analysis_result):
+    """Длительности этапов анализа, запись артефакта и попадания в кеш этапов"""
+    measurements = analysis_result.get('measurements') or {}
+    timings = measurements.get('timings_ms') or {}
+    cached = measurements.get('cached_stages')
+    for stage, milliseconds in timings.items():
+        # Этапы из кеша почти мгновенны и исказили бы распределение - они в счетчике кеша этапов
+        if not cached or stage not in cached:
+            metrics.analysis_stage_seconds.observe(milliseconds / 1000, file_type=job.file_type, stage=stage)
+        if cached is not None and config.STAGE_CACHE_MAX_BYTES and stage not in ARTIFACT_STAGES:
+            metrics.stage_cache_requests.inc(stage=stage, result='hit' if stage in cached else 'miss')
+    if 'publish' in timings:
+        write_ms = sum(timings.get(stage, 0) for stage in ARTIFACT_STAGES)
+        metrics.artifact_write_seconds.observe(write_ms / 1000, file_type=job.file_type)
+
+
+def record_job_metrics(job):
+    """Длительность и ожидание в очереди завершенного задания (finish_handler очереди)"""
+    if job.running_since is None:
+        return
+    metrics.analysis_duration_seconds.observe((job.finished_at - job.started_at).total_seconds(),
+                                              file_type=job.file_type, status=job.status)
+    metrics.queue_wait_seconds.observe(max(0.0, job.running_since - job.queued_at), file_type=job.file_type)
+
+
+def update_queue_metrics(services):
+    """Текущая загрузка очереди для снимка метрик (вызывается и из потока записи снимков)"""
+    load = services.job_manager.load()
+    services.metrics.jobs_queued.set(load['pending'] - load['running'])
+    services.metrics.jobs_running.set(load['running'])
+    services.metrics.queue_backlog_seconds.set(round(load['backlog_seconds'], 3))
+
+
+def register_artifacts(job, analysis_result):
+    """Записывает файлы результата в индекс; возвращает запись основного артефакта"""
+    artifact = artifact_registry.register(analysis_result['processed_file'], analysis_result.get('processed_sha256'),
+                                          job.id)
+    for kind in ('metadata_file', 'frames_csv_file'):
+        if analysis_result.get(kind):
+            artifact_registry.register(analysis_result[kind], job_id=job.id, kind=kind)
+    if analysis_result.get('geometry'):
+        # Исходник назван по хешу содержимого загруженного файла и общий для повторных загрузок:
+        # если очистка только что удалила его как просроченный, без него останется только перерисовка
+        try:
+            artifact_registry.register(analysis_result['geometry']['source_file'], job.file_info.get('sha256'),
+                                       job.id, kind='source')
+        except OSError as e:
+            logger.warning(f"Исходник результата {job.id} недоступен: {e}")
+    profile = analysis_result.get('profile') or {}
+    for kind in ('report', 'profile'):
+        if profile.get(kind):
+            artifact_registry.register(profile[kind], job_id=job.id, kind='profile')
+    return artifact
+
+
+def get_cache_key(content_hash, file_type):
+    """Ключ кеша результатов для файла с текущими настройками анализа"""
+    return make_cache_key(content_hash, file_type, config.DEFAULT_UNITS, DISTANCE_ANALYSIS_CONFIG)
+
+
+def remove_upload(file_path):
+    """Удаляет загруженный файл, если он еще существует"""
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+
+
+class ServiceMetrics:
+    """
+    Метрики Prometheus приложения (/metrics)
+
+    Значения процессов сервиса складываются через METRICS_FOLDER; у
+    приложений в одном процессе папки снимков должны быть разными.
+    """
+
+    def __init__(self, folder=None, flush_interval=5.0):
+        self.registry = registry = MetricsRegistry(folder, flush_interval)
+        self.http_requests = registry.counter('distance_http_requests_total',
+                                              'HTTP-запросы по обработчику, методу и статусу',
+                                              ('endpoint', 'method', 'status'))
+        self.http_request_seconds = registry.histogram('distance_http_request_duration_seconds',
+                                                       'Длительность обработки HTTP-запроса', ('endpoint',))
+        self.upload_receive_seconds = registry.histogram('distance_upload_receive_seconds',
+                                                         'Прием тела загрузки: ожидание и разбор данных запроса')
+        self.upload_save_seconds = registry.histogram('distance_upload_save_seconds',
+                                                      'Запись загрузки на диск вместе с подсчетом SHA-256')
+        self.upload_bytes = registry.counter('distance_upload_bytes_total', 'Принято байт загруженных файлов')
+        self.queue_wait_seconds = registry.histogram('distance_queue_wait_seconds', 'Ожидание задания в очереди',
+                                                     ('file_type',))
+        self.analysis_duration_seconds = registry.histogram('distance_analysis_duration_seconds',
+                                                            'Длительность задания анализа', ('file_type', 'status'))
+        self.analysis_stage_seconds = registry.histogram('distance_analysis_stage_seconds',
+                                                         'Длительность этапа анализа (без этапов из кеша)',
+                                                         ('file_type', 'stage'))
+        self.artifact_write_seconds = registry.histogram('distance_artifact_write_seconds',
+                                                         'Запись файлов результата: сохранение изображения и публикация',
+                                                         ('file_type',))
+        self.download_bytes = registry.counter('distance_download_bytes_total',
+                                               'Отдано байт результатов через /download', ('mode',))
+        self.jobs_queued = registry.gauge('distance_jobs_queued', 'Заданий в очереди')
+        self.jobs_running = registry.gauge('distance_jobs_running', 'Выполняемых заданий')
+        self.queue_backlog_seconds = registry.gauge('distance_queue_backlog_seconds',
+                                                    'Оценка оставшегося анализа в очереди и в работе (сек)')
+        self.result_cache_requests = registry.counter('distance_result_cache_requests_total',
+                                                      'Обращения к кешу результатов', ('result',))
+        self.stage_cache_requests = registry.counter('distance_stage_cache_requests_total',
+                                                     'Обращения к кешу этапов анализа изображений', ('stage', 'result'))
+        self.render_cache_requests = registry.counter('distance_render_cache_requests_total',
+                                                      'Обращения к кешу исходников для перерисовки', ('result',))
+        self.worker_startup_seconds = registry.gauge('distance_worker_startup_seconds',
+                                                     'Старт воркера пре-форк сервера: от fork до приема запросов',
+                                                     ('worker',))
+        registry.add_ratio('distance_result_cache_hit_ratio', 'Доля попаданий в кеш результатов',
+                           self.result_cache_requests)
+        registry.add_ratio('distance_stage_cache_hit_ratio', 'Доля попаданий в кеш этапов анализа',
+                           self.stage_cache_requests)
+        registry.add_ratio('distance_render_cache_hit_ratio', 'Доля попаданий в кеш исходников',
+                           self.render_cache_requests)
+
+    def render(self):
+        return self.registry.render()
+
+
+# Этапы анализа, которые пишут файлы результата (не кешируются)
+ARTIFACT_STAGES = ('save', 'publish')
+
+
+class Services:
+    """
+    Сервисы приложения: индекс, очередь, кеши, пул анализа, очистка и метрики
+
+    Создаются create_app() по конфигурации приложения и хранятся в
+    app.extensions['distance']; потоков и процессов не запускают. Созданное
+    здесь можно наследовать через fork: блокировки свободны, соединения с
+    индексом открываются заново в каждом процессе.
+    """
+
+    def __init__(self, flask_app, config):
+        self.config = config
+        retention_seconds = config.FILE_RETENTION_DAYS * 24 * 3600
+
+        # Сведения о воркере пре-форк сервера (serve.py) для /health; None - обычный запуск
+        self.worker_info = None
+
+        # Индекс заданий и артефактов (SQLite): общий для процессов сервиса, переживает перезапуск
+        self.job_index = JobIndex(config.JOB_INDEX_PATH)
+        interrupted = self.job_index.recover_interrupted('Анализ прерван остановкой сервиса')
+        if interrupted:
+            logger.warning(f"Заданий, прерванных остановкой сервиса: {interrupted}")
+
+        # Артефакты в папке результатов: размер, хеш для ETag, срок хранения
+        self.artifact_registry = ArtifactRegistry(config.PROCESSED_FOLDER, self.job_index,
+                                                  retention_seconds=retention_seconds)
+        # Загруженные файлы - в том же индексе, для удаления по сроку хранения
+        self.upload_registry = ArtifactRegistry(config.UPLOAD_FOLDER, self.job_index,
+                                                retention_seconds=retention_seconds, name='uploads')
+
+        # Фоновое удаление просроченных файлов пачками (вместо очистки каталогов в запросе)
+        self.sweeper = RetentionSweeper(
+            self.job_index,
+            {'processed': config.PROCESSED_FOLDER, 'uploads': config.UPLOAD_FOLDER},
+            retention_seconds=retention_seconds,
+            interval=config.CLEANUP_INTERVAL.total_seconds(),
+            batch_size=config.CLEANUP_BATCH_SIZE,
+            batch_seconds=config.CLEANUP_BATCH_SECONDS,
+            pause_seconds=config.CLEANUP_BATCH_PAUSE,
+            # Брошенные временные файлы старше двух таймаутов анализа точно не пишутся
+            grace_seconds=max(3600, 2 * config.ANALYSIS_TIMEOUT)
+        )
+
+        # Кеш результатов: повторная загрузка того же файла не запускает анализ
+        self.result_cache = ResultCache(config.PROCESSED_FOLDER, config.RESULT_CACHE_MAX_BYTES, self.job_index,
+                                        retention_seconds=retention_seconds)
+
+        # Исходные изображения для перерисовки измерений (/results/<job_id>/overlay)
+        self.render_cache = StageCache(config.RENDER_CACHE_MAX_BYTES)
+
+        self.metrics = ServiceMetrics(config.METRICS_FOLDER, config.METRICS_FLUSH_INTERVAL)
+        self.metrics.registry.add_collector(lambda: update_queue_metrics(self))
+
+        # Пул процессов анализа: тяжелые вычисления не держат GIL процесса Flask
+        self.analysis_pool = AnalysisPool(
+            config.ANALYSIS_WORKERS,
+            start_method=config.ANALYSIS_START_METHOD,
+            log_level=getattr(logging, config.LOG_LEVEL),
+            initializer=init_worker
+        )
+
+        # Очередь заданий: /upload только сохраняет файл и ставит его сюда
+        # Обработчики выполняются в рабочих потоках очереди - в контексте своего приложения
+        self.job_manager = JobManager(
+            with_app_context(run_analysis_job, flask_app),
+            Scheduler(DISTANCE_ANALYSIS_CONFIG['video_processing'], config.SCHEDULER_AGING_FACTOR),
+            max_workers=config.ANALYSIS_WORKERS,
+            max_queue_size=config.ANALYSIS_QUEUE_SIZE,
+            history_size=config.JOB_HISTORY_SIZE,
+            cancel_handler=lambda job: self.analysis_pool.cancel(job.id),
+            index=self.job_index,
+            finish_handler=with_app_context(record_job_metrics, flask_app)
+        )
+
+        # Снижение качества анализа при росте очереди и задержек
+        self.quality_governor = QualityGovernor(config.ADAPTIVE_QUALITY)
+
+        # Ограничение частоты загрузок по клиентам (API_CONFIG['rate_limiting'])
+        # Корзины - в индексе: лимит общий для всех воркеров пре-форк сервера
+        self.rate_limiter = RateLimiter.from_config(API_CONFIG.get('rate_limiting', {}),
+                                                    config.RATE_LIMIT_MAX_CLIENTS, self.job_index)
+
+
+def start_services(flask_app, run_sweeper=True, start_pool=False):
+    """
+    Запускает потоки и процессы сервисов приложения в текущем процессе
+
+    run_sweeper=False - периодическая очистка работает в другом процессе
+    (в пре-форк сервере - только в первом воркере). start_pool - запустить
+    процессы анализа сразу, а не при первом задании.
+    """
+    services = get_services(flask_app)
+    # Процессы анализа - до первых потоков, чтобы при fork копировался однопоточный процесс
+    if start_pool:
+        services.analysis_pool.start()
+    services.metrics.registry.start()
+    services.job_manager.start()
+    if run_sweeper:
+        services.sweeper.start()
+    atexit.register(stop_services, flask_app)
+
+
+def stop_services(flask_app):
+    """Останавливает сервисы приложения: очередь, процессы анализа, очистку и запись метрик"""
+    services = get_services(flask_app)
+    services.job_manager.shutdown(wait=False)
+    services.analysis_pool.shutdown()
+    services.sweeper.stop(wait=False)
+    services.metrics.registry.stop()
+
+
+# Загрузки, проходящие контроль допуска, и проверять ли для них заполненность очереди
+# (/upload/batch при заполненной очереди сам ждет свободного места)
+ADMISSION_ENDPOINTS = {'api.upload_file': True, 'api.upload_batch': False}
+
+
+def build_analysis_response(job):
+    """Формирует ответ с результатом анализа для завершенного задания"""
+    analysis_result = job.result
+
+    # Формируем URL для скачивания результата анализа
+    analysis_file_url = url_for('api.download_processed',
+                                filename=analysis_result['processed_file'],
+                                _external=True)
+
+    response_data = {
+        'success': True,
+        'message': 'Анализ расстояний успешно выполнен',
+        'job_id': job.id,
+        'original_file': job.original_file,
+        'processed_file': analysis_result['processed_file'],
+        'processed_file_url': analysis_file_url,
+        'file_type': job.file_type,
+        'file_info': job.file_info,
+        'distances_calculated': analysis_result.get('distances_calculated', False),
+        'is_placeholder': analysis_result.get('is_placeholder', False),  # Флаг заглушки
+        'materialization': analysis_result.get('materialization'),
+        'analysis_settings': {
+            'units': config.DEFAULT_UNITS,
+            'timeout': config.ANALYSIS_TIMEOUT,
+            'environment': config.__class__.__name__
+        }
+    }
+
+    # Измерения и JSON с метаданными, если анализ их вернул
+    if analysis_result.get('measurements') is not None:
+        response_data['measurements'] = analysis_result['measurements']
+    if analysis_result.get('metadata_file'):
+        response_data['metadata_file_url'] = url_for('api.download_processed',
+                                                     filename=analysis_result['metadata_file'],
+                                                     _external=True)
+    if analysis_result.get('frames_csv_file'):
+        response_data['frames_csv_url'] = url_for('api.download_processed',
+                                                  filename=analysis_result['frames_csv_file'],
+                                                  _external=True)
+    if analysis_result.get('geometry'):
+        response_data['geometry'] = analysis_result['geometry']
+        response_data['measurements_url'] = url_for('api.get_result_measurements', job_id=job.id, _external=True)
+        response_data['overlay_url'] = url_for('api.render_result_overlay', job_id=job.id, _external=True)
+
+    if analysis_result.get('profile'):
+        response_data['profile_url'] = url_for('api.get_job_profile', job_id=job.id, _external=True)
+
+    # Добавляем конфигурацию анализа если есть
+    if 'analysis_config' in analysis_result:
+        # Конвертируем любые set объекты в списки
+        response_data['analysis_config'] = convert_sets_to_lists(analysis_result['analysis_config'])
+
+    return response_data
+
 
 def create_dummy_video(output_path):
     """Создает демонстрационное видео (заглушка для тестирования)"""
@@ -212,7 +687,7 @@ def create_dummy_video(output_path):
             f.write(b'')
 
 
-@app.route('/', methods=['GET'])
+@api.route('/', methods=['GET'])
 def index():
     """Главная страница приложения"""
     # Здесь можно либо отдать HTML файл, либо перенаправить
@@ -225,16 +700,21 @@ def index():
         'available_endpoints': {
             '/': 'GET - Эта страница',
             '/health': 'GET - Проверка здоровья сервиса',
-            '/upload': 'POST - Загрузка файла для анализа',
+            '/upload': 'POST - Загрузка файла для анализа (возвращает job_id)',
+            '/upload/batch': 'POST - Пакетная загрузка (multipart или JSON-манифест), ответ NDJSON',
             '/download/<filename>': 'GET - Скачивание результата',
-            '/status/<filename>': 'GET - Статус анализа',
-            '/cleanup': 'POST - Очистка временных файлов'
+            '/status/<job_id>': 'GET - Статус задания анализа',
+            '/jobs/<job_id>': 'DELETE - Отмена задания анализа',
+            '/jobs/<job_id>/events': 'GET - Поток событий задания (Server-Sent Events)',
+            '/results/<job_id>/measurements': 'GET - Измерения в других единицах (?units=)',
+            '/results/<job_id>/overlay': 'GET - Перерисовка измерений (?units=, measurement_color, ...)',
+            '/cleanup': 'POST - Фоновая очистка файлов (?mode=all|expired)'
         },
         'note': 'Для использования веб-интерфейса откройте файл index.html в браузере'
     })
 
 
-@app.route('/app', methods=['GET'])
+@api.route('/app', methods=['GET'])
 def serve_app():
     """Отдает HTML интерфейс приложения"""
     # Простой HTML интерфейс встроенный в Flask
@@ -339,7 +819,7 @@ def serve_app():
     return html_content
 
 
-@app.route('/test-cors', methods=['GET', 'POST', 'OPTIONS'])
+@api.route('/test-cors', methods=['GET', 'POST', 'OPTIONS'])
 def test_cors():
     """Тестовый endpoint для проверки CORS"""
     if request.method == 'OPTIONS':
@@ -362,7 +842,7 @@ def test_cors():
     return response
 
 
-@app.route('/health', methods=['GET'])
+@api.route('/health', methods=['GET'])
 def health_check():
     """Проверка здоровья сервиса анализа расстояний"""
 
@@ -378,92 +858,137 @@ def health_check():
         'supported_formats': get_supported_formats_json(),  # Используем helper функцию
         'default_units': config.DEFAULT_UNITS,
         'analysis_timeout': config.ANALYSIS_TIMEOUT,
+        'jobs': job_manager.stats(),
+        'analysis_pool': analysis_pool.stats(),
+        'result_cache': result_cache.stats(),
+        'rate_limit': rate_limiter.stats(),
+        'retention': sweeper.stats(),
+        'worker': get_services().worker_info,
         'debug_mode': config.DEBUG
     })
 
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    """Обрабатывает загрузку файла для анализа расстояний"""
-    try:
-        # Проверяем наличие файла в запросе
-        if 'file' not in request.files:
-            return jsonify({'success': False, 'error': 'Файл не найден в запросе'}), 400
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики всех процессов сервиса в текстовом формате Prometheus"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
 
-        file = request.files['file']
 
-        if file.filename == '':
-            return jsonify({'success': False, 'error': 'Файл не выбран'}), 400
+@api.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-        # Проверяем тип файла на основе конфигурации
-        is_allowed, file_type = allowed_file(file.filename)
-        if not is_allowed:
-            # Конвертируем set в list для JSON сериализации
-            all_formats = []
-            for extensions in config.ALLOWED_EXTENSIONS.values():
-                all_formats.extend(list(extensions))
-            supported_formats = ', '.join(all_formats)
 
-            return jsonify({
-                'success': False,
-                'error': f'Неподдерживаемый тип файла для анализа расстояний. Поддерживаются: {supported_formats}'
-            }), 400
+@api.after_app_request
+def record_request_metrics(response):
+    # Метка - имя обработчика без префикса blueprint, как до его появления
+    endpoint = request.endpoint.rpartition('.')[2] if request.endpoint else 'unknown'
+    metrics.http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    started = g.get('request_started')
+    if started is not None:
+        metrics.http_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+    return response
+
+
+def reject_request(status_code, error, retry_after):
+    """Отказ с заголовком Retry-After (целые секунды, не меньше 1)"""
+    seconds = math.ceil(max(1.0, retry_after))
+    response = jsonify({'success': False, 'error': error, 'retry_after': seconds})
+    response.headers['Retry-After'] = str(seconds)
+    return response, status_code
+
+
+@api.before_app_request
+def admit_upload():
+    """
+    Контроль допуска загрузок до чтения тела запроса
+
+    Отклоненная загрузка не пишется на диск: 503, если очередь заполнена или
+    оценка ожидания в ней больше ADMISSION_MAX_WAIT_SECONDS, 429 - если клиент
+    превысил лимит частоты. Retry-After - оценка, когда запрос будет принят.
+    """
+    if request.method != 'POST' or request.endpoint not in ADMISSION_ENDPOINTS:
+        return None
+
+    load = job_manager.load()
+    if ADMISSION_ENDPOINTS[request.endpoint] and load['pending'] >= load['max_queue_size']:
+        logger.warning("Очередь анализа заполнена, загрузка отклонена до приема файла")
+        return reject_request(503, f'Очередь анализа заполнена ({load["max_queue_size"]} заданий)',
+                              load['slot_eta'])
+    if load['wait_seconds'] > config.ADMISSION_MAX_WAIT_SECONDS:
+        logger.warning(f"Ожидание в очереди {load['wait_seconds']:.0f} сек, загрузка отклонена")
+        return reject_request(503, f'Сервис перегружен: ожидание анализа около {math.ceil(load["wait_seconds"] / 60)} мин',
+                              load['wait_seconds'] - config.ADMISSION_MAX_WAIT_SECONDS)
+
+    client_id = get_client_id()
+    retry_after = rate_limiter.acquire(client_id)
+    if retry_after > 0:
+        logger.warning(f"Превышен лимит частоты загрузок для клиента {client_id}")
+        return reject_request(429, 'Слишком много запросов, повторите позже', retry_after)
+    return None
+
+
+@api.before_app_request
+def start_upload_profile():
+    """Профилирование загрузки: по заголовку с ADMIN_TOKEN или для доли PROFILING['sample_rate']"""
+    if request.method != 'POST' or request.endpoint != 'api.upload_file':
+        return None
+    g.profile_trigger = request_trigger(config.PROFILING, request.headers.get(config.PROFILING['header']),
+                                        config.ADMIN_TOKEN)
+    g.request_profiler = profile_request(g.profile_trigger)
+    return None
+
+
+@api.after_app_request
+def save_upload_profile(response):
+    """Сохраняет профиль запроса /upload рядом с артефактами созданного задания"""
+    profiler = g.get('request_profiler')
+    if profiler is None:
+        return response
+    profiler.disable()
+    job_id = g.get('profile_job_id')
+    if job_id is not None:
+        filename = profile_name(job_id, '_upload.prof')
+        try:
+            profiler.dump_stats(os.path.join(config.PROCESSED_FOLDER, filename))
+            artifact_registry.register(filename, job_id=job_id, kind='profile')
+        except OSError as e:
+            logger.error(f"Не удалось сохранить профиль загрузки {job_id}: {e}")
+    return response
 
-        # Создаем безопасное имя файла
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join(config.UPLOAD_FOLDER, unique_filename)
-
-        # Сохраняем файл
-        file.save(file_path)
-        logger.info(f"Файл сохранен для анализа: {file_path}")
-
-        # Получаем информацию о файле
-        file_info = get_file_info(file_path)
-
-        # Отправляем файл на анализ расстояний с настройками из конфига
-        analysis_result = send_to_distance_analysis_service(file_path, file_type)
-
-        if analysis_result['success']:
-            # Формируем URL для скачивания результата анализа
-            analysis_file_url = url_for('download_processed',
-                                        filename=analysis_result['processed_file'],
-                                        _external=True)
-
-            response_data = {
-                'success': True,
-                'message': 'Анализ расстояний успешно выполнен',
-                'original_file': unique_filename,
-                'processed_file': analysis_result['processed_file'],
-                'processed_file_url': analysis_file_url,
-                'file_type': file_type,
-                'file_info': file_info,
-                'distances_calculated': analysis_result.get('distances_calculated', False),
-                'is_placeholder': analysis_result.get('is_placeholder', False),  # Флаг заглушки
-                'analysis_settings': {
-                    'units': config.DEFAULT_UNITS,
-                    'timeout': config.ANALYSIS_TIMEOUT,
-                    'environment': config.__class__.__name__
-                }
-            }
-
-            # Добавляем конфигурацию анализа если есть
-            if 'analysis_config' in analysis_result:
-                # Конвертируем любые set объекты в списки
-                response_data['analysis_config'] = convert_sets_to_lists(analysis_result['analysis_config'])
 
+@api.route('/upload', methods=['POST'])
+def upload_file():
+    """Обрабатывает загрузку файла для анализа расстояний"""
+    try:
+        # Принимаем файл потоково: одна запись на диск, хеш и размер считаются на лету
+        try:
+            uploaded = receive_uploaded_file()
+        except (UploadTooLargeError, RequestEntityTooLarge) as e:
+            return too_large(e)
+        except UploadError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        if uploaded is None:
+            return jsonify({'success': False, 'error': 'Файл не найден в запросе'}), 400
+
+        try:
+            job = submit_upload(uploaded)
+        except QueueFullError as e:
+            logger.warning(f"Очередь анализа заполнена, файл отклонен: {uploaded.path}")
+            remove_upload(uploaded.path)
+            return reject_request(503, str(e), job_manager.load()['slot_eta'])
+        g.profile_job_id = job.id
+
+        if job.is_finished:
+            response_data = build_analysis_response(job)
+            response_data['cached'] = True
             return jsonify(response_data)
-        else:
-            # Удаляем загруженный файл при ошибке
-            try:
-                os.remove(file_path)
-            except:
-                pass
 
-            return jsonify({
-                'success': False,
-                'error': 'Ошибка анализа расстояний'
-            }), 500
+        response_data = build_queued_response(job)
+        response = jsonify(response_data)
+        response.headers['Location'] = response_data['status_url']
+        return response, 202
 
     except Exception as e:
         logger.error(f"Ошибка при анализе файла: {e}")
@@ -473,89 +998,783 @@ def upload_file():
         }), 500
 
 
-@app.route('/download/<filename>')
+def submit_upload(uploaded):
+    """
+    Создает задание для принятого файла
+
+    Если файл с теми же настройками уже анализировался, задание сразу
+    завершено результатом из кеша. QueueFullError - очередь заполнена.
+    """
+    _, file_type = allowed_file(uploaded.filename)
+    file_path = uploaded.path
+    unique_filename = os.path.basename(file_path)
+    logger.info(f"Файл сохранен для анализа: {file_path} ({uploaded.size} байт, sha256 {uploaded.sha256})")
+
+    # Информация о файле собрана при приеме, повторный os.stat не нужен
+    file_info = uploaded.file_info()
+    metrics.upload_receive_seconds.observe(uploaded.receive_seconds)
+    metrics.upload_save_seconds.observe(uploaded.save_seconds)
+    metrics.upload_bytes.inc(uploaded.size)
+
+    # Такой файл уже анализировался с теми же настройками - отдаем готовый результат
+    cached_result = result_cache.get(get_cache_key(uploaded.sha256, file_type))
+    if result_cache.enabled:
+        metrics.result_cache_requests.inc(result='miss' if cached_result is None else 'hit')
+    if cached_result is not None:
+        logger.info(f"Результат для {file_path} найден в кеше: {cached_result['processed_file']}")
+        remove_upload(file_path)
+        return job_manager.record_completed(file_path, file_type, unique_filename, file_info, cached_result)
+
+    # Длительность видео нужна планировщику для оценки стоимости анализа
+    video_info = probe_video(file_path) if file_type == 'video' else None
+
+    # Ставим файл в очередь на анализ, не блокируя поток запроса
+    job = job_manager.submit(file_path, file_type, unique_filename, file_info,
+                             client_id=get_client_id(), video_info=video_info, profile=g.get('profile_trigger'))
+
+    # Загрузка хранится до истечения срока; пока задание активно, очистка ее не тронет
+    try:
+        upload_registry.register(unique_filename, uploaded.sha256, job.id, kind='upload')
+    except OSError as e:
+        logger.warning(f"Загрузка {file_path} не записана в индекс: {e}")
+    return job
+
+
+def get_client_id():
+    """
+    Идентификатор клиента для справедливой очереди и лимитов
+
+    IP-адрес соединения; заголовок CLIENT_ID_HEADER - только от доверенного
+    шлюза или с токеном администратора, иначе клиент обходил бы лимиты,
+    меняя заголовок в каждом запросе.
+    """
+    if config.CLIENT_ID_HEADER and (is_trusted_proxy(request.remote_addr) or has_admin_token()):
+        client_id = request.headers.get(config.CLIENT_ID_HEADER)
+        if client_id:
+            return client_id
+    return request.remote_addr
+
+
+def is_trusted_proxy(address):
+    """Адрес соединения входит в CLIENT_ID_TRUSTED_PROXIES"""
+    if not address or not config.CLIENT_ID_TRUSTED_PROXIES:
+        return False
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted_proxy_networks(config.CLIENT_ID_TRUSTED_PROXIES))
+
+
+@functools.lru_cache(maxsize=8)
+def trusted_proxy_networks(proxies):
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def build_queued_response(job):
+    """Ответ для задания, поставленного в очередь"""
+    return {
+        'success': True,
+        'message': 'Файл принят, анализ расстояний поставлен в очередь',
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('api.get_job_status', job_id=job.id, _external=True),
+        'events_url': url_for('api.stream_job_events', job_id=job.id, _external=True),
+        'original_file': job.original_file,
+        'file_type': job.file_type,
+        'file_info': job.file_info
+    }
+
+
+def build_batch_line(index, filename, job=None, error=None, cached=False):
+    """Строка NDJSON с результатом одного файла пакета"""
+    if job is None:
+        line = {'success': False, 'error': error}
+    elif job.status == JOB_COMPLETED:
+        line = build_analysis_response(job)
+        if cached:
+            line['cached'] = True
+    else:
+        line = {'success': False, 'job_id': job.id, 'status': job.status,
+                'error': job.error or 'Задание отменено'}
+    line['index'] = index
+    line['filename'] = filename
+    return json.dumps(line, ensure_ascii=False, default=str) + '\n'
+
+
+def receive_batch_multipart(rejected):
+    """
+    Файлы пакета из multipart/form-data (поля file и files) по мере приема
+
+    Файлы неподдерживаемых типов не сохраняются, их имена добавляются в rejected.
+    """
+    def destination(field, filename):
+        if field not in ('file', 'files'):
+            return None
+        try:
+            return upload_destination(filename)
+        except UploadError as e:
+            rejected.append((filename, str(e)))
+            return None
+
+    stream = get_input_stream(request.environ, max_content_length=config.BATCH_MAX_CONTENT_LENGTH)
+    return iter_multipart_files(stream, request.content_type, destination,
+                                max_size=config.MAX_CONTENT_LENGTH)
+
+
+def parse_batch_manifest():
+    """
+    Манифест пакета: {"files": ["https://...", {"url": ..., "filename": ...}]}
+
+    Возвращает список (url, filename); UploadError - некорректный манифест.
+    """
+    if not config.BATCH_URL_HOSTS:
+        raise UploadError('Загрузка по ссылкам выключена: не задан BATCH_URL_HOSTS')
+    manifest = request.get_json(silent=True)
+    items = manifest.get('files') if isinstance(manifest, dict) else None
+    if not isinstance(items, list) or not items:
+        raise UploadError('Манифест должен содержать непустой список files')
+
+    entries = []
+    for item in items:
+        url = item.get('url') if isinstance(item, dict) else item
+        if not isinstance(url, str):
+            raise UploadError(f'Некорректный URL в манифесте: {url!r}')
+        # Адреса хоста проверяются при скачивании - на каждом перенаправлении
+        parsed = check_url(url, config.BATCH_URL_HOSTS, config.BATCH_URL_SCHEMES)
+        filename = item.get('filename') if isinstance(item, dict) else None
+        entries.append((url, filename or os.path.basename(parsed.path)))
+    return entries
+
+
+def download_manifest_file(url, filename):
+    """Скачивает файл манифеста потоково в UPLOAD_FOLDER"""
+    path = upload_destination(filename)
+    return download_url(url, filename, path, config.BATCH_URL_HOSTS, config.BATCH_URL_SCHEMES,
+                        timeout=config.BATCH_DOWNLOAD_TIMEOUT, max_size=config.MAX_CONTENT_LENGTH,
+                        max_redirects=config.BATCH_URL_MAX_REDIRECTS)
+
+
+def receive_batch():
+    """
+    Источник файлов пакета по типу запроса
+
+    Возвращает итератор (index, имя файла, IngestedFile или текст ошибки)
+    или None, если тип запроса не поддерживается. UploadError -
+    некорректный манифест.
+    """
+    if request.mimetype == 'multipart/form-data':
+        rejected = []
+        return iter_multipart_batch(receive_batch_multipart(rejected), rejected)
+    if request.is_json:
+        manifest = parse_batch_manifest()
+        if len(manifest) > config.BATCH_MAX_FILES:
+            raise UploadError(f'В пакете больше {config.BATCH_MAX_FILES} файлов')
+        return iter_manifest_batch(manifest)
+    return None
+
+
+def iter_multipart_batch(files, rejected):
+    """Файлы multipart-пакета по мере приема; отклоненные по типу - с текстом ошибки на своих местах"""
+    index = 0
+    try:
+        for uploaded in files:
+            for filename, error in rejected:
+                yield index, filename, error
+                index += 1
+            rejected.clear()
+            if index >= config.BATCH_MAX_FILES:
+                remove_upload(uploaded.path)
+                yield index, uploaded.filename, f'В пакете больше {config.BATCH_MAX_FILES} файлов'
+                return
+            yield index, uploaded.filename, uploaded
+            index += 1
+    except UploadError as e:
+        yield index, None, str(e)
+    for filename, error in rejected:
+        yield index, filename, error
+        index += 1
+
+
+def iter_manifest_batch(manifest):
+    """Файлы манифеста: скачиваются параллельно и отдаются по мере готовности"""
+    with ThreadPoolExecutor(max_workers=config.BATCH_DOWNLOAD_WORKERS,
+                            thread_name_prefix='batch-download') as executor:
+        download = with_app_context(download_manifest_file)
+        downloads = {executor.submit(download, url, filename): (index, filename)
+                     for index, (url, filename) in enumerate(manifest)}
+        try:
+            for future in as_completed(downloads):
+                index, filename = downloads[future]
+                try:
+                    yield index, filename, future.result()
+                except UploadError as e:
+                    yield index, filename, str(e)
+        finally:
+            for future in downloads:
+                future.cancel()
+
+
+def finished_batch_lines(pending, timeout=0):
+    """Строки NDJSON заданий пакета, завершившихся за timeout (None - дождаться первого)"""
+    done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+    for future in done:
+        index, filename, job = pending.pop(future)
+        yield build_batch_line(index, filename, job)
+
+
+def submit_batch_file(pending, index, filename, uploaded):
+    """
+    Ставит файл пакета в очередь и добавляет задание в pending
+
+    Если очередь заполнена, ждет места: сначала завершения своих заданий
+    (их строки отдаются сразу), иначе - любого освободившегося места.
+    """
+    while True:
+        try:
+            job = submit_upload(uploaded)
+        except QueueFullError as e:
+            if pending:
+                yield from finished_batch_lines(pending, timeout=None)
+            elif not job_manager.wait_for_slot(config.ANALYSIS_TIMEOUT):
+                remove_upload(uploaded.path)
+                yield build_batch_line(index, filename, error=str(e))
+                return
+            continue
+        if job.is_finished:
+            yield build_batch_line(index, filename, job, cached=True)
+        else:
+            pending[job.future] = (index, filename, job)
+        return
+
+
+def stream_batch_results(received):
+    """NDJSON пакета: строка на файл в порядке готовности"""
+    pending = {}  # future задания -> (index, имя файла, задание)
+    for index, filename, item in received:
+        yield from finished_batch_lines(pending)
+        if isinstance(item, str):
+            yield build_batch_line(index, filename, error=item)
+        else:
+            yield from submit_batch_file(pending, index, filename, item)
+
+    while pending:
+        yield from finished_batch_lines(pending, timeout=None)
+
+
+@api.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    Пакетная загрузка файлов для анализа
+
+    Принимает multipart/form-data с несколькими файлами (поля file или files)
+    либо JSON-манифест со ссылками на файлы. Каждый файл ставится в очередь
+    сразу после приема, а ответ - NDJSON: по строке на файл в порядке
+    завершения анализа, в формате ответа /upload (плюс index и filename).
+    Задания, не дождавшиеся обрыва соединения, продолжают выполняться.
+    """
+    try:
+        received = receive_batch()
+    except RequestEntityTooLarge:
+        max_size_mb = config.BATCH_MAX_CONTENT_LENGTH / (1024 * 1024)
+        return jsonify({
+            'success': False,
+            'error': f'Пакет слишком большой. Максимальный размер: {max_size_mb:.0f}MB'
+        }), 413
+    except UploadError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    if received is None:
+        return jsonify({
+            'success': False,
+            'error': 'Ожидается multipart/form-data с файлами или JSON-манифест'
+        }), 400
+
+    response = Response(stream_with_context(stream_batch_results(received)), mimetype='application/x-ndjson')
+    # nginx не должен буферизовать поток результатов
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@api.route('/download/<filename>')
 def download_processed(filename):
-    """Возвращает обработанный файл для скачивания"""
+    """
+    Возвращает обработанный файл для скачивания
+
+    Результаты неизменяемы, поэтому отдаются с сильным ETag (SHA-256 содержимого),
+    Last-Modified и долгим Cache-Control. Поддерживаются Range (206),
+    If-None-Match / If-Modified-Since (304). Параметр ?inline=1 отдает файл
+    без Content-Disposition: attachment (для воспроизведения видео в браузере).
+    """
     try:
         file_path = os.path.join(config.PROCESSED_FOLDER, filename)
 
-        if not os.path.exists(file_path):
+        # Профили заданий доступны только администратору (/admin/jobs/<job_id>/profile)
+        if filename.startswith(PROFILE_PREFIX):
+            return jsonify({'error': 'Файл не найден'}), 404
+
+        # Размер, mtime и хеш - из индекса артефактов, без обращения к файловой системе
+        artifact = artifact_registry.lookup(filename)
+        if artifact is None:
             return jsonify({'error': 'Файл не найден'}), 404
 
         # Определяем MIME тип
         mime_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        last_modified = artifact['mtime_ns'] / 1e9
+        as_attachment = request.args.get('inline') != '1'
 
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=filename,
-            mimetype=mime_type
-        )
+        if config.DOWNLOAD_OFFLOAD == 'x-accel-redirect':
+            response = offload_download(filename, mime_type, artifact['sha256'], last_modified, as_attachment)
+        else:
+            # В режиме x-sendfile send_file сам выставляет X-Sendfile (USE_X_SENDFILE)
+            try:
+                response = send_file(
+                    file_path,
+                    as_attachment=as_attachment,
+                    download_name=filename,
+                    mimetype=mime_type,
+                    conditional=True,
+                    etag=artifact['sha256'],
+                    last_modified=last_modified,
+                    max_age=config.DOWNLOAD_CACHE_MAX_AGE
+                )
+            except FileNotFoundError:
+                # Файл удален в обход индекса
+                artifact_registry.forget(filename)
+                return jsonify({'error': 'Файл не найден'}), 404
+            response.headers.setdefault('Accept-Ranges', 'bytes')
+
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        record_download_bytes(response, artifact)
+        return response
 
     except Exception as e:
         logger.error(f"Ошибка при скачивании файла: {e}")
         return jsonify({'error': 'Ошибка скачивания файла'}), 500
 
 
-@app.route('/status/<filename>')
-def get_file_status(filename):
-    """Получает статус обработки файла"""
+def record_download_bytes(response, artifact):
+    """Учитывает отданные байты; при X-Accel-Redirect их отдает nginx - считаем файл целиком"""
+    if request.method == 'HEAD' or response.status_code not in (200, 206):
+        return
+    if config.DOWNLOAD_OFFLOAD == 'x-accel-redirect':
+        sent = artifact['size']
+    else:
+        sent = response.content_length or 0
+    metrics.download_bytes.inc(sent, mode=config.DOWNLOAD_OFFLOAD or 'app')
+
+
+def offload_download(filename, mime_type, etag, last_modified, as_attachment):
+    """
+    Ответ с X-Accel-Redirect: байты файла отдает nginx, а не Python-воркер
+
+    Условные запросы (304) обрабатываются здесь, Range - самим nginx.
+    """
+    response = Response(mimetype=mime_type)
+    response.headers['X-Accel-Redirect'] = config.DOWNLOAD_OFFLOAD_PREFIX + filename
+    if as_attachment:
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.max_age = config.DOWNLOAD_CACHE_MAX_AGE
+    return response.make_conditional(request, accept_ranges=False)
+
+
+@api.route('/status/<job_id>')
+def get_job_status(job_id):
+    """Получает статус задания анализа"""
+    try:
+        job = job_manager.get(job_id)
+
+        if job is None:
+            return jsonify({'error': 'Задание не найдено'}), 404
+
+        response_data = job.to_dict()
+
+        if job.status == JOB_COMPLETED:
+            response_data['result'] = build_analysis_response(job)
+            response_data['download_url'] = response_data['result']['processed_file_url']
+        elif job.status == JOB_FAILED:
+            response_data['success'] = False
+
+        return jsonify(response_data)
+
+    except Exception as e:
+        logger.error(f"Ошибка получения статуса: {e}")
+        return jsonify({'error': 'Ошибка получения статуса'}), 500
+
+
+def format_job_event(job, event_id, event, data):
+    """
+    Событие задания в формате Server-Sent Events
+
+    Типы событий - NOTIFICATION_CONFIG['notification_types']: info (смена
+    состояния), progress, success (с результатом) и error.
+    """
+    payload = {'job_id': job.id, **data}
+    if event == EVENT_PROGRESS:
+        name = 'progress'
+    elif data.get('status') == JOB_COMPLETED:
+        name = 'success'
+        payload['result'] = build_analysis_response(job)
+    elif data.get('status') in (JOB_FAILED, JOB_CANCELLED):
+        name = 'error'
+    else:
+        name = 'info'
+    body = json.dumps(payload, ensure_ascii=False, default=str)
+    return f"id: {event_id}\nevent: {name}\ndata: {body}\n\n"
+
+
+@api.route('/jobs/<job_id>/events')
+def stream_job_events(job_id):
+    """
+    Поток событий задания (Server-Sent Events) вместо опроса /status
+
+    Поддерживается Last-Event-ID: после переподключения приходят только
+    пропущенные события. Поток закрывается после финального события.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Задание не найдено'}), 404
+
     try:
-        processed_path = os.path.join(config.PROCESSED_FOLDER, filename)
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_id = 0
+    send_progress = NOTIFICATION_CONFIG.get('enable_progress_notifications', True)
+
+    def generate():
+        nonlocal last_id
+        yield f"retry: {config.SSE_RETRY_MS}\n\n"
+        while True:
+            events = job_manager.wait_events(job, last_id, timeout=config.SSE_HEARTBEAT_INTERVAL)
+            if not events:
+                # Комментарий не дает прокси закрыть простаивающее соединение
+                yield ': keepalive\n\n'
+                continue
+            for event_id, event, data in events:
+                last_id = event_id
+                if event == EVENT_PROGRESS and not send_progress:
+                    continue
+                yield format_job_event(job, event_id, event, data)
+                if event == EVENT_STATUS and job.is_finished and data.get('status') == job.status:
+                    return
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+REMOTE_CANCEL_WAIT = 3.0  # Сколько ждать отмены задания процессом-владельцем (сек)
 
-        if os.path.exists(processed_path):
-            file_info = get_file_info(processed_path)
+
+@api.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """
+    Отменяет задание анализа и сразу освобождает процесс анализа
+
+    Задание другого процесса (воркера) отменяет его владелец по флагу в
+    индексе: ответ ждет отмены до REMOTE_CANCEL_WAIT секунд, затем - 202.
+    """
+    try:
+        job = job_manager.cancel(job_id)
+
+        if job is None:
+            return jsonify({'error': 'Задание не найдено'}), 404
+
+        if job.detached and not job.is_finished:
+            deadline = time.monotonic() + REMOTE_CANCEL_WAIT
+            after_id = job.last_event_id
+            while not job.is_finished and time.monotonic() < deadline:
+                for event_id, _, _ in job_manager.wait_events(job, after_id, deadline - time.monotonic()):
+                    after_id = event_id
+            if not job.is_finished:
+                return jsonify({
+                    'success': True,
+                    'message': 'Отмена передана процессу, выполняющему задание',
+                    'job_id': job.id,
+                    'status': job.status
+                }), 202
+
+        if job.is_finished and job.status != JOB_CANCELLED:
             return jsonify({
-                'status': 'completed',
-                'file_info': file_info,
-                'download_url': url_for('download_processed', filename=filename, _external=True),
-                'analysis_settings': {
-                    'units': config.DEFAULT_UNITS,
-                    'environment': config.__class__.__name__,
-                    'supported_formats': get_supported_formats_json()  # Безопасная сериализация
-                }
-            })
+                'success': False,
+                'error': 'Задание уже завершено',
+                'status': job.status
+            }), 409
+
+        return jsonify({
+            'success': True,
+            'message': 'Задание анализа отменено',
+            'job_id': job.id,
+            'status': JOB_CANCELLED
+        })
+
+    except Exception as e:
+        logger.error(f"Ошибка отмены задания: {e}")
+        return jsonify({'error': 'Ошибка отмены задания'}), 500
+
+
+def get_result_geometry(job_id):
+    """
+    Геометрия результата задания
+
+    Возвращает (job, None) или (None, ответ с ошибкой).
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return None, (jsonify({'error': 'Задание не найдено'}), 404)
+    if job.status != JOB_COMPLETED:
+        return None, (jsonify({
+            'success': False,
+            'error': 'Задание еще не завершено',
+            'status': job.status
+        }), 409)
+    if not job.result.get('geometry'):
+        return None, (jsonify({
+            'success': False,
+            'error': 'Для этого результата геометрия не сохранена (поддерживаются изображения)'
+        }), 422)
+    return job, None
+
+
+def get_requested_scale(job):
+    """Единицы из ?units= (по умолчанию - запрошенные при загрузке) и множитель перевода пикселей в них"""
+    geometry = job.result['geometry']
+    units = request.args.get('units') or job.result['measurements'].get('requested_units', config.DEFAULT_UNITS)
+    if units not in config.SUPPORTED_UNITS:
+        raise ValueError(f'Неподдерживаемые единицы измерения: {units}. '
+                         f'Поддерживаются: {", ".join(config.SUPPORTED_UNITS)}')
+    meters_per_pixel = request.args.get('meters_per_pixel', type=float)
+    if meters_per_pixel is not None and meters_per_pixel <= 0:
+        raise ValueError('meters_per_pixel должен быть положительным числом')
+    return units, units_per_pixel(geometry, units, meters_per_pixel)
+
+
+def parse_output_overrides():
+    """Параметры наложения из query string поверх DISTANCE_ANALYSIS_CONFIG['output']"""
+    output_config = dict(DISTANCE_ANALYSIS_CONFIG.get('output', {}))
+    for name in OUTPUT_OVERRIDES:
+        value = request.args.get(name)
+        if value is None:
+            continue
+        if name == 'measurement_color':
+            # "#00ff00" или "0,255,0"
+            if value.startswith('#') and len(value) == 7:
+                output_config[name] = tuple(int(value[i:i + 2], 16) for i in (1, 3, 5))
+            else:
+                output_config[name] = tuple(int(part) for part in value.split(','))
+            if len(output_config[name]) != 3:
+                raise ValueError(name)
+        elif name == 'line_thickness':
+            output_config[name] = int(value)
         else:
+            output_config[name] = float(value)
+    return output_config
+
+
+def get_base_image(geometry):
+    """Исходное изображение результата в разрешении анализа (с кешем)"""
+    key = f"{geometry['source_file']}:{geometry['image_size'][0]}x{geometry['image_size'][1]}"
+    image = render_cache.get(key)
+    if render_cache.enabled:
+        metrics.render_cache_requests.inc(result='miss' if image is None else 'hit')
+    if image is None:
+        image = load_base_image(config.PROCESSED_FOLDER, geometry)
+        render_cache.put(key, image)
+    return image
+
+
+@api.route('/results/<job_id>/measurements')
+def get_result_measurements(job_id):
+    """Измерения результата в запрошенных единицах без повторного анализа"""
+    try:
+        job, error_response = get_result_geometry(job_id)
+        if error_response is not None:
+            return error_response
+
+        geometry = job.result['geometry']
+        try:
+            units, factor = get_requested_scale(job)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        except GeometryError as e:
+            return jsonify({'success': False, 'error': str(e)}), 422
+
+        measurements = job.result['measurements']
+        objects, distances = convert_measurements(measurements['objects'], measurements['distances'], factor)
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'units': units,
+            'units_per_pixel': factor,
+            'calibration': geometry['calibration'],
+            'image_size': geometry['image_size'],
+            'objects': objects,
+            'distances': distances
+        })
+
+    except Exception as e:
+        logger.error(f"Ошибка пересчета измерений: {e}")
+        return jsonify({'error': 'Ошибка пересчета измерений'}), 500
+
+
+@api.route('/results/<job_id>/overlay')
+def render_result_overlay(job_id):
+    """Перерисовывает измерения поверх исходного изображения с другими единицами или стилем"""
+    try:
+        job, error_response = get_result_geometry(job_id)
+        if error_response is not None:
+            return error_response
+
+        geometry = job.result['geometry']
+        try:
+            units, factor = get_requested_scale(job)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        except GeometryError as e:
+            return jsonify({'success': False, 'error': str(e)}), 422
+
+        try:
+            output_config = parse_output_overrides()
+        except ValueError:
             return jsonify({
-                'status': 'processing',
-                'estimated_time': config.ANALYSIS_TIMEOUT
-            })
+                'success': False,
+                'error': f'Некорректные параметры наложения: {", ".join(OUTPUT_OVERRIDES)}'
+            }), 400
+
+        if artifact_registry.get(geometry['source_file']) is None:
+            return jsonify({'error': 'Исходное изображение результата удалено'}), 404
+
+        measurements = job.result['measurements']
+        extension = os.path.splitext(geometry['source_file'])[1]
+        data = render(get_base_image(geometry), measurements['objects'], measurements['distances'],
+                      output_config, units, factor, extension)
+
+        return send_file(
+            io.BytesIO(data),
+            mimetype=mimetypes.guess_type(geometry['source_file'])[0] or 'application/octet-stream',
+            as_attachment=request.args.get('download') == '1',
+            download_name=f"overlay_{job.id}_{units}{extension}"
+        )
 
     except Exception as e:
-        logger.error(f"Ошибка получения статуса: {e}")
-        return jsonify({'error': 'Ошибка получения статуса'}), 500
+        logger.error(f"Ошибка перерисовки измерений: {e}")
+        return jsonify({'error': 'Ошибка перерисовки измерений'}), 500
+
+
+def has_admin_token():
+    """В запросе есть заголовок Authorization: Bearer с ADMIN_TOKEN"""
+    if not config.ADMIN_TOKEN:
+        return False
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode('utf-8'),
+                                                              config.ADMIN_TOKEN.encode('utf-8'))
+
 
+def require_admin():
+    """None для запроса с токеном администратора, иначе ответ с ошибкой"""
+    if not config.ADMIN_TOKEN:
+        return jsonify({'success': False, 'error': 'Административный доступ не настроен (ADMIN_TOKEN)'}), 403
+    if not has_admin_token():
+        return jsonify({'success': False, 'error': 'Требуется токен администратора'}), 401
+    return None
 
-@app.route('/cleanup', methods=['POST'])
+
+@api.route('/admin/jobs/<job_id>/profile')
+def get_job_profile(job_id):
+    """
+    Профиль задания: отчет анализа (время и CPU по этапам, пиковый RSS) и ссылки на файлы
+
+    ?file=analysis - файл профиля анализа (pstats или collapsed stacks),
+    ?file=upload - pstats запроса /upload.
+    """
+    denied = require_admin()
+    if denied is not None:
+        return denied
+    if not job_id.isalnum():
+        return jsonify({'success': False, 'error': 'Профиль задания не найден'}), 404
+
+    files = {
+        'analysis': [profile_name(job_id, '.prof'), profile_name(job_id, '.folded')],
+        'upload': [profile_name(job_id, '_upload.prof')]
+    }
+    available = {}
+    for kind, candidates in files.items():
+        for filename in candidates:
+            if artifact_registry.get(filename) is not None:
+                available[kind] = filename
+                break
+
+    requested = request.args.get('file')
+    if requested is not None:
+        if requested not in files:
+            return jsonify({'success': False, 'error': 'Параметр file: analysis или upload'}), 400
+        if requested not in available:
+            return jsonify({'success': False, 'error': 'Файл профиля не найден'}), 404
+        try:
+            return send_file(os.path.join(config.PROCESSED_FOLDER, available[requested]), as_attachment=True,
+                             download_name=available[requested], mimetype='application/octet-stream')
+        except FileNotFoundError:
+            artifact_registry.forget(available[requested])
+            return jsonify({'success': False, 'error': 'Файл профиля не найден'}), 404
+
+    report = None
+    report_file = profile_name(job_id, '.json')
+    if artifact_registry.get(report_file) is not None:
+        try:
+            with open(os.path.join(config.PROCESSED_FOLDER, report_file), encoding='utf-8') as f:
+                report = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Отчет профиля {report_file} не прочитан: {e}")
+    if report is None and not available:
+        return jsonify({'success': False, 'error': 'Профиль задания не найден'}), 404
+
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'analysis': report,
+        'files': {kind: url_for('api.get_job_profile', job_id=job_id, file=kind, _external=True) for kind in available}
+    })
+
+
+@api.route('/cleanup', methods=['POST'])
 def cleanup_files():
-    """Очищает временные файлы (для администрирования)"""
-    try:
-        import shutil
+    """
+    Запускает очистку файлов в фоне (для администрирования)
 
-        # Очищаем папки загрузок и обработанных файлов
-        if os.path.exists(config.UPLOAD_FOLDER):
-            shutil.rmtree(config.UPLOAD_FOLDER)
-            os.makedirs(config.UPLOAD_FOLDER)
+    ?mode=all (по умолчанию) - удалить все файлы, кроме файлов заданий в очереди
+    и в работе; ?mode=expired - только файлы с истекшим сроком хранения.
+    Удаление идет пачками в потоке очистки, ответ возвращается сразу.
+    """
+    try:
+        mode = request.args.get('mode', 'all')
+        if mode not in ('all', 'expired'):
+            return jsonify({'success': False, 'error': 'mode должен быть all или expired'}), 400
 
-        if os.path.exists(config.PROCESSED_FOLDER):
-            shutil.rmtree(config.PROCESSED_FOLDER)
-            os.makedirs(config.PROCESSED_FOLDER)
+        sweeper.request_sweep(expire_all=mode == 'all')
+        if mode == 'all':
+            render_cache.clear()
 
-        logger.info("Временные файлы очищены")
+        logger.info(f"Запрошена очистка файлов (mode={mode})")
 
         return jsonify({
             'success': True,
-            'message': 'Временные файлы очищены',
+            'message': 'Очистка файлов запущена',
+            'mode': mode,
             'upload_folder': config.UPLOAD_FOLDER,
-            'processed_folder': config.PROCESSED_FOLDER
-        })
+            'processed_folder': config.PROCESSED_FOLDER,
+            'retention': sweeper.stats()
+        }), 202
 
     except Exception as e:
         logger.error(f"Ошибка очистки: {e}")
         return jsonify({'error': 'Ошибка очистки файлов'}), 500
 
 
-@app.errorhandler(TypeError)
+@api.app_errorhandler(TypeError)
 def handle_json_error(e):
     """Обработчик ошибок JSON сериализации"""
     if "not JSON serializable" in str(e):
@@ -570,7 +1789,7 @@ def handle_json_error(e):
     raise e
 
 
-@app.errorhandler(413)
+@api.app_errorhandler(413)
 def too_large(e):
     """Обработчик ошибки слишком большого файла"""
     max_size_mb = config.MAX_CONTENT_LENGTH / (1024 * 1024)
@@ -580,7 +1799,7 @@ def too_large(e):
     }), 413
 
 
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def internal_error(error):
     """Обработчик внутренних ошибок сервера"""
     logger.error(f"Внутренняя ошибка: {error}")
@@ -601,36 +1820,37 @@ def internal_error(error):
 
 
 if __name__ == '__main__':
-    # Проверяем наличие необходимых папок
-    if not os.path.exists(config.UPLOAD_FOLDER):
-        os.makedirs(config.UPLOAD_FOLDER)
-        logger.info(f"Создана папка для загрузок: {config.UPLOAD_FOLDER}")
+    app = create_app(start=False)
+    settings = get_services(app).config
 
-    if not os.path.exists(config.PROCESSED_FOLDER):
-        os.makedirs(config.PROCESSED_FOLDER)
-        logger.info(f"Создана папка для результатов анализа: {config.PROCESSED_FOLDER}")
+    # Заранее запускаем процессы анализа, чтобы первое задание не ждало их старта
+    start_services(app, start_pool=True)
 
     # Информация о запуске с использованием конфигурации
     logger.info("=" * 60)
     logger.info("🚀 Запуск сервиса анализа расстояний")
     logger.info("=" * 60)
-    logger.info(f"📊 Режим работы: {config.__class__.__name__}")
-    logger.info(f"🐛 Debug режим: {config.DEBUG}")
-    logger.info(f"📁 Папка загрузок: {config.UPLOAD_FOLDER}")
-    logger.info(f"📁 Папка результатов: {config.PROCESSED_FOLDER}")
-    logger.info(f"📦 Максимальный размер файла: {config.MAX_CONTENT_LENGTH / (1024 * 1024):.0f}MB")
-    logger.info(f"⏱️  Таймаут анализа: {config.ANALYSIS_TIMEOUT} сек")
-    logger.info(f"📏 Единицы измерения по умолчанию: {config.DEFAULT_UNITS}")
-    logger.info(f"🎯 Поддерживаемые форматы:")
-    for file_type, extensions in config.ALLOWED_EXTENSIONS.items():
+    logger.info(f"📊 Режим работы: {settings.__class__.__name__}")
+    logger.info(f"🐛 Debug режим: {settings.DEBUG}")
+    logger.info(f"📁 Папка загрузок: {settings.UPLOAD_FOLDER}")
+    logger.info(f"📁 Папка результатов: {settings.PROCESSED_FOLDER}")
+    logger.info(f"📦 Максимальный размер файла: {settings.MAX_CONTENT_LENGTH / (1024 * 1024):.0f}MB")
+    logger.info(f"⏱️  Таймаут анализа: {settings.ANALYSIS_TIMEOUT} сек")
+    logger.info(f"📏 Единицы измерения по умолчанию: {settings.DEFAULT_UNITS}")
+    logger.info("🎯 Поддерживаемые форматы:")
+    for file_type, extensions in settings.ALLOWED_EXTENSIONS.items():
         logger.info(f"   {file_type}: {', '.join(extensions)}")
-    logger.info(f"🌐 Сервер доступен на: http://localhost:5000")
+    logger.info("🌐 Сервер доступен на: http://localhost:5000")
+    logger.info("🏭 Для продакшена (несколько воркеров): python serve.py")
     logger.info("=" * 60)
 
     # Запуск приложения с настройками из конфигурации
+    # Без перезагрузчика: в debug он запускает приложение заново в дочернем процессе, и сервисы
+    # (процессы анализа, очередь, очистка) работали бы и в родителе, который только следит за файлами
     app.run(
-        debug=config.DEBUG,
+        debug=settings.DEBUG,
         host='localhost',
         port=5000,
-        threaded=True  # Разрешаем множественные подключения
+        threaded=True,  # Разрешаем множественные подключения
+        use_reloader=False
     )
@@ -0,0 +1,181 @@
+"""
+Артефакты анализа (обработанные файлы) и их хеши содержимого
+
+Артефакты записываются в индекс (job_index): размер, mtime, хеш и срок
+хранения. Хеш используется как сильный ETag при скачивании; обычно он известен
+из результата анализа, иначе вычисляется при первом запросе и запоминается.
+Файлы, которых нет в индексе (созданные до его появления), индексируются
+при первом обращении.
+
+materialize() создает артефакт-копию файла (например, видео без найденных
+объектов) без лишнего ввода-вывода: жесткой ссылкой, reflink, копированием
+в ядре (copy_file_range/sendfile) и только в крайнем случае буферным копированием.
+"""
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Порядок попыток по умолчанию - от самой дешевой
+MATERIALIZE_STRATEGIES = ('hardlink', 'reflink', 'copy_file_range', 'sendfile', 'copy')
+
+FICLONE = 0x40049409  # ioctl(2) для reflink на Btrfs/XFS (Linux)
+
+# Ошибки, означающие "стратегия здесь недоступна" - пробуем следующую
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP,
+                       errno.EINVAL, errno.ENOSYS, errno.EMLINK, errno.ENOTTY, errno.EBADF}
+
+
+def file_sha256(path, chunk_size=HASH_CHUNK_SIZE):
+    """SHA-256 содержимого файла, читается блоками"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactRegistry:
+    """Файлы папки folder в индексе заданий; name - под каким именем папка записана в индексе"""
+
+    def __init__(self, folder, index, retention_seconds=None, name='processed'):
+        self.folder = folder
+        self.index = index
+        self.retention_seconds = retention_seconds
+        self.name = name
+
+    def register(self, filename, sha256=None, job_id=None, kind='result'):
+        """Записывает артефакт в индекс (размер и mtime - с диска); возвращает запись"""
+        stat = os.stat(os.path.join(self.folder, filename))
+        expires_at = time.time() + self.retention_seconds if self.retention_seconds else None
+        self.index.put_artifact(filename, stat.st_size, stat.st_mtime_ns, sha256, job_id, kind, expires_at,
+                                self.name)
+        return {'filename': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+
+    def get(self, filename):
+        """Запись артефакта (один запрос к индексу) или None, если файла нет"""
+        artifact = self.index.get_artifact(filename, self.name)
+        if artifact is None:
+            # Файл мог появиться до индекса - индексируем при первом обращении
+            try:
+                artifact = self.register(filename)
+            except OSError:
+                return None
+        return artifact
+
+    def lookup(self, filename):
+        """
+        Запись артефакта с хешем содержимого или None, если файла нет
+
+        Файл читается, только если хеш еще не известен.
+        """
+        artifact = self.get(filename)
+        if artifact is not None and artifact['sha256'] is None:
+            try:
+                artifact['sha256'] = file_sha256(os.path.join(self.folder, filename))
+            except OSError:
+                self.forget(filename)
+                return None
+            self.index.set_artifact_sha256(filename, artifact['sha256'], self.name)
+        return artifact
+
+    def forget(self, filename=None):
+        """Забывает один артефакт или все артефакты папки"""
+        self.index.delete_artifacts(None if filename is None else [filename], self.name)
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflink поддерживается только в Linux')
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _kernel_copy(copy_chunk):
+    """Копирование без передачи данных через пространство пользователя"""
+    def copy(src, dst):
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            while remaining > 0:
+                copied = copy_chunk(fsrc.fileno(), fdst.fileno(), offset, min(remaining, COPY_CHUNK_SIZE))
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+    return copy
+
+
+def _copy_file_range_chunk(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+
+def _sendfile_chunk(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _buffered_copy(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+
+
+_STRATEGY_FUNCS = {
+    'hardlink': _hardlink,
+    'reflink': _reflink,
+    'copy_file_range': _kernel_copy(_copy_file_range_chunk) if hasattr(os, 'copy_file_range') else None,
+    'sendfile': _kernel_copy(_sendfile_chunk) if hasattr(os, 'sendfile') else None,
+    'copy': _buffered_copy
+}
+
+
+def materialize(src, dst, strategies=MATERIALIZE_STRATEGIES):
+    """
+    Создает dst с содержимым src самым дешевым доступным способом
+
+    Файл появляется атомарно (через временное имя и os.replace).
+    Возвращает название использованной стратегии.
+    """
+    temp_path = dst + '.part'
+
+    for strategy in strategies:
+        func = _STRATEGY_FUNCS.get(strategy)
+        if func is None:
+            continue
+
+        try:
+            func(src, temp_path)
+        except OSError as e:
+            _remove_quietly(temp_path)
+            if e.errno in _UNSUPPORTED_ERRNOS or strategy == 'reflink':
+                logger.debug(f"Стратегия {strategy} недоступна для {dst}: {e}")
+                continue
+            raise
+        except BaseException:
+            _remove_quietly(temp_path)
+            raise
+
+        os.replace(temp_path, dst)
+        return strategy
+
+    raise OSError(errno.ENOTSUP, f'Не удалось создать артефакт {dst}: нет доступных стратегий')
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
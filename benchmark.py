@@ -0,0 +1,577 @@
+"""
+Нагрузочный бенчмарк пути загрузка -> анализ -> скачивание
+
+Синтетические изображения и видео нескольких размеров генерируются локально
+с фиксированным seed (каждый запрос получает свой файл, поэтому кеши
+результатов и этапов не подменяют анализ). Каждый запрос: POST /upload,
+опрос GET /status до завершения, GET /download результата. Запросы идут
+параллельно (--concurrency) через тестовый клиент Flask (--mode client) или
+по HTTP к настоящему серверу (--mode server: сервер запускается отдельным
+процессом, с --workers N - пре-форк сервер serve.py, либо --server-url /
+--server-cmd для своего сервера).
+
+Отчет по сценарию: пропускная способность (завершенных запросов в секунду),
+p50/p95/p99 задержек загрузки, получения результата, скачивания и всего
+пути, пиковый RSS сервиса (процесс и все его дочерние процессы), ошибки,
+отказы 429/503 и задания с пониженным качеством.
+
+Результат сравнивается с базовой линией (--baseline): если пропускная
+способность упала или p95 задержки / пиковая память выросли больше чем на
+--tolerance, процесс завершается с кодом 1. --update-baseline записывает
+текущие результаты как новую базовую линию. Базовая линия зависит от машины,
+поэтому в репозиторий не входит: ее снимают на той же машине перед проверкой
+(в CI - с базовой ветки PR на том же раннере, см. .github/workflows/build.yml).
+
+    python benchmark.py run --scenarios image_small,video_short --requests 20 --concurrency 4
+    python benchmark.py run --mode server --update-baseline
+    python benchmark.py run --mode server --workers 4
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BASE_DIR, 'benchmark_baseline.json')
+BASELINE_VERSION = 1
+
+# Синтетические файлы: размер кадра, число кадров видео, fps
+SCENARIOS = {
+    'image_small': {'file_type': 'image', 'size': (640, 480)},
+    'image_medium': {'file_type': 'image', 'size': (1920, 1080)},
+    'image_large': {'file_type': 'image', 'size': (4000, 3000)},
+    'video_short': {'file_type': 'video', 'size': (320, 240), 'frames': 30, 'fps': 15},
+    'video_medium': {'file_type': 'video', 'size': (640, 480), 'frames': 90, 'fps': 30}
+}
+DEFAULT_SCENARIOS = ('image_small', 'image_medium', 'video_short')
+
+PHASES = ('upload', 'result', 'download', 'end_to_end')
+POLL_INTERVAL = 0.05  # Период опроса /status (сек)
+MAX_RETRIES = 20  # Сколько раз повторять загрузку после 429/503
+# Сервис бенчмарка доверяет заголовку клиента с локального адреса: каждый запрос - свой клиент
+CLIENT_ID_ENV = {'CLIENT_ID_HEADER': 'X-Client-ID', 'CLIENT_ID_TRUSTED_PROXIES': '127.0.0.1,::1'}
+MEMORY_SAMPLE_INTERVAL = 0.1
+SERVER_START_TIMEOUT = 60
+
+
+# --- Синтетические файлы ---
+
+def draw_scene(rng, size, offset=0):
+    """Кадр с шумным фоном и несколькими контрастными фигурами (смещаются на offset)"""
+    width, height = size
+    noise = np.random.default_rng(rng.getrandbits(32)).normal(128, 24, (height, width, 3))
+    image = Image.fromarray(np.clip(noise, 0, 255).astype(np.uint8), 'RGB')
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(3, 6)):
+        w = rng.randint(width // 12, width // 5)
+        h = rng.randint(height // 12, height // 5)
+        x = (rng.randint(0, width - w) + offset) % max(1, width - w)
+        y = rng.randint(0, height - h)
+        color = tuple(rng.randint(0, 255) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle((x, y, x + w, y + h), fill=color)
+        else:
+            draw.ellipse((x, y, x + w, y + h), fill=color)
+    return image
+
+
+def generate_file(folder, scenario, index, seed):
+    """Файл сценария с номером index; одинаковый seed - одинаковые байты"""
+    # Импорт здесь: модуль нужен только для генерации видео
+    from video_io import MJPEGAviWriter
+
+    spec = SCENARIOS[scenario]
+    rng = random.Random(f'{seed}:{scenario}:{index}')
+    if spec['file_type'] == 'image':
+        path = os.path.join(folder, f'{scenario}_{index}.jpg')
+        draw_scene(rng, spec['size']).save(path, 'JPEG', quality=90)
+        return path
+
+    path = os.path.join(folder, f'{scenario}_{index}.avi')
+    scene_seed = rng.random()
+    writer = MJPEGAviWriter(path, spec['size'][0], spec['size'][1], spec['fps'])
+    try:
+        for frame in range(spec['frames']):
+            writer.write(draw_scene(random.Random(scene_seed), spec['size'], offset=frame * 4))
+    finally:
+        writer.close()
+    return path
+
+
+# --- Транспорт ---
+
+class FlaskClientTransport:
+    """Запросы через тестовый клиент Flask в этом же процессе"""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def upload(self, path, client_id):
+        with open(path, 'rb') as f:
+            response = self._client().post('/upload', data={'file': (f, os.path.basename(path))},
+                                           headers={'X-Client-ID': client_id})
+        return response.status_code, response.get_json(silent=True) or {}, response.headers
+
+    def get_json(self, url):
+        response = self._client().get(url_path(url))
+        return response.status_code, response.get_json(silent=True) or {}
+
+    def download(self, url):
+        response = self._client().get(url_path(url))
+        return response.status_code, len(response.data)
+
+
+class HttpTransport:
+    """Запросы по HTTP к запущенному серверу (сессия на поток)"""
+
+    def __init__(self, base_url):
+        import requests
+        self._requests = requests
+        self.base_url = base_url.rstrip('/')
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        return session
+
+    def upload(self, path, client_id):
+        with open(path, 'rb') as f:
+            response = self._session().post(self.base_url + '/upload', files={'file': (os.path.basename(path), f)},
+                                            headers={'X-Client-ID': client_id}, timeout=120)
+        return response.status_code, safe_json(response), response.headers
+
+    def get_json(self, url):
+        response = self._session().get(self.base_url + url_path(url), timeout=60)
+        return response.status_code, safe_json(response)
+
+    def download(self, url):
+        size = 0
+        with self._session().get(self.base_url + url_path(url), stream=True, timeout=120) as response:
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+            return response.status_code, size
+
+
+def url_path(url):
+    """Путь с параметрами из абсолютного URL ответа сервиса"""
+    parsed = urlparse(url)
+    return parsed.path + ('?' + parsed.query if parsed.query else '')
+
+
+def safe_json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {}
+
+
+# --- Память ---
+
+def process_tree_rss(root_pid):
+    """Суммарный RSS процесса root_pid и всех его потомков (Linux, байт) или None"""
+    children = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', encoding='ascii', errors='replace') as f:
+                # Имя процесса в скобках может содержать пробелы
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/status', encoding='ascii', errors='replace') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class MemorySampler(threading.Thread):
+    """Пиковый RSS дерева процессов root_pid за время работы"""
+
+    def __init__(self, root_pid):
+        super().__init__(name='memory_sampler', daemon=True)
+        self.root_pid = root_pid
+        self.peak = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            rss = process_tree_rss(self.root_pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            if self._stopped.wait(MEMORY_SAMPLE_INTERVAL):
+                break
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        return self.peak
+
+
+# --- Прогон ---
+
+def run_request(transport, path, client_id, timeout):
+    """Один путь загрузка -> результат -> скачивание; возвращает замеры или ошибку"""
+    record = {'rejected': 0}
+    started = time.perf_counter()
+
+    for _ in range(MAX_RETRIES):
+        upload_started = time.perf_counter()
+        status, data, headers = transport.upload(path, client_id)
+        if status not in (429, 503):
+            break
+        record['rejected'] += 1
+        time.sleep(min(5.0, float(headers.get('Retry-After') or 1)))
+    record['upload'] = time.perf_counter() - upload_started
+    if status not in (200, 202):
+        return {**record, 'error': f'upload {status}: {data.get("error")}'}
+
+    result = data
+    if status == 202:
+        deadline = time.perf_counter() + timeout
+        while True:
+            status, result = transport.get_json(data['status_url'])
+            if status != 200:
+                return {**record, 'error': f'status {status}'}
+            if result.get('status') in ('completed', 'failed', 'cancelled'):
+                break
+            if time.perf_counter() > deadline:
+                return {**record, 'error': 'timeout'}
+            time.sleep(POLL_INTERVAL)
+        if result['status'] != 'completed':
+            return {**record, 'error': f'job {result["status"]}: {result.get("error")}'}
+        result = result['result']
+    record['result'] = time.perf_counter() - started
+
+    download_started = time.perf_counter()
+    status, size = transport.download(result['processed_file_url'])
+    if status != 200:
+        return {**record, 'error': f'download {status}'}
+    finished = time.perf_counter()
+    record['download'] = finished - download_started
+    record['end_to_end'] = finished - started
+    record['bytes'] = size
+    record['degraded'] = bool(((result.get('analysis_config') or {}).get('degradation') or {}).get('applied'))
+    return record
+
+
+def percentiles(values):
+    from scheduler import percentile
+    ordered = sorted(values)
+    return {f'p{int(q * 100)}': round(percentile(ordered, q) * 1000, 2) if ordered else None
+            for q in (0.5, 0.95, 0.99)}
+
+
+def run_scenario(transport, files, concurrency, timeout, memory_pid, run_id):
+    """Прогоняет все файлы сценария с заданным параллелизмом"""
+    sampler = MemorySampler(memory_pid) if memory_pid is not None else None
+    if sampler is not None:
+        sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Каждый запрос - свой клиент: ограничение частоты на клиента не искажает замер
+        records = list(executor.map(
+            lambda item: run_request(transport, item[1], f'benchmark-{run_id}-{item[0]}', timeout),
+            enumerate(files)))
+    duration = time.perf_counter() - started
+    peak = sampler.stop() if sampler is not None else None
+
+    completed = [record for record in records if 'error' not in record]
+    errors = [record['error'] for record in records if 'error' in record]
+    return {
+        'requests': len(records),
+        'completed': len(completed),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'rejected': sum(record['rejected'] for record in records),
+        'degraded': sum(record.get('degraded', False) for record in completed),
+        'duration_seconds': round(duration, 3),
+        'throughput_rps': round(len(completed) / duration, 4) if duration else 0.0,
+        'latency_ms': {phase: percentiles([record[phase] for record in completed if phase in record])
+                       for phase in PHASES},
+        'peak_rss_bytes': peak
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Регрессии относительно базовой линии: список описаний (пусто - регрессий нет)"""
+    regressions = []
+    for key, current in results.items():
+        reference = baseline.get('scenarios', {}).get(key)
+        if reference is None:
+            continue
+        if current['errors']:
+            regressions.append(f'{key}: ошибок {current["errors"]} ({current["error_samples"]})')
+        if reference['throughput_rps'] and current['throughput_rps'] < reference['throughput_rps'] * (1 - tolerance):
+            regressions.append(f'{key}: пропускная способность {current["throughput_rps"]} < '
+                               f'{reference["throughput_rps"]} (-{tolerance:.0%})')
+        p95 = current['latency_ms']['end_to_end']['p95']
+        reference_p95 = reference['latency_ms']['end_to_end']['p95']
+        if p95 is not None and reference_p95 and p95 > reference_p95 * (1 + tolerance):
+            regressions.append(f'{key}: p95 всего пути {p95} мс > {reference_p95} мс (+{tolerance:.0%})')
+        peak, reference_peak = current.get('peak_rss_bytes'), reference.get('peak_rss_bytes')
+        if peak and reference_peak and peak > reference_peak * (1 + tolerance):
+            regressions.append(f'{key}: пиковый RSS {peak / 2 ** 20:.0f}MB > {reference_peak / 2 ** 20:.0f}MB '
+                               f'(+{tolerance:.0%})')
+    return regressions
+
+
+def machine_info():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, workdir, env):
+    """Запускает сервер в workdir; возвращает (процесс, базовый URL)"""
+    port = free_port()
+    if args.server_cmd:
+        command = shlex.split(args.server_cmd.format(port=port, python=sys.executable))
+    elif args.workers:
+        # Пре-форк сервер (serve.py) с N воркерами
+        command = [sys.executable, os.path.join(BASE_DIR, 'serve.py'), '--workers', str(args.workers),
+                   '--host', '127.0.0.1', '--port', str(port)]
+    else:
+        command = [sys.executable, os.path.abspath(__file__), 'serve', '--port', str(port)]
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+
+    import requests
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Сервер завершился при запуске (код {process.returncode}), см. server.log')
+        try:
+            if requests.get(base_url + '/health', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f'Сервер не ответил за {SERVER_START_TIMEOUT} сек')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run(args):
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        print(f'Неизвестные сценарии: {", ".join(unknown)} (доступны: {", ".join(SCENARIOS)})', file=sys.stderr)
+        return 2
+    if args.workers and (args.mode != 'server' or args.server_url or args.server_cmd):
+        print('--workers - только для --mode server без --server-url и --server-cmd', file=sys.stderr)
+        return 2
+    # Результаты пре-форк сервера сравниваются только с его же базовой линией
+    mode = f'{args.mode}-w{args.workers}' if args.workers else args.mode
+
+    workdir = tempfile.mkdtemp(prefix='benchmark_')
+    env = dict(os.environ, FLASK_ENV=args.env, **CLIENT_ID_ENV, PYTHONPATH=os.pathsep.join(
+        [BASE_DIR] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])))
+    print(f'Рабочая папка: {workdir}')
+    # Папки сервиса (uploads, processed, индекс) задаются относительно текущей папки при
+    # импорте config, поэтому переходим в рабочую папку до первого импорта модулей сервиса
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+
+    files = {}
+    for scenario in scenarios:
+        folder = os.path.join(workdir, 'input')
+        os.makedirs(folder, exist_ok=True)
+        files[scenario] = [generate_file(folder, scenario, index, args.seed) for index in range(args.requests)]
+
+    server = flask_app = None
+    try:
+        if args.mode == 'client':
+            os.environ['FLASK_ENV'] = args.env
+            os.environ.update(CLIENT_ID_ENV)
+            # Журнал сервиса и процессов анализа не смешивается с отчетом
+            os.environ.setdefault('LOG_LEVEL', 'WARNING')
+            import app as service
+            flask_app = service.create_app()
+            transport = FlaskClientTransport(flask_app)
+            memory_pid = os.getpid()
+        elif args.server_url:
+            transport, memory_pid = HttpTransport(args.server_url), args.server_pid
+        else:
+            server, base_url = start_server(args, workdir, env)
+            transport, memory_pid = HttpTransport(base_url), server.pid
+
+        # Прогрев: запуск процессов анализа и первые импорты не входят в замер
+        warmup = generate_file(os.path.join(workdir, 'input'), scenarios[0], 'warmup', args.seed)
+        run_request(transport, warmup, 'benchmark-warmup', args.timeout)
+
+        results = {}
+        for scenario in scenarios:
+            key = f'{mode}:{scenario}:c{args.concurrency}'
+            print(f'{key}: {args.requests} запросов...', flush=True)
+            results[key] = run_scenario(transport, files[scenario], args.concurrency, args.timeout, memory_pid,
+                                        f'{scenario}-{time.time_ns()}')
+            print_result(key, results[key])
+    finally:
+        if server is not None:
+            stop_server(server)
+        if flask_app is not None:
+            # Сервис пишет в рабочую папку до завершения процесса - останавливаем его до удаления папки
+            service.stop_services(flask_app)
+        os.chdir(previous_dir)
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'version': BASELINE_VERSION,
+        'created_at': datetime.now().isoformat(),
+        'machine': machine_info(),
+        'settings': {'env': args.env, 'requests': args.requests, 'concurrency': args.concurrency,
+                     'seed': args.seed, 'workers': args.workers},
+        'scenarios': results
+    }
+    if args.output:
+        write_json(args.output, report)
+
+    if args.update_baseline:
+        baseline = read_json(args.baseline) or {'version': BASELINE_VERSION, 'scenarios': {}}
+        baseline.update({key: report[key] for key in ('created_at', 'machine', 'settings')})
+        baseline['scenarios'].update(results)
+        write_json(args.baseline, baseline)
+        print(f'Базовая линия обновлена: {args.baseline}')
+        return 0
+
+    baseline = read_json(args.baseline)
+    if baseline is None:
+        print(f'Базовой линии нет ({args.baseline}) - сравнение пропущено')
+        return 0
+    if baseline.get('machine') != machine_info():
+        print('Внимание: базовая линия снята на другой машине, сравнение может быть неточным')
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'РЕГРЕССИЯ {regression}')
+    if regressions:
+        return 1
+    print('Регрессий нет')
+    return 0
+
+
+def print_result(key, result):
+    latency = result['latency_ms']
+    peak = result['peak_rss_bytes']
+    print(f'  {result["completed"]}/{result["requests"]} за {result["duration_seconds"]} сек, '
+          f'{result["throughput_rps"]} запр/сек, ошибок {result["errors"]}, отказов {result["rejected"]}, '
+          f'с пониженным качеством {result["degraded"]}')
+    for phase in PHASES:
+        values = latency[phase]
+        print(f'  {phase:>10}: p50 {values["p50"]} мс, p95 {values["p95"]} мс, p99 {values["p99"]} мс')
+    print(f'  пиковый RSS: {f"{peak / 2 ** 20:.0f}MB" if peak else "н/д"}')
+
+
+def read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path, data):
+    temp_path = path + '.part'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    os.replace(temp_path, path)
+
+
+def serve(args):
+    """Сервер для --mode server без --workers: однопроцессный многопоточный сервер Werkzeug"""
+    import app as service
+    flask_app = service.create_app(start=False)
+    service.start_services(flask_app, start_pool=True)
+    flask_app.run(host='127.0.0.1', port=args.port, threaded=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк пути загрузка -> анализ -> скачивание')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Прогнать сценарии и сравнить с базовой линией')
+    run_parser.add_argument('--mode', choices=('client', 'server'), default='client')
+    run_parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                            help=f'Через запятую: {", ".join(SCENARIOS)}')
+    run_parser.add_argument('--requests', type=int, default=20, help='Запросов на сценарий')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='Параллельных запросов')
+    run_parser.add_argument('--env', default='production', help='FLASK_ENV сервиса')
+    run_parser.add_argument('--seed', type=int, default=1, help='Seed синтетических файлов')
+    run_parser.add_argument('--timeout', type=float, default=600, help='Ожидание результата запроса (сек)')
+    run_parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    run_parser.add_argument('--tolerance', type=float, default=0.25, help='Допустимое ухудшение (доля)')
+    run_parser.add_argument('--update-baseline', action='store_true', help='Записать результаты как базовую линию')
+    run_parser.add_argument('--output', help='Куда сохранить JSON с результатами')
+    run_parser.add_argument('--server-url', help='Уже запущенный сервер (--mode server)')
+    run_parser.add_argument('--server-pid', type=int, help='PID сервера --server-url для замера памяти')
+    run_parser.add_argument('--server-cmd', help='Команда запуска сервера; {port} и {python} подставляются')
+    run_parser.add_argument('--workers', type=int, default=0,
+                            help='--mode server: пре-форк сервер serve.py с N воркерами (0 - однопроцессный)')
+    run_parser.add_argument('--keep-workdir', action='store_true', help='Не удалять рабочую папку')
+
+    serve_parser = commands.add_parser('serve', help='Запустить сервер для --mode server')
+    serve_parser.add_argument('--port', type=int, required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return serve(args)
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,558 @@
+"""
+Калибровка масштаба по эталонным объектам
+
+Эталоны (DISTANCE_ANALYSIS_CONFIG['calibration']['reference_objects']) -
+предметы известного размера: монета, кредитная карта, линейка, ручка. Размеры
+задаются строками ('2.4cm', '30cm') и разбираются в метры один раз, при
+создании ReferenceCalibrator.
+
+Шаблон эталона - контур его формы (REFERENCE_SHAPES) в виде полосы с допуском,
+окруженной полем, с нулевым средним: пиксели границ внутри полосы повышают
+оценку, а границы на поле и внутри фигуры - понижают. Поиск многомасштабный:
+шаблоны строятся для одной октавы размеров, а изображение уменьшается вдвое
+на каждом уровне пирамиды, поэтому крупные эталоны ищутся на малых уровнях.
+Спектры (rFFT) всех шаблонов для всех уровней вычисляются заранее, при старте
+процесса анализа; на изображение приходится по одному прямому FFT на уровень
+и одно пакетное обратное FFT по всем шаблонам уровня.
+
+Отклик шаблона - только гипотеза: любая окружность похожа на монету, а прямая
+граница - на сторону линейки. Лучший кандидат с оценкой не ниже
+match_threshold проверяется по карте границ (verify_candidate): контур
+должен быть виден на каждой стороне фигуры, а связные границы, касающиеся
+контура, - занимать рамку размера и пропорций эталона. Кроме того,
+кандидат должен опережать на match_margin все остальные гипотезы (другие
+эталоны и другие положения), кроме проверенных эталонов того же масштаба.
+Если проверку не прошел никто, масштаба нет и расстояния остаются в пикселях.
+
+Поддерживаются эталоны, расположенные вдоль осей изображения (0° и 90°).
+"""
+import logging
+import math
+import re
+
+import numpy as np
+from PIL import Image
+
+# Модуль, а не имена: distance_analyzer сам импортирует calibration
+import distance_analyzer
+from tracking import change_score, thumbnail
+
+logger = logging.getLogger(__name__)
+
+# Метров в единице измерения
+METERS_PER_UNIT = {
+    'meters': 1.0,
+    'centimeters': 0.01,
+    'feet': 0.3048,
+    'inches': 0.0254
+}
+
+UNIT_LABELS = {
+    'meters': 'm',
+    'centimeters': 'cm',
+    'pixels': 'px',
+    'feet': 'ft',
+    'inches': 'in'
+}
+
+# Суффиксы строк размеров эталонов
+SIZE_SUFFIXES = {
+    'mm': 0.001,
+    'cm': 0.01,
+    'm': 1.0,
+    'in': 0.0254,
+    'ft': 0.3048
+}
+SIZE_PATTERN = re.compile(r'^\s*(\d+(?:[.,]\d+)?)\s*([a-z]+)\s*$')
+
+# Форма эталона: ('ellipse' | 'rectangle', отношение длинной стороны к короткой).
+# Размер эталона в конфигурации - длинная сторона
+REFERENCE_SHAPES = {
+    'coin': ('ellipse', 1.0),
+    'credit_card': ('rectangle', 85.6 / 53.98),  # ISO/IEC 7810 ID-1
+    'ruler': ('rectangle', 10.0),  # 30×3 см
+    'pen': ('rectangle', 14.0)  # 14×1 см
+}
+
+SCALES_PER_OCTAVE = 4  # Шаг размеров шаблонов - 2^(1/4) ≈ 19%
+BAND_TOLERANCE = 0.1  # Допуск контура - 10% полуразмера (покрывает шаг масштаба)
+MIN_SHORT_SIDE = 6  # Тонкие эталоны ищутся, начиная с короткой стороны 6 пикселей
+EDGE_DILATION = 1  # Границы утолщаются на 1 пиксель в каждую сторону
+MARGIN = 0.25  # Поле вокруг фигуры - 25% полуразмера по каждой оси (не меньше 2 пикселей)
+SAME_PLACE_IOU = 0.3  # Рамки кандидатов одного эталона с таким перекрытием - одна гипотеза
+SCALE_AGREEMENT = 0.1  # Масштабы двух находок совпадают, если различаются не больше чем на 10%
+MIN_SHORT_SIDE_SLACK = 2  # Допуск короткой стороны тонкого эталона - не меньше 2 пикселей холста
+OUTLINE_RADIUS = 2  # Точка измеренного контура видна, если граница не дальше 2 пикселей холста
+
+
+def parse_size(text):
+    """Размер эталона '2.4cm', '30 cm', '1.5in' в метрах"""
+    match = SIZE_PATTERN.match(str(text).lower())
+    if not match or match.group(2) not in SIZE_SUFFIXES:
+        raise ValueError(f'Некорректный размер эталона: {text!r} '
+                         f'(ожидается число и единица: {", ".join(SIZE_SUFFIXES)})')
+    value = float(match.group(1).replace(',', '.')) * SIZE_SUFFIXES[match.group(2)]
+    if value <= 0:
+        raise ValueError(f'Размер эталона должен быть положительным: {text!r}')
+    return value
+
+
+def units_per_pixel(meters_per_pixel, units):
+    """Единиц units на пиксель при масштабе meters_per_pixel; None - перевод невозможен"""
+    if units == 'pixels':
+        return 1.0
+    if not meters_per_pixel or units not in METERS_PER_UNIT:
+        return None
+    return meters_per_pixel / METERS_PER_UNIT[units]
+
+
+def distance_label(units, factor):
+    """Функция подписи расстояния для render_overlay"""
+    suffix = UNIT_LABELS.get(units, units)
+    precision = 0 if units == 'pixels' else 2
+    return lambda item: f"{item['distance_px'] * factor:.{precision}f}{suffix}"
+
+
+def convert_distances(distances, factor):
+    """Расстояния с полем distance в единицах; factor - единиц на пиксель"""
+    return [{**item, 'distance': round(item['distance_px'] * factor, 4)} for item in distances]
+
+
+def shape_template(shape, aspect, long_side):
+    """
+    Шаблон контура с нулевым средним
+
+    Допуск полосы контура - BAND_TOLERANCE от полуразмера по каждой оси
+    (не меньше пикселя), ширина поля вокруг фигуры - MARGIN. Возвращает
+    (шаблон float32, нормировка): отклик, деленный на нормировку, равен 1
+    для точного совпадения с контуром фигуры.
+    """
+    half_w, half_h = long_side / 2, long_side / aspect / 2
+    tolerance_x = max(1.0, half_w * BAND_TOLERANCE)
+    tolerance_y = max(1.0, half_h * BAND_TOLERANCE)
+    width = 2 * math.ceil(half_w + tolerance_x + max(2.0, half_w * MARGIN)) + 1
+    height = 2 * math.ceil(half_h + tolerance_y + max(2.0, half_h * MARGIN)) + 1
+
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    x -= (width - 1) / 2
+    y -= (height - 1) / 2
+    kernel = outline_band(shape, x, y, half_w, half_h).astype(np.float32)
+    kernel -= kernel.mean()
+    # Нормировка - отклик на идеальную границу фигуры толщиной в пиксель
+    expected = float(kernel[dilate(np.abs(outline_distance(shape, x, y, half_w, half_h)) <= 0.5)].sum())
+    return kernel, expected
+
+
+def outline_distance(shape, x, y, half_w, half_h):
+    """Расстояние со знаком (внутри - отрицательное) от точек x, y до контура фигуры с центром в нуле"""
+    if shape == 'ellipse':
+        return (np.hypot(x / half_w, y / half_h) - 1) * min(half_w, half_h)
+    return np.maximum(np.abs(x) - half_w, np.abs(y) - half_h)
+
+
+def outline_band(shape, x, y, half_w, half_h):
+    """Попадают ли точки x, y в полосу контура с допуском BAND_TOLERANCE (фигура с центром в нуле)"""
+    if shape == 'ellipse':
+        return np.abs(outline_distance(shape, x, y, half_w, half_h)) <= max(1.0, min(half_w, half_h) * BAND_TOLERANCE)
+    tolerance_x = max(1.0, half_w * BAND_TOLERANCE)
+    tolerance_y = max(1.0, half_h * BAND_TOLERANCE)
+    outer = (np.abs(x) <= half_w + tolerance_x) & (np.abs(y) <= half_h + tolerance_y)
+    inner = (np.abs(x) < half_w - tolerance_x) & (np.abs(y) < half_h - tolerance_y)
+    return outer & ~inner
+
+
+def outline_segments(shape, half_w, half_h):
+    """
+    Точки контура фигуры с центром в нуле с шагом около пикселя: список (xs, ys)
+
+    Эллипс делится на четверти, прямоугольник - на стороны; каждый участок
+    должен быть виден на изображении отдельно.
+    """
+    if shape == 'ellipse':
+        count = max(4, math.ceil(math.pi * (half_w + half_h) / 4))
+        segments = []
+        for quarter in range(4):
+            angles = (quarter + (np.arange(count) + 0.5) / count) * math.pi / 2
+            segments.append((half_w * np.cos(angles), half_h * np.sin(angles)))
+        return segments
+
+    across_x = np.linspace(-half_w, half_w, max(2, math.ceil(2 * half_w) + 1))
+    across_y = np.linspace(-half_h, half_h, max(2, math.ceil(2 * half_h) + 1))
+    return [
+        (across_x, np.full_like(across_x, -half_h)),
+        (across_x, np.full_like(across_x, half_h)),
+        (np.full_like(across_y, -half_w), across_y),
+        (np.full_like(across_y, half_w), across_y)
+    ]
+
+
+def top_peaks(scores, shape):
+    """Два лучших положения шаблона размера shape, не перекрывающихся больше чем наполовину"""
+    first = np.unravel_index(int(scores.argmax()), scores.shape)
+    peaks = [(first, float(scores[first]))]
+    rest = scores.copy()
+    rest[max(0, first[0] - shape[0] // 2):first[0] + shape[0] // 2 + 1,
+         max(0, first[1] - shape[1] // 2):first[1] + shape[1] // 2 + 1] = -np.inf
+    if np.isfinite(rest).any():
+        second = np.unravel_index(int(rest.argmax()), rest.shape)
+        peaks.append((second, float(rest[second])))
+    return peaks
+
+
+def box_iou(a, b):
+    """Перекрытие рамок (x0, y0, x1, y1): площадь пересечения к площади объединения"""
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    inter = width * height
+    return inter / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter)
+
+
+def scales_agree(first, second):
+    """Совпадают ли масштабы (meters_per_pixel) двух находок с точностью SCALE_AGREEMENT"""
+    return abs(first['meters_per_pixel'] / second['meters_per_pixel'] - 1) <= SCALE_AGREEMENT
+
+
+def same_finding(first, second):
+    """Один ли эталон того же масштаба нашли две калибровки"""
+    return first['reference'] == second['reference'] and scales_agree(first, second)
+
+
+def dilate(mask, radius=EDGE_DILATION):
+    """Утолщение бинарной маски квадратом (2·radius+1)²"""
+    result = mask.copy()
+    for _ in range(radius):
+        grown = result.copy()
+        grown[1:] |= result[:-1]
+        grown[:-1] |= result[1:]
+        grown[:, 1:] |= grown[:, :-1]
+        grown[:, :-1] |= grown[:, 1:]
+        result = grown
+    return result
+
+
+def downsample(mask):
+    """Уменьшение бинарной маски вдвое с сохранением тонких границ (max-pooling)"""
+    height, width = mask.shape[0] // 2 * 2, mask.shape[1] // 2 * 2
+    mask = mask[:height, :width]
+    return mask[0::2, 0::2] | mask[1::2, 0::2] | mask[0::2, 1::2] | mask[1::2, 1::2]
+
+
+class ReferenceCalibrator:
+    """
+    Поиск эталонов и масштаба (метров на пиксель) на изображении
+
+    Шаблоны и их спектры строятся в конструкторе; экземпляр создается один
+    раз на процесс анализа (см. analysis.get_calibrator).
+    """
+
+    def __init__(self, config):
+        calibration_config = config.get('calibration', {})
+        algorithms_config = config.get('algorithms', {})
+        image_config = config.get('image_processing', {})
+
+        self.enabled = (calibration_config.get('auto_detect_reference', False)
+                        and algorithms_config.get('scale_detection') == 'template_matching')
+        self.canvas_size = int(calibration_config.get('canvas_size', 512))
+        self.min_template_px = int(calibration_config.get('min_template_px', 16))
+        self.match_threshold = float(calibration_config.get('match_threshold', 0.8))
+        self.match_margin = float(calibration_config.get('match_margin', 0.1))
+        self.min_outline_coverage = float(calibration_config.get('min_outline_coverage', 0.75))
+        self.size_tolerance = float(calibration_config.get('size_tolerance', 0.15))
+        self.aspect_tolerance = float(calibration_config.get('aspect_tolerance', 0.2))
+        self.blur_kernel_size = image_config.get('blur_kernel_size', 5)
+        self.low_threshold = image_config.get('canny_low_threshold', 50)
+        self.high_threshold = image_config.get('canny_high_threshold', 150)
+        self.params = {
+            'calibration': calibration_config,
+            'scale_detection': algorithms_config.get('scale_detection'),
+            # Свои настройки границ: ключ этапа calibration строится от resize, а не от edges
+            'edges': [self.blur_kernel_size, self.low_threshold, self.high_threshold]
+        }
+
+        sizes = calibration_config.get('reference_sizes', {})
+        self.references = {}
+        for name in calibration_config.get('reference_objects', []):
+            if name not in REFERENCE_SHAPES:
+                logger.warning(f"Эталон {name}: форма неизвестна, эталон пропущен")
+                continue
+            if name not in sizes:
+                logger.warning(f"Эталон {name}: размер не задан, эталон пропущен")
+                continue
+            self.references[name] = parse_size(sizes[name])
+
+        self.levels = []
+        if self.enabled and self.references:
+            self.levels = self._build_levels()
+            logger.info(f"Эталоны калибровки: {', '.join(self.references)}; "
+                        f"шаблонов: {sum(len(level['templates']) for level in self.levels)}")
+
+    def _build_templates(self):
+        """
+        Шаблоны одной октавы размеров: (эталон, длинная сторона, поворот, шаблон, нормировка)
+
+        Октава тонкого эталона начинается с размера, при котором его короткая
+        сторона не меньше MIN_SHORT_SIDE: иначе шаблон совпадает с любой прямой границей.
+        """
+        templates = []
+        for name in self.references:
+            shape, aspect = REFERENCE_SHAPES[name]
+            base = max(self.min_template_px, MIN_SHORT_SIDE * aspect)
+            for step in range(SCALES_PER_OCTAVE):
+                long_side = base * 2 ** (step / SCALES_PER_OCTAVE)
+                kernel, expected = shape_template(shape, aspect, long_side)
+                templates.append((name, long_side, False, kernel, expected))
+                if aspect != 1.0:
+                    templates.append((name, long_side, True, kernel.T.copy(), expected))
+        return templates
+
+    def _build_levels(self):
+        """Уровни пирамиды с заранее вычисленными спектрами шаблонов, умещающихся в уровень"""
+        templates = self._build_templates()
+
+        levels = []
+        size, factor = self.canvas_size, 1
+        while True:
+            fitting = [template for template in templates if max(template[3].shape) <= size]
+            if not fitting:
+                break
+            spectra = np.empty((len(fitting), size, size // 2 + 1), dtype=np.complex64)
+            for i, (_, _, _, kernel, _) in enumerate(fitting):
+                # Сопряженный спектр: произведение спектров дает взаимную корреляцию
+                spectra[i] = np.conj(np.fft.rfft2(kernel, s=(size, size)))
+            levels.append({
+                'size': size,
+                'factor': factor,
+                'spectra': spectra,
+                'templates': [(name, long_side, rotated, kernel.shape, expected)
+                              for name, long_side, rotated, kernel, expected in fitting]
+            })
+            size //= 2
+            factor *= 2
+        return levels
+
+    def edge_map(self, image):
+        """Бинарная карта границ изображения, вписанного в холст; возвращает (карта, масштаб)"""
+        scale = min(1.0, self.canvas_size / max(image.width, image.height))
+        if scale < 1.0:
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                                 Image.BILINEAR)
+        gray = distance_analyzer.gaussian_blur(distance_analyzer.to_grayscale(image), self.blur_kernel_size)
+        ys, xs, _, _ = distance_analyzer.canny(gray, self.low_threshold, self.high_threshold)
+        edges = np.zeros(gray.shape, dtype=bool)
+        edges[ys, xs] = True
+        return edges, scale
+
+    def find_candidates(self, image):
+        """
+        Гипотезы эталонов: по два лучших положения каждого шаблона на каждом уровне
+
+        Возвращает (кандидаты по убыванию оценки, карта границ холста). Положение
+        и размеры кандидата - в пикселях холста, рамка box - в пикселях изображения.
+        """
+        edges, scale = self.edge_map(image)
+        canvas_edges = edges
+        candidates = []
+        for level in self.levels:
+            factor = level['factor']
+            if factor > 1:
+                edges = downsample(edges)
+            height, width = edges.shape
+            canvas = np.zeros((level['size'], level['size']), dtype=np.float32)
+            canvas[:height, :width] = dilate(edges)
+
+            spectrum = np.fft.rfft2(canvas).astype(np.complex64)
+            scores = np.fft.irfft2(level['spectra'] * spectrum, s=canvas.shape)
+
+            for i, (name, long_side, rotated, shape, expected) in enumerate(level['templates']):
+                # Только положения, где шаблон целиком внутри изображения (без циклического переноса)
+                valid = scores[i, :height - shape[0] + 1, :width - shape[1] + 1]
+                if valid.size == 0:
+                    continue
+                for (y, x), score in top_peaks(valid, shape):
+                    y, x, shape_h, shape_w = y * factor, x * factor, shape[0] * factor, shape[1] * factor
+                    candidates.append({
+                        'score': score / expected,
+                        'reference': name,
+                        'long_side': long_side * factor,
+                        'rotated': rotated,
+                        'shape': (shape_h, shape_w),
+                        'position': (y, x),
+                        'pixels': 1 / scale,
+                        'box': (x / scale, y / scale, (x + shape_w) / scale, (y + shape_h) / scale)
+                    })
+        candidates.sort(key=lambda candidate: candidate['score'], reverse=True)
+        return candidates, canvas_edges
+
+    def verify_candidate(self, candidate, edges):
+        """
+        Проверяет кандидата по карте границ холста; возвращает находку или None
+
+        Связные границы, проходящие через полосу контура шаблона, должны
+        занимать рамку длиной эталона (size_tolerance) и его пропорций
+        (aspect_tolerance): так отсеиваются прямые, проходящие через шаблон,
+        и части более крупных предметов. Контур фигуры по измеренной рамке
+        должен быть виден на каждой стороне прямоугольника (в каждой четверти
+        эллипса) не меньше чем на min_outline_coverage. Масштаб находки
+        считается по измеренной рамке, а не по размеру шаблона.
+        """
+        if 'result' in candidate:
+            return candidate['result']
+        candidate['result'] = None
+
+        name = candidate['reference']
+        shape_name, aspect = REFERENCE_SHAPES[name]
+        half_w = candidate['long_side'] / 2
+        half_h = half_w / aspect
+        if candidate['rotated']:
+            half_w, half_h = half_h, half_w
+        (y, x), (kernel_h, kernel_w) = candidate['position'], candidate['shape']
+
+        # Окрестность - окно шаблона и еще по половине окна с каждой стороны
+        top, left = max(0, y - kernel_h // 2), max(0, x - kernel_w // 2)
+        region = dilate(edges[top:y + kernel_h + kernel_h // 2, left:x + kernel_w + kernel_w // 2])
+        flat = np.flatnonzero(region)
+        if len(flat) == 0:
+            return None
+        labels, _ = distance_analyzer.label_components(flat, region.shape[1])
+        ys, xs = np.divmod(flat, region.shape[1])
+        on_outline = outline_band(shape_name, xs - (x + (kernel_w - 1) / 2 - left),
+                                  ys - (y + (kernel_h - 1) / 2 - top), half_w, half_h)
+        members = np.isin(labels, np.unique(labels[on_outline]))
+        if not on_outline.any():
+            return None
+        # Дилатация расширила рамку на EDGE_DILATION с каждой стороны
+        x0, x1 = xs[members].min() + EDGE_DILATION, xs[members].max() - EDGE_DILATION
+        y0, y1 = ys[members].min() + EDGE_DILATION, ys[members].max() - EDGE_DILATION
+        width, height = x1 - x0 + 1, y1 - y0 + 1
+
+        measured_long, measured_short = max(width, height), min(width, height)
+        if abs(measured_long / (2 * max(half_w, half_h)) - 1) > self.size_tolerance:
+            return None
+        expected_short = measured_long / aspect
+        if abs(measured_short - expected_short) > max(MIN_SHORT_SIDE_SLACK, expected_short * self.aspect_tolerance):
+            return None
+        if aspect != 1.0 and (height > width) != candidate['rotated']:
+            return None
+
+        near = dilate(region, OUTLINE_RADIUS)
+        for segment_xs, segment_ys in outline_segments(shape_name, (width - 1) / 2, (height - 1) / 2):
+            rows = np.clip(np.round((y0 + y1) / 2 + segment_ys).astype(np.int64), 0, region.shape[0] - 1)
+            cols = np.clip(np.round((x0 + x1) / 2 + segment_xs).astype(np.int64), 0, region.shape[1] - 1)
+            if near[rows, cols].mean() < self.min_outline_coverage:
+                return None
+
+        pixels = candidate['pixels']
+        size_px = measured_long * pixels
+        candidate['result'] = {
+            'reference': name,
+            'reference_size_m': self.references[name],
+            'meters_per_pixel': self.references[name] / size_px,
+            'score': round(candidate['score'], 3),
+            'size_px': round(float(size_px), 2),
+            'orientation': 'vertical' if candidate['rotated'] else 'horizontal',
+            'bbox': [round((left + x0) * pixels), round((top + y0) * pixels),
+                     round(width * pixels), round(height * pixels)]
+        }
+        return candidate['result']
+
+    def calibrate(self, image):
+        """
+        Находит эталон на изображении PIL
+
+        Возвращает словарь {reference, meters_per_pixel, score, margin, size_px,
+        bbox} в пикселях изображения или None, если эталон не найден или
+        находка неоднозначна.
+        """
+        if not self.levels:
+            return None
+
+        candidates, edges = self.find_candidates(image)
+        best = result = None
+        for candidate in candidates:
+            if candidate['score'] < self.match_threshold:
+                break
+            result = self.verify_candidate(candidate, edges)
+            if result is not None:
+                best = candidate
+                break
+        if best is None:
+            return None
+
+        # Запас над остальными гипотезами: близкие по оценке другие эталоны и другие
+        # положения допустимы, только если это проверенные эталоны того же масштаба
+        runner_up = 0.0
+        for candidate in candidates:
+            if candidate is best or (candidate['reference'] == best['reference']
+                                     and box_iou(candidate['box'], best['box']) >= SAME_PLACE_IOU):
+                continue
+            if candidate['score'] <= best['score'] - self.match_margin:
+                runner_up = max(runner_up, candidate['score'])
+                break
+            other = self.verify_candidate(candidate, edges)
+            if other is None or not scales_agree(other, result):
+                logger.info(f"Эталон {best['reference']} неоднозначен: {candidate['reference']} "
+                            f"с оценкой {candidate['score']:.3f} против {best['score']:.3f}")
+                return None
+
+        result['margin'] = round(best['score'] - runner_up, 3)
+        return result
+
+
+class SceneCalibration:
+    """
+    Масштаб для кадров видео
+
+    Калибровка выполняется на первом кадре и после смены сцены (change_score
+    с кадром калибровки больше порога), а внутри сцены повторяется раз в
+    retry_interval кадров: пока эталон не найден - как новая попытка, после -
+    как перепроверка. Перепроверка, нашедшая другой эталон или другой масштаб,
+    сбрасывает масштаб (кадры - в пикселях), и до смены сцены он принимается
+    снова, только когда две попытки подряд найдут одно и то же. Промах
+    перепроверки (эталон закрыт или вышел из кадра) масштаб не сбрасывает.
+    """
+
+    def __init__(self, calibrator, threshold, retry_interval):
+        self.calibrator = calibrator
+        self.threshold = threshold
+        self.retry_interval = max(1, retry_interval)
+        self.result = None
+        self.calibrations = 0
+        self.rejections = 0
+        self._reference = None
+        self._since_attempt = 0
+        self._candidate = None
+        self._disputed = False
+
+    def process(self, image):
+        """Масштаб для очередного кадра (словарь calibrate() или None)"""
+        current = thumbnail(image)
+        self._since_attempt += 1
+        scene_changed = True
+        if self._reference is not None:
+            scene_changed = change_score(self._reference, current) > self.threshold
+            if not scene_changed and self._since_attempt < self.retry_interval:
+                return self.result
+
+        found = self.calibrator.calibrate(image)
+        self.calibrations += 1
+        self._reference = current
+        self._since_attempt = 0
+
+        if scene_changed:
+            self.result, self._candidate, self._disputed = found, None, False
+        elif self.result is not None:
+            if found is not None and not same_finding(found, self.result):
+                logger.info(f"Перепроверка масштаба: {found['reference']} {found['meters_per_pixel']:.6g} м/пкс "
+                            f"вместо {self.result['reference']} {self.result['meters_per_pixel']:.6g} - "
+                            f"масштаб сброшен")
+                self.rejections += 1
+                self.result, self._candidate, self._disputed = None, found, True
+        elif not self._disputed:
+            self.result = found
+        elif found is not None and self._candidate is not None and same_finding(found, self._candidate):
+            self.result, self._candidate, self._disputed = found, None, False
+        else:
+            self._candidate = found
+        return self.result
@@ -27,9 +27,108 @@ class Config:
     DEFAULT_UNITS = 'meters'
     SUPPORTED_UNITS = ['meters', 'centimeters', 'pixels', 'feet', 'inches']
 
+    # Очередь заданий анализа
+    ANALYSIS_WORKERS = 2  # Количество процессов анализа (и одновременных заданий)
+    ANALYSIS_START_METHOD = 'spawn'  # Способ запуска процессов: spawn, forkserver, fork
+    ANALYSIS_QUEUE_SIZE = 32  # Максимум заданий в очереди и в работе
+    JOB_HISTORY_SIZE = 1000  # Сколько заданий держать в памяти процесса (остальные - в индексе)
+    # Индекс заданий и артефактов (SQLite, WAL) - общий для всех процессов с этим каталогом данных
+    JOB_INDEX_PATH = os.path.join(os.getcwd(), 'jobs.sqlite3')
+    # Планировщик: ожидание в очереди уменьшает оценку стоимости задания на
+    # SCHEDULER_AGING_FACTOR секунд за секунду, чтобы длинные видео не ждали бесконечно
+    SCHEDULER_AGING_FACTOR = 1.0
+    # Клиент для справедливой очереди и лимитов - IP-адрес соединения. Заголовок CLIENT_ID_HEADER
+    # (например X-Client-ID) учитывается только в запросах от CLIENT_ID_TRUSTED_PROXIES (адреса
+    # или сети шлюзов, выставляющих заголовок) и в запросах с токеном администратора
+    CLIENT_ID_HEADER = os.environ.get('CLIENT_ID_HEADER') or None
+    CLIENT_ID_TRUSTED_PROXIES = tuple(
+        address.strip() for address in os.environ.get('CLIENT_ID_TRUSTED_PROXIES', '').split(',') if address.strip())
+
+    # Контроль допуска загрузок (до чтения тела запроса)
+    # Частота - по API_CONFIG['rate_limiting'] на клиента; кроме того, загрузка отклоняется,
+    # если оценка ожидания в очереди превышает ADMISSION_MAX_WAIT_SECONDS
+    ADMISSION_MAX_WAIT_SECONDS = 15 * 60
+    RATE_LIMIT_MAX_CLIENTS = 10000  # Сколько клиентов отслеживать для ограничения частоты
+
+    # Адаптивное снижение качества под нагрузкой (см. adaptive_quality.py): уровень включается,
+    # если заполненность очереди (доля ANALYSIS_QUEUE_SIZE) или p95 задержки заданий за последние
+    # 5 минут достигли порога; действует самый строгий из включенных уровней
+    ADAPTIVE_QUALITY = {
+        'enabled': True,
+        'levels': [
+            {'queue_fill': 0.5, 'latency_p95_seconds': 120, 'max_resolution': (1280, 720), 'frame_skip': 2},
+            {'queue_fill': 0.75, 'latency_p95_seconds': 300, 'max_resolution': (960, 540), 'frame_skip': 3,
+             'overlay': False}
+        ]
+    }
+
+    # Поток событий заданий (/jobs/<job_id>/events)
+    SSE_HEARTBEAT_INTERVAL = 15  # Комментарий keepalive при отсутствии событий (сек)
+    SSE_RETRY_MS = 2000  # Задержка переподключения EventSource (мс)
+
+    # Пакетная загрузка (/upload/batch)
+    BATCH_MAX_FILES = 500  # Максимум файлов в одном пакете
+    BATCH_MAX_CONTENT_LENGTH = 4 * 1024 * 1024 * 1024  # 4GB на весь multipart-пакет
+    BATCH_URL_SCHEMES = ('http', 'https')  # Допустимые схемы ссылок в JSON-манифесте
+    # Хосты, с которых сервис скачивает файлы манифеста ('*.example.com' - любой поддомен);
+    # пусто - ссылки в манифесте отклоняются. Непубличные адреса запрещены всегда
+    BATCH_URL_HOSTS = tuple(
+        host.strip() for host in os.environ.get('BATCH_URL_HOSTS', '').split(',') if host.strip())
+    BATCH_URL_MAX_REDIRECTS = 3  # Перенаправлений при скачивании (каждое проверяется заново)
+    BATCH_DOWNLOAD_WORKERS = 4  # Параллельных скачиваний файлов манифеста
+    BATCH_DOWNLOAD_TIMEOUT = 60  # Таймаут соединения и чтения при скачивании (сек)
+
+    # Скачивание результатов
+    DOWNLOAD_CACHE_MAX_AGE = 365 * 24 * 3600  # Результаты неизменяемы - кешируем на год
+    # Отдача файла фронт-прокси: None, 'x-accel-redirect' (nginx) или 'x-sendfile' (Apache/lighttpd)
+    DOWNLOAD_OFFLOAD = os.environ.get('DOWNLOAD_OFFLOAD') or None
+    DOWNLOAD_OFFLOAD_PREFIX = '/protected/processed/'  # internal location nginx для X-Accel-Redirect
+
+    # Способы создания артефактов-копий в порядке попыток (см. artifacts.materialize)
+    ARTIFACT_MATERIALIZE_STRATEGIES = ('hardlink', 'reflink', 'copy_file_range', 'sendfile', 'copy')
+
+    # Кеш результатов по содержимому файла (0 - отключить)
+    RESULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1GB артефактов в записях кеша (файлы хранятся по сроку)
+
+    # Кеш промежуточных результатов этапов анализа в каждом процессе пула (0 - отключить)
+    STAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+    # Кеш исходных изображений для перерисовки измерений в другом стиле или единицах
+    RENDER_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+    # Токен администратора: /admin/* (заголовок Authorization: Bearer) и профилирование
+    # загрузки по заголовку PROFILING['header']; без токена административный доступ выключен
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or None
+
+    # Профилирование загрузок и анализа (см. profiling.py): по заголовку с ADMIN_TOKEN,
+    # для доли sample_rate загрузок и для анализа дольше slow_job_seconds (None - выключено)
+    PROFILING = {
+        'header': 'X-Profile',
+        'sample_rate': 0.0,
+        'slow_job_seconds': None,
+        'sample_interval': 0.01  # Период семплирования стека медленного задания (сек)
+    }
+
+    # Метрики Prometheus (/metrics): процессы сервиса складывают снимки метрик в общую папку
+    METRICS_FOLDER = os.path.join(os.getcwd(), 'metrics')
+    METRICS_FLUSH_INTERVAL = 5  # Как часто процесс записывает снимок своих метрик (сек)
+
+    # Пре-форк сервер (serve.py): мастер один раз загружает приложение и модули анализа,
+    # воркеры порождаются fork; ANALYSIS_WORKERS и ANALYSIS_QUEUE_SIZE - на каждый воркер
+    SERVE_HOST = os.environ.get('SERVE_HOST', '127.0.0.1')
+    SERVE_PORT = int(os.environ.get('SERVE_PORT', 5000))
+    SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', 2))
+    SERVE_BACKLOG = 128  # Очередь соединений слушающего сокета
+    # Процессы анализа воркера порождаются fork и получают загруженные в мастере шаблоны калибровки
+    SERVE_ANALYSIS_START_METHOD = 'fork'
+    SERVE_SHUTDOWN_TIMEOUT = 30  # Ожидание остановки воркеров до SIGKILL (сек)
+
     # Настройки очистки временных файлов
     CLEANUP_INTERVAL = timedelta(hours=24)  # Очистка каждые 24 часа
     FILE_RETENTION_DAYS = 7  # Хранить файлы 7 дней
+    CLEANUP_BATCH_SIZE = 200  # Файлов в одной пачке удаления
+    CLEANUP_BATCH_SECONDS = 0.25  # Предельная длительность пачки (сек)
+    CLEANUP_BATCH_PAUSE = 0.05  # Пауза между пачками (сек)
 
     # CORS настройки
     CORS_ORIGINS = ['http://localhost:3000', 'http://127.0.0.1:3000']
@@ -59,6 +158,8 @@ class ProductionConfig(Config):
     # Продакшн настройки
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB в продакшне
     ANALYSIS_TIMEOUT = 600  # 10 минут для сложных анализов
+    ANALYSIS_WORKERS = 4
+    ANALYSIS_QUEUE_SIZE = 128
 
     # Безопасность
     SESSION_COOKIE_SECURE = True
@@ -73,10 +174,16 @@ class TestingConfig(Config):
     # Тестовые папки
     UPLOAD_FOLDER = os.path.join(os.getcwd(), 'test_uploads')
     PROCESSED_FOLDER = os.path.join(os.getcwd(), 'test_processed')
+    JOB_INDEX_PATH = os.path.join(os.getcwd(), 'test_jobs.sqlite3')
+    METRICS_FOLDER = os.path.join(os.getcwd(), 'test_metrics')
 
     # Быстрые настройки для тестов
     ANALYSIS_TIMEOUT = 5  # 5 секунд для тестов
     MAX_CONTENT_LENGTH = 1 * 1024 * 1024  # 1MB для тестовых файлов
+    ANALYSIS_WORKERS = 1
+    ANALYSIS_QUEUE_SIZE = 8
+    RESULT_CACHE_MAX_BYTES = 10 * 1024 * 1024
+    STAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
 
 # Словарь конфигураций
 config = {
@@ -102,7 +209,14 @@ DISTANCE_ANALYSIS_CONFIG = {
             'ruler': '30cm',  # Стандартная линейка
             'credit_card': '8.5cm',  # Стандартная кредитная карта
             'pen': '14cm'  # Стандартная ручка
-        }
+        },
+        'match_threshold': 0.8,  # Минимальная оценка совпадения с шаблоном эталона (1 - точное)
+        'match_margin': 0.1,  # Насколько эталон должен опережать другие эталоны и положения
+        'min_outline_coverage': 0.75,  # Доля каждой стороны (четверти) контура, видимая на границах
+        'size_tolerance': 0.15,  # Допуск длины найденного контура относительно шаблона
+        'aspect_tolerance': 0.2,  # Допуск короткой стороны относительно пропорций эталона
+        'canvas_size': 512,  # Поиск эталонов - на изображении, вписанном в квадрат этого размера
+        'min_template_px': 16  # Наименьший размер эталона на этом квадрате (в пикселях)
     },
 
     # Алгоритмы анализа
@@ -110,22 +224,35 @@ DISTANCE_ANALYSIS_CONFIG = {
         'edge_detection': 'canny',
         'object_detection': 'contours',
         'distance_calculation': 'euclidean',
+        'distance_query': 'nearest',  # 'nearest', 'knn' или 'radius'
+        'distance_index': 'auto',  # 'grid', 'full' (матрица N×N) или 'auto'
+        'full_matrix_max_objects': 64,  # В режиме 'auto' до этого числа объектов - полная матрица
+        'distance_k': 3,  # Число соседей для 'knn'
+        'distance_radius_px': 200,  # Радиус для 'radius' (в пикселях)
         'scale_detection': 'template_matching'
     },
 
     # Настройки обработки изображений
     'image_processing': {
-        'max_resolution': (1920, 1080),  # Максимальное разрешение для обработки
+        'max_resolution': (1920, 1080),  # Максимальное разрешение для обработки (без tiled_processing)
         'blur_kernel_size': 5,
         'canny_low_threshold': 50,
         'canny_high_threshold': 150,
-        'contour_min_area': 100
+        'contour_min_area': 100,
+        'tiled_processing': True,  # Изображения больше max_resolution - без уменьшения, по тайлам
+        'tile_size': 1024,  # Сторона тайла в пикселях
+        'tile_workers': None,  # Потоков для тайлов (None - по числу ядер)
+        'tiled_max_megapixels': 64  # Предельный размер изображения для обработки по тайлам
     },
 
     # Настройки обработки видео
     'video_processing': {
         'fps_limit': 30,  # Максимальный FPS для обработки
         'frame_skip': 1,  # Обрабатывать каждый N-й кадр
+        'tracking': True,  # Детекция только на ключевых кадрах, между ними - слежение за объектами
+        'keyframe_interval': 15,  # Полная детекция не реже чем раз в N обработанных кадров
+        'scene_change_threshold': 6.0,  # Средняя разница яркости с ключевым кадром (0-255) для новой детекции
+        'tracking_search_radius': 32,  # Максимальное смещение объекта между кадрами (в пикселях)
         'output_format': 'mp4',
         'codec': 'h264'
     },
@@ -0,0 +1,593 @@
+"""
+Анализ расстояний на изображениях
+
+Конвейер: размытие по Гауссу (blur_kernel_size) -> детектор границ Canny
+(canny_low_threshold / canny_high_threshold) -> выделение контуров как связных
+компонент границ с фильтром по contour_min_area -> евклидовы расстояния между
+объектами (через пространственный индекс, см. spatial.py) -> наложение
+измерений на изображение.
+
+Все шаги выполняются векторными операциями NumPy над целыми массивами,
+без попиксельных циклов Python. Декодирование, масштабирование и отрисовка
+выполняются Pillow.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+import calibration
+import spatial
+import tiling
+from artifacts import file_sha256
+from profiling import record_stage, stage_clock
+from stage_cache import StageRunner
+from config import DISTANCE_ANALYSIS_CONFIG
+
+logger = logging.getLogger(__name__)
+
+TAN_22_5 = np.float32(0.41421356)
+TAN_67_5 = np.float32(2.41421356)
+
+EXIF_ORIENTATION = 0x0112  # Тег ориентации: значения 5-8 - поворот на 90°
+
+# Соседи для связности по 8 направлениям (каждая пара учитывается один раз)
+NEIGHBOR_OFFSETS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+def load_image(file_path, max_resolution=None):
+    """Загружает изображение в RGB, уменьшая его до max_resolution (ширина, высота)"""
+    with Image.open(file_path) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    return fit_resolution(image, max_resolution)
+
+
+def image_size(file_path):
+    """Размер изображения (ширина, высота) с учетом поворота EXIF - по заголовку, без декодирования"""
+    with Image.open(file_path) as image:
+        width, height = image.size
+        if image.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def fit_resolution(image, max_resolution=None):
+    """Уменьшает изображение до max_resolution (ширина, высота), возвращает (image, scale)"""
+    scale = 1.0
+    if max_resolution:
+        max_w, max_h = max_resolution
+        scale = min(1.0, max_w / image.width, max_h / image.height)
+        if scale < 1.0:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.BILINEAR)
+
+    return image, scale
+
+
+def to_grayscale(image):
+    """Яркость изображения как массив uint8"""
+    return np.asarray(image.convert('L'))
+
+
+# Целочисленные ядра малых размеров - те же, что использует cv2.GaussianBlur при sigma=0
+SMALL_GAUSSIAN_KERNELS = {
+    3: (np.array([1, 2, 1], dtype=np.uint16), 4),
+    5: (np.array([1, 4, 6, 4, 1], dtype=np.uint16), 16)
+}
+
+
+def gaussian_kernel(size):
+    """Одномерное ядро Гаусса; sigma вычисляется по размеру, как в OpenCV"""
+    sigma = 0.3 * ((size - 1) * 0.5 - 1) + 0.8
+    x = np.arange(size, dtype=np.float32) - (size - 1) / 2
+    kernel = np.exp(-(x * x) / (2 * sigma * sigma))
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def _symmetric_convolve(padded, kernel, length, axis):
+    """Свертка с симметричным ядром: парные отсчеты складываются до умножения"""
+    radius = len(kernel) // 2
+
+    def taps(i):
+        return padded[:, i:i + length] if axis == 1 else padded[i:i + length]
+
+    result = taps(radius) * kernel[radius]
+    pair = np.empty_like(result)
+    for i in range(radius):
+        np.add(taps(i), taps(len(kernel) - 1 - i), out=pair)
+        pair *= kernel[i]
+        result += pair
+    return result
+
+
+def gaussian_blur(gray, kernel_size):
+    """
+    Разделимое размытие изображения uint8: свертка по строкам, затем по столбцам
+
+    Для ядер 3 и 5 счет ведется в целых uint16 (точно как в OpenCV),
+    для остальных - во float32. Результат округляется до uint8.
+    """
+    if kernel_size is None or kernel_size <= 1:
+        return gray
+
+    kernel_size |= 1  # ядро должно быть нечетным
+    radius = kernel_size // 2
+    h, w = gray.shape
+
+    if kernel_size in SMALL_GAUSSIAN_KERNELS:
+        kernel, norm = SMALL_GAUSSIAN_KERNELS[kernel_size]
+        source = gray.astype(np.uint16)
+    else:
+        kernel, norm = gaussian_kernel(kernel_size), 1
+        source = gray.astype(np.float32)
+
+    rows = _symmetric_convolve(np.pad(source, ((0, 0), (radius, radius)), mode='reflect'), kernel, w, axis=1)
+    blurred = _symmetric_convolve(np.pad(rows, ((radius, radius), (0, 0)), mode='reflect'), kernel, h, axis=0)
+
+    if norm == 1:
+        return np.clip(np.rint(blurred), 0, 255).astype(np.uint8)
+    # Деление с округлением: (x + norm^2 / 2) // norm^2
+    blurred += norm * norm // 2
+    blurred //= norm * norm
+    return blurred.astype(np.uint8)
+
+
+def sobel(gray):
+    """Градиенты Собеля 3x3 по x и y (int16)"""
+    p = np.pad(gray, 1, mode='reflect').astype(np.int16)
+    # Сглаживание [1, 2, 1] поперек направления производной
+    vertical = p[:-2] + p[2:]
+    vertical += p[1:-1]
+    vertical += p[1:-1]
+    horizontal = p[:, :-2] + p[:, 2:]
+    horizontal += p[:, 1:-1]
+    horizontal += p[:, 1:-1]
+    gx = np.subtract(vertical[:, 2:], vertical[:, :-2])
+    gy = np.subtract(horizontal[2:], horizontal[:-2])
+    return gx, gy
+
+
+def non_maximum_suppression(gx, gy, low_threshold):
+    """
+    Оставляет только локальные максимумы модуля градиента вдоль его направления
+
+    Проверяются только пиксели с модулем выше low_threshold - остальные
+    все равно отбрасываются порогом. Возвращает плоские индексы оставшихся
+    пикселей и модуль градиента в них.
+    """
+    h, w = gx.shape
+    magnitude = np.abs(gx)
+    magnitude += np.abs(gy)  # L1-норма, как в cv2.Canny по умолчанию
+
+    candidates = np.flatnonzero(magnitude > low_threshold)
+    if len(candidates) == 0:
+        return candidates, np.empty(0, dtype=magnitude.dtype)
+
+    # Соседи берутся из дополненного нулями массива по плоским индексам
+    padded = np.pad(magnitude, 1).ravel()
+    stride = w + 2
+    ys, xs = np.divmod(candidates, w)
+    center_index = (ys + 1) * stride + xs + 1
+    center = padded[center_index]
+
+    cx = gx.ravel()[candidates].astype(np.float32)
+    cy = gy.ravel()[candidates].astype(np.float32)
+    ax, ay = np.abs(cx), np.abs(cy)
+
+    horizontal = ay <= ax * TAN_22_5
+    vertical = ay > ax * TAN_67_5
+    same_sign = (cx * cy) > 0
+
+    # Смещение к соседу вдоль направления градиента
+    offset = np.where(same_sign, stride + 1, stride - 1)
+    offset[vertical] = stride
+    offset[horizontal] = 1
+
+    keep = (center > padded[center_index - offset]) & (center >= padded[center_index + offset])
+    return candidates[keep], center[keep]
+
+
+def neighbor_pairs(flat, width):
+    """
+    Пары соседних (8-связность) пикселей из отсортированного набора плоских индексов
+
+    Возвращает номера элементов flat, образующих пары.
+    """
+    xs = flat % width
+    firsts, seconds = [], []
+    for dy, dx in NEIGHBOR_OFFSETS:
+        # Не переходим через край строки
+        valid = (xs < width - 1) if dx > 0 else (xs > 0) if dx < 0 else np.ones(len(flat), dtype=bool)
+        source = np.flatnonzero(valid)
+        target = flat[source] + dy * width + dx
+        position = np.searchsorted(flat, target)
+        position[position == len(flat)] = 0
+        found = flat[position] == target
+        firsts.append(source[found])
+        seconds.append(position[found])
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def _compress(parent):
+    """Сжатие путей: каждый элемент указывает прямо на корень"""
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+
+def union_find(count, first, second):
+    """
+    Векторный union-find: возвращает корень компоненты для каждого элемента
+
+    На каждой итерации корни соединенных пар подвешиваются к меньшему корню,
+    после чего пути сжимаются; число итераций растет логарифмически.
+    """
+    parent = np.arange(count, dtype=np.int64)
+    while len(first):
+        root_a = parent[first]
+        root_b = parent[second]
+        differ = root_a != root_b
+        if not differ.any():
+            break
+        root_a, root_b = root_a[differ], root_b[differ]
+        first, second = first[differ], second[differ]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        parent = _compress(parent)
+    return parent
+
+
+def label_components(flat, width):
+    """
+    Связные компоненты (8-связность) пикселей, заданных отсортированными плоскими индексами
+
+    Возвращает (labels, count): номер компоненты каждого пикселя (0..count-1).
+    """
+    if len(flat) == 0:
+        return np.empty(0, dtype=np.int64), 0
+
+    first, second = neighbor_pairs(flat, width)
+    roots = union_find(len(flat), first, second)
+    _, labels = np.unique(roots, return_inverse=True)
+    return labels, int(labels.max()) + 1
+
+
+def canny(gray, low_threshold, high_threshold):
+    """
+    Детектор границ Canny
+
+    Возвращает (ys, xs, labels, count): пиксели границ после гистерезиса,
+    сгруппированные в связные контуры.
+    """
+    h, w = gray.shape
+    gx, gy = sobel(gray)
+    flat, magnitude = non_maximum_suppression(gx, gy, low_threshold)
+
+    labels, count = label_components(flat, w)
+    if count == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, 0
+
+    # Гистерезис: сохраняем компоненты, содержащие хотя бы один сильный пиксель
+    strong = magnitude > high_threshold
+    has_strong = np.bincount(labels, weights=strong, minlength=count) > 0
+    keep = has_strong[labels]
+
+    ys, xs = np.divmod(flat[keep], w)
+    _, labels = np.unique(labels[keep], return_inverse=True)
+    return ys, xs, labels, int(has_strong.sum())
+
+
+def extract_objects(ys, xs, labels, count, min_area):
+    """
+    Описание контуров: рамка, центр и площадь
+
+    Площадь контура оценивается площадью ограничивающего прямоугольника;
+    контуры меньше min_area отбрасываются.
+    """
+    if count == 0:
+        return []
+
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+
+    x_sorted, y_sorted = xs[order], ys[order]
+    x_min = np.minimum.reduceat(x_sorted, starts)
+    x_max = np.maximum.reduceat(x_sorted, starts)
+    y_min = np.minimum.reduceat(y_sorted, starts)
+    y_max = np.maximum.reduceat(y_sorted, starts)
+    pixels = np.diff(np.r_[starts, len(order)])
+
+    width = x_max - x_min + 1
+    height = y_max - y_min + 1
+    area = width * height
+    center_x = np.add.reduceat(x_sorted, starts) / pixels
+    center_y = np.add.reduceat(y_sorted, starts) / pixels
+
+    selected = np.flatnonzero(area >= min_area)
+    # Крупные объекты первыми
+    selected = selected[np.argsort(-area[selected], kind='stable')]
+
+    return [
+        {
+            'id': object_id,
+            'bbox': [int(x_min[i]), int(y_min[i]), int(width[i]), int(height[i])],
+            'center': [round(float(center_x[i]), 2), round(float(center_y[i]), 2)],
+            'area': int(area[i]),
+            'contour_pixels': int(pixels[i])
+        }
+        for object_id, i in enumerate(selected)
+    ]
+
+
+def measure_distances(objects, algorithms_config):
+    """
+    Евклидовы расстояния между центрами объектов
+
+    algorithms_config['distance_query']: 'nearest' - ближайший сосед каждого
+    объекта, 'knn' - distance_k ближайших, 'radius' - все пары не дальше
+    distance_radius_px. Поиск выполняется по пространственному индексу
+    (spatial.py); distance_index='full' или малое число объектов (до
+    full_matrix_max_objects) - полная матрица N×N.
+    """
+    if len(objects) < 2:
+        return []
+
+    query = algorithms_config.get('distance_query', 'nearest')
+    mode = algorithms_config.get('distance_index', 'auto')
+    full_matrix_max = algorithms_config.get('full_matrix_max_objects', spatial.FULL_MATRIX_MAX_POINTS)
+    centers = np.array([obj['center'] for obj in objects], dtype=np.float64)
+
+    if query == 'radius':
+        first, second, distances = spatial.within_radius(
+            centers, algorithms_config.get('distance_radius_px', 200), mode, full_matrix_max)
+    elif query in ('nearest', 'knn'):
+        k = 1 if query == 'nearest' else max(1, int(algorithms_config.get('distance_k', 3)))
+        neighbors, neighbor_distances = spatial.k_nearest(centers, k, mode, full_matrix_max)
+        found = neighbors >= 0
+        first = np.broadcast_to(np.arange(len(centers))[:, None], neighbors.shape)[found]
+        first, second, distances = spatial.unique_pairs(first, neighbors[found], neighbor_distances[found])
+    else:
+        raise ValueError(f'Неизвестный тип запроса расстояний: {query}')
+
+    return [
+        {'from': int(a), 'to': int(b), 'distance_px': round(float(d), 2)}
+        for a, b, d in zip(first, second, distances)
+    ]
+
+
+def render_overlay(image, objects, distances, output_config, label_func):
+    """Рисует рамки объектов и линии измерений поверх изображения"""
+    overlay = image.copy()
+    draw = ImageDraw.Draw(overlay)
+    color = tuple(output_config.get('measurement_color', (0, 255, 0)))
+    thickness = max(1, int(output_config.get('line_thickness', 2)))
+    font_size = max(8, round(20 * output_config.get('font_scale', 0.7)))
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except TypeError:
+        font = ImageFont.load_default()
+
+    for obj in objects:
+        x, y, w, h = obj['bbox']
+        draw.rectangle([x, y, x + w - 1, y + h - 1], outline=color, width=thickness)
+
+    centers = {obj['id']: tuple(obj['center']) for obj in objects}
+    for item in distances:
+        start, end = centers[item['from']], centers[item['to']]
+        draw.line([start, end], fill=color, width=thickness)
+        middle = ((start[0] + end[0]) / 2, (start[1] + end[1]) / 2)
+        draw.text(middle, label_func(item), fill=color, font=font)
+
+    return overlay
+
+
+def save_image(image, fp, extension=None):
+    """
+    Сохраняет изображение в формате, определяемом расширением
+
+    fp - путь или файловый объект; для файлового объекта расширение
+    передается в extension.
+    """
+    extension = (extension or os.path.splitext(fp)[1]).lower()
+    image_format = Image.registered_extensions().get(extension)
+    if extension in ('.jpg', '.jpeg'):
+        image.save(fp, image_format, quality=90)
+    elif extension == '.png':
+        # Максимальное сжатие PNG в разы дороже самого анализа
+        image.save(fp, image_format, compress_level=1)
+    else:
+        image.save(fp, image_format)
+
+
+class DistanceAnalyzer:
+    """
+    Анализатор расстояний между объектами на изображении
+
+    Анализ разбит на этапы stage_cache.STAGES; с stage_cache результаты этапов
+    запоминаются, и повторный анализ того же файла с другими параметрами
+    пересчитывает только этапы, зависящие от измененных параметров.
+    calibrator - calibration.ReferenceCalibrator для перевода пикселей в единицы.
+    """
+
+    def __init__(self, config=None, stage_cache=None, calibrator=None):
+        self.config = config or DISTANCE_ANALYSIS_CONFIG
+        self.image_config = self.config.get('image_processing', {})
+        self.output_config = self.config.get('output', {})
+        self.algorithms_config = self.config.get('algorithms', {})
+        self.stage_cache = stage_cache
+        self.calibrator = calibrator
+
+    def analyze_image(self, image, tiled=False, runner=None):
+        """
+        Находит объекты и расстояния между ними на изображении PIL
+
+        tiled=True - размытие и поиск границ по тайлам (см. tiling.py).
+        Возвращает словарь с объектами, расстояниями (в пикселях)
+        и временем выполнения этапов.
+        """
+        runner = runner or StageRunner()
+        blur_kernel_size = self.image_config.get('blur_kernel_size', 5)
+        low_threshold = self.image_config.get('canny_low_threshold', 50)
+        high_threshold = self.image_config.get('canny_high_threshold', 150)
+
+        if tiled:
+            # Яркость и размытие считаются внутри тайлов на этапе edges:
+            # полноразмерный массив яркости не создается
+            tile_size = self.image_config.get('tile_size', 1024)
+            ys, xs, labels, count, tiling_info = runner.run(
+                'edges',
+                {'blur_kernel_size': blur_kernel_size, 'low': low_threshold, 'high': high_threshold,
+                 'tile_size': tile_size},
+                lambda: tiling.canny_tiled(image, blur_kernel_size, low_threshold, high_threshold,
+                                           tile_size, self.image_config.get('tile_workers')))
+        else:
+            blurred = runner.run('blur', {'blur_kernel_size': blur_kernel_size},
+                                 lambda: gaussian_blur(to_grayscale(image), blur_kernel_size))
+            tiling_info = None
+            ys, xs, labels, count = runner.run(
+                'edges', {'low': low_threshold, 'high': high_threshold},
+                lambda: canny(blurred, low_threshold, high_threshold))
+
+        min_area = self.image_config.get('contour_min_area', 100)
+        objects = runner.run('contours', {'min_area': min_area},
+                             lambda: extract_objects(ys, xs, labels, count, min_area))
+
+        distances = runner.run('distances', {'algorithms': self.algorithms_config},
+                               lambda: measure_distances(objects, self.algorithms_config))
+
+        measurements = {
+            'objects': objects,
+            'distances': distances,
+            'edge_pixels': int(len(ys)),
+            'timings_ms': runner.timings
+        }
+        if tiling_info is not None:
+            measurements['tiling'] = tiling_info
+        return measurements
+
+    def prepare_image(self, image):
+        """
+        Приводит изображение к разрешению анализа: возвращает (image, scale, tiled)
+
+        Изображения больше max_resolution уменьшаются, а при включенном
+        tiled_processing анализируются в исходном разрешении по тайлам
+        (с ограничением tiled_max_megapixels).
+        """
+        max_resolution = self.image_config.get('max_resolution')
+        if not self.tiles(image.width, image.height):
+            image, scale = fit_resolution(image, max_resolution)
+            return image, scale, False
+
+        scale = 1.0
+        max_pixels = self.image_config.get('tiled_max_megapixels', 64) * 1_000_000
+        if image.width * image.height > max_pixels:
+            scale = (max_pixels / (image.width * image.height)) ** 0.5
+            size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+            image = image.resize(size, Image.BILINEAR)
+        return image, scale, True
+
+    def exceeds_resolution(self, width, height):
+        """Больше ли изображение max_resolution"""
+        max_resolution = self.image_config.get('max_resolution')
+        return bool(max_resolution) and (width > max_resolution[0] or height > max_resolution[1])
+
+    def tiles(self, width, height):
+        """Анализируется ли изображение такого размера по тайлам"""
+        return self.exceeds_resolution(width, height) and self.image_config.get('tiled_processing', False)
+
+    @staticmethod
+    def apply_units(measurements, scale_result, units):
+        """
+        Переводит расстояния в units по найденному масштабу
+
+        Без масштаба (эталон не найден) расстояния остаются в пикселях:
+        units='pixels', а запрошенные единицы - в requested_units.
+        """
+        meters_per_pixel = scale_result['meters_per_pixel'] if scale_result else None
+        factor = calibration.units_per_pixel(meters_per_pixel, units)
+        measurements['calibration'] = scale_result
+        measurements['requested_units'] = units
+        if factor is None:
+            measurements['units'] = 'pixels'
+            measurements['units_per_pixel'] = 1.0
+            return measurements
+
+        measurements['units'] = units
+        measurements['units_per_pixel'] = factor
+        measurements['distances'] = calibration.convert_distances(measurements['distances'], factor)
+        return measurements
+
+    def process_file(self, file_path, file_type, units, output_path, content_hash=None, progress=None):
+        """
+        Анализирует изображение и сохраняет результат с наложенными измерениями
+
+        content_hash - SHA-256 файла, ключ кеша этапов (вычисляется, если не
+        передан и кеш включен). progress(data) получает {'stage': ...} перед
+        каждым этапом. Рядом с результатом сохраняется JSON с измерениями,
+        если включен output.include_metadata. Возвращает словарь измерений.
+        """
+        if file_type != 'image':
+            raise ValueError(f'DistanceAnalyzer поддерживает только изображения, получено: {file_type}')
+
+        if content_hash is None and self.stage_cache is not None and self.stage_cache.enabled:
+            content_hash = file_sha256(file_path)
+        on_stage = (lambda stage: progress({'stage': stage})) if progress is not None else None
+        runner = StageRunner(self.stage_cache, content_hash, on_stage)
+
+        # Полноразмерные изображения больше max_resolution в кеш этапов не попадают:
+        # один такой кадр вытеснил бы из него все остальное
+        width, height = image_size(file_path)
+        large = self.exceeds_resolution(width, height)
+        tiled_input = self.tiles(width, height)
+        decoded = runner.run('decode', {}, lambda: load_image(file_path)[0], store=not large)
+        image, scale, tiled = runner.run(
+            'resize',
+            {name: self.image_config.get(name)
+             for name in ('max_resolution', 'tiled_processing', 'tiled_max_megapixels')},
+            lambda decoded=decoded: self.prepare_image(decoded), store=not tiled_input)
+        # Полноразмерный декодированный кадр больше не нужен
+        del decoded
+
+        measurements = self.analyze_image(image, tiled, runner)
+        measurements['image_size'] = [image.width, image.height]
+        measurements['resize_scale'] = round(scale, 6)
+
+        scale_result = None
+        if self.calibrator is not None and self.calibrator.enabled:
+            scale_result = runner.run('calibration', self.calibrator.params,
+                                      lambda: self.calibrator.calibrate(image), after='resize')
+        self.apply_units(measurements, scale_result, units)
+
+        result_image = image
+        if self.output_config.get('overlay_measurements', True):
+            label = calibration.distance_label(measurements['units'], measurements['units_per_pixel'])
+            result_image = runner.run(
+                'overlay', {'output': self.output_config, 'units': measurements['units'],
+                            'units_per_pixel': measurements['units_per_pixel']},
+                lambda: render_overlay(image, measurements['objects'], measurements['distances'],
+                                       self.output_config, label),
+                after='distances', store=not tiled)
+
+        if progress is not None:
+            progress({'stage': 'save'})
+        started = time.perf_counter()
+        mark = stage_clock()
+        save_image(result_image, output_path)
+        runner.timings['save'] = round((time.perf_counter() - started) * 1000, 2)
+        record_stage('save', mark)
+        measurements['cached_stages'] = runner.cached
+
+        if self.output_config.get('include_metadata', True):
+            with open(os.path.splitext(output_path)[0] + '.json', 'w', encoding='utf-8') as f:
+                json.dump(measurements, f, ensure_ascii=False)
+
+        logger.info(f"Найдено объектов: {len(measurements['objects'])}, "
+                    f"расстояний: {len(measurements['distances'])} ({file_path})")
+        return measurements
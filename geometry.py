@@ -0,0 +1,86 @@
+"""
+Геометрия результата анализа без привязки к единицам
+
+Анализ сохраняет объекты и расстояния в пикселях изображения анализа и масштаб
+калибровки (метров на пиксель). Из этой геометрии без повторного анализа
+получаются измерения в любых единицах из SUPPORTED_UNITS и новое изображение
+с наложенными измерениями (с другим цветом, толщиной линий или шрифтом).
+"""
+import io
+import os
+
+from PIL import Image
+
+from calibration import METERS_PER_UNIT, distance_label
+from calibration import units_per_pixel as scale_units_per_pixel
+from distance_analyzer import load_image, render_overlay, save_image
+
+# Параметры наложения, которые можно переопределить при перерисовке
+OUTPUT_OVERRIDES = ('measurement_color', 'font_scale', 'line_thickness')
+
+
+class GeometryError(Exception):
+    """Измерения нельзя получить из сохраненной геометрии"""
+
+
+def build_geometry(measurements, source_file):
+    """Геометрия из измерений изображения (см. DistanceAnalyzer.process_file)"""
+    scale_result = measurements.get('calibration') or {}
+    return {
+        'source_file': source_file,
+        'image_size': measurements['image_size'],
+        'resize_scale': measurements['resize_scale'],
+        'calibration': {
+            'meters_per_pixel': scale_result.get('meters_per_pixel'),
+            'reference': scale_result.get('reference')
+        }
+    }
+
+
+def units_per_pixel(geometry, units, meters_per_pixel=None):
+    """Множитель перевода пикселей в units; meters_per_pixel переопределяет калибровку"""
+    if units == 'pixels':
+        return 1.0
+    if units not in METERS_PER_UNIT:
+        raise GeometryError(f'Неподдерживаемые единицы измерения: {units}')
+
+    factor = scale_units_per_pixel(meters_per_pixel or geometry['calibration'].get('meters_per_pixel'), units)
+    if factor is None:
+        raise GeometryError('Масштаб не откалиброван: доступны только пиксели '
+                            '(или передайте meters_per_pixel)')
+    return factor
+
+
+def convert_measurements(objects, distances, factor):
+    """Объекты и расстояния с размерами в единицах; factor - единиц на пиксель"""
+    converted_objects = [
+        {
+            **obj,
+            'width': round(obj['bbox'][2] * factor, 4),
+            'height': round(obj['bbox'][3] * factor, 4)
+        }
+        for obj in objects
+    ]
+    converted_distances = [
+        {**item, 'distance': round(item['distance_px'] * factor, 4)}
+        for item in distances
+    ]
+    return converted_objects, converted_distances
+
+
+def load_base_image(folder, geometry):
+    """Исходное изображение в разрешении анализа"""
+    image, _ = load_image(os.path.join(folder, geometry['source_file']))
+    size = tuple(geometry['image_size'])
+    if image.size != size:
+        image = image.resize(size, Image.BILINEAR)
+    return image
+
+
+def render(base_image, objects, distances, output_config, units, factor, extension):
+    """Новое изображение с измерениями в units; возвращает байты файла формата extension"""
+    result = render_overlay(base_image, objects, distances, output_config, distance_label(units, factor))
+
+    buffer = io.BytesIO()
+    save_image(result, buffer, extension)
+    return buffer.getvalue()
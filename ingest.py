@@ -0,0 +1,279 @@
+"""
+Потоковый прием загружаемых файлов
+
+Тело запроса читается из request.stream блоками фиксированного размера и сразу
+пишется в итоговый файл в UPLOAD_FOLDER. Хеш содержимого и размер считаются на
+лету, лимит размера проверяется во время чтения. Память не зависит от размера
+файла, а данные записываются на диск ровно один раз (без временного файла
+Werkzeug и повторного os.stat).
+
+download_url() так же сохраняет файл по ссылке (манифест пакетной загрузки):
+только с разрешенных хостов и только с публичных адресов. Соединение
+открывается с тем адресом, который прошел проверку, а каждое
+перенаправление проверяется заново - сервер нельзя заставить обратиться к
+loopback, внутренней сети или metadata-сервису облака.
+"""
+import hashlib
+import http.client
+import ipaddress
+import os
+import socket
+import ssl
+import time
+from datetime import datetime
+from urllib.parse import urljoin, urlparse
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, Epilogue, NeedData
+
+CHUNK_SIZE = 64 * 1024  # Размер блока чтения тела запроса
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class UploadError(Exception):
+    """Некорректный запрос загрузки"""
+
+
+class UploadTooLargeError(UploadError):
+    """Файл превышает допустимый размер"""
+
+
+class IngestedFile:
+    """Файл, полностью принятый и записанный на диск"""
+
+    def __init__(self, field_name, filename, path, size, sha256, receive_seconds=0.0, save_seconds=0.0):
+        self.field_name = field_name
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.received_at = datetime.now()
+        self.receive_seconds = receive_seconds  # Ожидание и разбор тела запроса
+        self.save_seconds = save_seconds  # Хеширование и запись на диск
+
+    def file_info(self):
+        """Информация о файле без обращения к файловой системе"""
+        received = self.received_at.isoformat()
+        return {
+            'size': self.size,
+            'sha256': self.sha256,
+            'created': received,
+            'modified': received
+        }
+
+
+class _HashingWriter:
+    """Пишет блоки в файл, одновременно считая хеш и размер"""
+
+    def __init__(self, field_name, filename, path, max_size):
+        self.field_name = field_name
+        self.filename = filename
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._started = time.perf_counter()
+        self._save_seconds = 0.0
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise UploadTooLargeError(f'Файл превышает {self.max_size} байт')
+        started = time.perf_counter()
+        self._hash.update(data)
+        self._file.write(data)
+        self._save_seconds += time.perf_counter() - started
+
+    def finish(self):
+        started = time.perf_counter()
+        self._file.close()
+        finished = time.perf_counter()
+        save_seconds = self._save_seconds + finished - started
+        return IngestedFile(self.field_name, self.filename, self.path, self.size, self._hash.hexdigest(),
+                            receive_seconds=finished - self._started - save_seconds, save_seconds=save_seconds)
+
+    def abort(self):
+        """Закрывает и удаляет недописанный файл"""
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def iter_multipart_files(stream, content_type, destination, max_size=None, chunk_size=CHUNK_SIZE):
+    """
+    Разбирает multipart/form-data поток и по мере приема отдает IngestedFile
+
+    destination(field_name, filename) возвращает путь для сохранения части
+    или None, чтобы пропустить ее. Исключение из destination прерывает прием
+    до записи данных на диск.
+    """
+    _, options = parse_options_header(content_type)
+    boundary = options.get('boundary')
+    if not boundary:
+        raise UploadError('В запросе multipart/form-data отсутствует boundary')
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    writer = None
+
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            try:
+                decoder.receive_data(chunk or None)
+                event = decoder.next_event()
+            except ValueError as e:
+                raise UploadError(f'Некорректное тело multipart запроса: {e}')
+
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    path = destination(event.name, event.filename)
+                    if path is not None:
+                        writer = _HashingWriter(event.name, event.filename, path, max_size)
+
+                elif isinstance(event, Data) and writer is not None:
+                    writer.write(event.data)
+                    if not event.more_data:
+                        finished, writer = writer, None
+                        yield finished.finish()
+
+                event = decoder.next_event()
+
+            if isinstance(event, Epilogue) or not chunk:
+                break
+
+    finally:
+        if writer is not None:
+            writer.abort()
+
+
+def save_stream(stream, filename, path, max_size=None, chunk_size=CHUNK_SIZE):
+    """Сохраняет тело запроса целиком как один файл (не multipart загрузка)"""
+    writer = _HashingWriter(None, filename, path, max_size)
+
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+
+    return writer.finish()
+
+
+def host_allowed(host, allowed_hosts):
+    """Хост есть в списке: точное имя или '*.домен' - любой поддомен"""
+    host = host.lower().rstrip('.')
+    for pattern in allowed_hosts:
+        pattern = pattern.lower().rstrip('.')
+        if pattern.startswith('*.') and host.endswith(pattern[1:]) or host == pattern:
+            return True
+    return False
+
+
+def public_address(host, port):
+    """
+    Адрес (ip, port) для подключения к host
+
+    Все адреса, которые вернул DNS, должны быть публичными: частный,
+    loopback, link-local, зарезервированный или multicast адрес - UploadError.
+    """
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise UploadError(f'Не удалось разрешить имя {host}: {e}')
+
+    addresses = []
+    for _, _, _, _, sockaddr in infos:
+        try:
+            ip = ipaddress.ip_address(sockaddr[0])
+        except ValueError:
+            raise UploadError(f'Адрес {sockaddr[0]} хоста {host} не поддерживается')
+        # ::ffff:127.0.0.1 - тот же loopback
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise UploadError(f'Хост {host} разрешается в непубличный адрес {ip}')
+        addresses.append((str(ip), port))
+    if not addresses:
+        raise UploadError(f'Не удалось разрешить имя {host}')
+    return addresses[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """HTTP-соединение с уже проверенным адресом: имя хоста повторно не разрешается"""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS-соединение с уже проверенным адресом; сертификат проверяется по имени хоста"""
+
+    def __init__(self, host, address, **kwargs):
+        self.ssl_context = ssl.create_default_context()
+        super().__init__(host, context=self.ssl_context, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        self.sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+
+_CONNECTIONS = {'http': _PinnedHTTPConnection, 'https': _PinnedHTTPSConnection}
+
+
+def check_url(url, allowed_hosts, schemes=tuple(DEFAULT_PORTS)):
+    """Разобранная ссылка, если ее схема и хост разрешены; иначе UploadError"""
+    parsed = urlparse(url)
+    if parsed.scheme not in schemes or parsed.scheme not in _CONNECTIONS:
+        raise UploadError(f'Некорректный URL: {url!r} (поддерживаются {", ".join(schemes)})')
+    if not parsed.hostname or not host_allowed(parsed.hostname, allowed_hosts):
+        raise UploadError(f'Хост {parsed.hostname!r} не разрешен для загрузки по ссылке')
+    try:
+        parsed.port
+    except ValueError:
+        raise UploadError(f'Некорректный порт в URL: {url!r}')
+    return parsed
+
+
+def download_url(url, filename, path, allowed_hosts, schemes=tuple(DEFAULT_PORTS), timeout=60, max_size=None,
+                 max_redirects=3):
+    """
+    Скачивает файл по ссылке в path потоково; возвращает IngestedFile
+
+    Ссылка и каждое перенаправление проверяются check_url и public_address,
+    соединение открывается с проверенным адресом. UploadError - ссылка
+    запрещена, недоступна или ответ не 200.
+    """
+    for _ in range(max_redirects + 1):
+        parsed = check_url(url, allowed_hosts, schemes)
+        port = parsed.port or DEFAULT_PORTS[parsed.scheme]
+        address = public_address(parsed.hostname, port)
+        connection = _CONNECTIONS[parsed.scheme](parsed.hostname, address, port=port, timeout=timeout)
+        target = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+        try:
+            connection.request('GET', target)
+            response = connection.getresponse()
+            if response.status in REDIRECT_STATUSES and response.getheader('Location'):
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.status != 200:
+                raise UploadError(f'Не удалось скачать {url}: HTTP {response.status}')
+            return save_stream(response, filename, path, max_size=max_size)
+        except (OSError, http.client.HTTPException) as e:
+            raise UploadError(f'Не удалось скачать {url}: {e}')
+        finally:
+            connection.close()
+    raise UploadError(f'Не удалось скачать {url}: больше {max_redirects} перенаправлений')
@@ -0,0 +1,437 @@
+"""
+Индекс заданий и артефактов в SQLite
+
+Один файл базы на каталог данных: задания (статус, время, результат,
+запрос отмены), артефакты в папке результатов (размер, mtime, SHA-256, срок
+хранения), записи кеша результатов и корзины токенов ограничения частоты.
+/status, /download, кеш результатов и очистка читают индекс вместо обращений
+к файловой системе, а состояние заданий переживает перезапуск и доступно
+всем процессам сервиса.
+
+База работает в режиме WAL: читатели не блокируют писателя, а несколько
+процессов с одним каталогом данных безопасно пишут по очереди (ожидание
+блокировки - busy_timeout). Соединения - свои у каждого потока и процесса.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Одинаковые имена в разных папках (загрузки, результаты) - разные артефакты
+ARTIFACTS_TABLE = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    folder TEXT NOT NULL DEFAULT 'processed',
+    filename TEXT NOT NULL,
+    job_id TEXT,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT,
+    created REAL NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (folder, filename)
+)"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    content_hash TEXT,
+    file_type TEXT NOT NULL,
+    file_path TEXT,
+    original_file TEXT,
+    file_info TEXT,
+    client_id TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    result TEXT,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    worker TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_content_hash ON jobs (content_hash);
+CREATE INDEX IF NOT EXISTS jobs_active ON jobs (worker) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created_at);
+
+""" + ARTIFACTS_TABLE + """;
+
+CREATE TABLE IF NOT EXISTS result_cache (
+    key TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS result_cache_lru ON result_cache (last_used);
+CREATE INDEX IF NOT EXISTS result_cache_file ON result_cache (filename);
+
+CREATE TABLE IF NOT EXISTS rate_limits (
+    client TEXT NOT NULL,
+    period INTEGER NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (client, period)
+);
+CREATE INDEX IF NOT EXISTS rate_limits_updated ON rate_limits (updated);
+"""
+
+# Изменения схемы для баз, созданных предыдущими версиями: (таблица, колонка, определение)
+MIGRATIONS = (
+    ('artifacts', 'folder', "TEXT NOT NULL DEFAULT 'processed'"),
+    ('jobs', 'cancel_requested', 'INTEGER NOT NULL DEFAULT 0'),
+)
+
+# Индексы по колонкам из MIGRATIONS и пересоздаваемым таблицам создаются после миграции
+SCHEMA_INDEXES = """
+CREATE INDEX IF NOT EXISTS artifacts_job ON artifacts (job_id);
+CREATE INDEX IF NOT EXISTS artifacts_expiry ON artifacts (expires_at);
+"""
+
+# Папка артефактов, на которые ссылаются записи кеша результатов
+RESULT_FOLDER = 'processed'
+
+ACTIVE_STATES = ('queued', 'running')
+
+# Поля задания, которые меняются по ходу выполнения
+JOB_STATE_FIELDS = ('status', 'error', 'result', 'started_at', 'finished_at')
+STATE_BATCH_SIZE = 500  # Заданий в одном запросе load_job_states (лимит параметров SQLite)
+
+
+def _to_json(value):
+    def default(obj):
+        if isinstance(obj, (set, frozenset, tuple)):
+            return list(obj)
+        return str(obj)
+    return json.dumps(value, ensure_ascii=False, default=default) if value is not None else None
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def current_worker():
+    """Идентификатор процесса сервиса (хост:pid) для записей о заданиях"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobIndex:
+    """Индекс заданий, артефактов и кеша результатов в одном файле SQLite"""
+
+    def __init__(self, path, busy_timeout=10.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        # executescript выполняет схему в своей транзакции
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        for table, column, definition in MIGRATIONS:
+            columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+            if column not in columns:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        _rekey_artifacts(conn)
+        conn.executescript(SCHEMA_INDEXES)
+
+    # --- соединения ---
+
+    def _connection(self):
+        # После fork соединение родителя использовать нельзя - открываем свое
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция на запись: блокировка берется сразу (BEGIN IMMEDIATE)"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def query(self, sql, params=()):
+        return self._connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        return self._connection().execute(sql, params).fetchone()
+
+    # --- задания ---
+
+    def save_job(self, job):
+        """Записывает задание целиком (новое или из кеша результатов)"""
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO jobs (id, content_hash, file_type, file_path, original_file, file_info, '
+                'client_id, status, error, result, created_at, started_at, finished_at, worker) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job.id, job.file_info.get('sha256'), job.file_type, job.file_path, job.original_file,
+                 _to_json(job.file_info), job.client_id, job.status, job.error, _to_json(job.result),
+                 _iso(job.created_at), _iso(job.started_at), _iso(job.finished_at), current_worker()))
+
+    def update_job(self, job):
+        """Записывает изменившееся состояние задания"""
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE jobs SET status = ?, error = ?, result = ?, started_at = ?, finished_at = ? WHERE id = ?',
+                (job.status, job.error, _to_json(job.result), _iso(job.started_at), _iso(job.finished_at),
+                 job.id))
+
+    def load_job(self, job_id):
+        """Запись задания (dict с разобранными JSON-полями) или None"""
+        row = self.query_one('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        if row is None:
+            return None
+        record = dict(row)
+        for name in ('file_info', 'result'):
+            record[name] = json.loads(record[name]) if record[name] else None
+        return record
+
+    def load_job_states(self, job_ids):
+        """
+        Только меняющиеся поля заданий: {id: состояние} - для слежения за заданиями других процессов
+
+        Задания, которых нет в индексе, в ответ не попадают.
+        """
+        states = {}
+        for offset in range(0, len(job_ids), STATE_BATCH_SIZE):
+            batch = job_ids[offset:offset + STATE_BATCH_SIZE]
+            rows = self.query(f'SELECT id, {", ".join(JOB_STATE_FIELDS)} FROM jobs '
+                              f'WHERE id IN ({", ".join("?" * len(batch))})', batch)
+            for row in rows:
+                record = dict(row)
+                record['result'] = json.loads(record['result']) if record['result'] else None
+                states[record.pop('id')] = record
+        return states
+
+    def request_cancel(self, job_id):
+        """Помечает задание в очереди или в работе для отмены его процессом; False - задание уже завершено"""
+        with self.transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN ('queued', 'running')", (job_id,))
+        return cursor.rowcount > 0
+
+    def cancel_requests(self, worker):
+        """Идентификаторы незавершенных заданий процесса worker, отмену которых запросили другие процессы"""
+        rows = self.query("SELECT id FROM jobs WHERE worker = ? AND status IN ('queued', 'running') "
+                          "AND cancel_requested = 1", (worker,))
+        return [row['id'] for row in rows]
+
+    def recover_interrupted(self, error):
+        """
+        Завершает ошибкой задания процессов этого хоста, которых больше нет
+
+        Такие задания остались в состоянии queued/running после остановки или
+        падения процесса. Возвращает число исправленных заданий.
+        """
+        host = socket.gethostname()
+        dead = []
+        for row in self.query("SELECT DISTINCT worker FROM jobs WHERE status IN ('queued', 'running')"):
+            worker_host, _, pid = (row['worker'] or '').rpartition(':')
+            if worker_host == host and pid.isdigit() and not _pid_alive(int(pid)):
+                dead.append(row['worker'])
+        if not dead:
+            return 0
+
+        with self.transaction() as db:
+            cursor = db.execute(
+                f"UPDATE jobs SET status = 'failed', error = ? "
+                f"WHERE status IN ('queued', 'running') AND worker IN ({', '.join('?' * len(dead))})",
+                (error, *dead))
+        return cursor.rowcount
+
+    # --- артефакты ---
+
+    def put_artifact(self, filename, size, mtime_ns, sha256=None, job_id=None, kind='result', expires_at=None,
+                     folder='processed'):
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO artifacts (filename, folder, job_id, kind, size, mtime_ns, sha256, created, '
+                'expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (filename, folder, job_id, kind, size, mtime_ns, sha256, time.time(), expires_at))
+
+    def get_artifact(self, filename, folder='processed'):
+        row = self.query_one('SELECT * FROM artifacts WHERE filename = ? AND folder = ?', (filename, folder))
+        return dict(row) if row is not None else None
+
+    def artifact_names(self, folder):
+        """Имена всех файлов папки folder, известных индексу"""
+        return {row['filename'] for row in self.query('SELECT filename FROM artifacts WHERE folder = ?', (folder,))}
+
+    def expired_artifacts(self, now, limit, expire_all=False):
+        """
+        Артефакты с истекшим сроком хранения, по возрастанию срока (индекс artifacts_expiry)
+
+        Файлы заданий в очереди или в работе не возвращаются. expire_all -
+        все артефакты независимо от срока.
+        """
+        active = ', '.join('?' * len(ACTIVE_STATES))
+        condition = '1' if expire_all else 'a.expires_at <= ?'
+        params = () if expire_all else (now,)
+        rows = self.query(
+            f'SELECT a.filename, a.folder, a.size FROM artifacts a LEFT JOIN jobs j ON j.id = a.job_id '
+            f'WHERE {condition} AND (j.status IS NULL OR j.status NOT IN ({active})) '
+            f'ORDER BY a.expires_at LIMIT ?',
+            (*params, *ACTIVE_STATES, limit))
+        return [dict(row) for row in rows]
+
+    def delete_jobs_before(self, created_before, limit):
+        """Удаляет до limit завершенных заданий, созданных раньше created_before (datetime)"""
+        with self.transaction() as db:
+            cursor = db.execute(
+                f'DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE created_at < ? '
+                f'AND status NOT IN ({", ".join("?" * len(ACTIVE_STATES))}) LIMIT ?)',
+                (_iso(created_before), *ACTIVE_STATES, limit))
+        return cursor.rowcount
+
+    def set_artifact_sha256(self, filename, sha256, folder='processed'):
+        with self.transaction() as db:
+            db.execute('UPDATE artifacts SET sha256 = ? WHERE folder = ? AND filename = ?', (sha256, folder, filename))
+
+    def delete_artifacts(self, filenames=None, folder='processed'):
+        """Удаляет записи артефактов папки folder (и кеша, ссылающегося на них); None - все записи папки"""
+        cached = folder == RESULT_FOLDER
+        with self.transaction() as db:
+            if filenames is None:
+                if cached:
+                    db.execute('DELETE FROM result_cache')
+                db.execute('DELETE FROM artifacts WHERE folder = ?', (folder,))
+                return
+            for filename in filenames:
+                if cached:
+                    db.execute('DELETE FROM result_cache WHERE filename = ?', (filename,))
+                db.execute('DELETE FROM artifacts WHERE folder = ? AND filename = ?', (folder, filename))
+
+    # --- кеш результатов ---
+
+    def cache_get(self, key, now, expires_at=None):
+        """
+        Результат из кеша, если его артефакт есть в индексе и не просрочен
+
+        Отмечает использование записи и в той же транзакции продлевает срок
+        хранения артефакта до expires_at: очистка не удалит файл результата,
+        который только что отдан клиенту.
+        """
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT c.result, a.filename FROM result_cache c '
+                'JOIN artifacts a ON a.folder = ? AND a.filename = c.filename '
+                'WHERE c.key = ? AND (a.expires_at IS NULL OR a.expires_at > ?)',
+                (RESULT_FOLDER, key, now)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE result_cache SET last_used = ? WHERE key = ?', (now, key))
+            if expires_at is not None:
+                db.execute('UPDATE artifacts SET expires_at = MAX(expires_at, ?) '
+                           'WHERE folder = ? AND filename = ? AND expires_at IS NOT NULL',
+                           (expires_at, RESULT_FOLDER, row['filename']))
+        return json.loads(row['result'])
+
+    def cache_put(self, key, filename, size, result, max_bytes):
+        """
+        Добавляет запись кеша и вытесняет давно не использованные сверх max_bytes
+
+        Вытесняется только запись кеша: ее артефакт может быть результатом
+        завершенного задания и удаляется по сроку хранения (sweeper).
+        Возвращает имена файлов вытесненных записей.
+        """
+        evicted = []
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO result_cache (key, filename, size, result, last_used) '
+                       'VALUES (?, ?, ?, ?, ?)', (key, filename, size, _to_json(result), time.time()))
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM result_cache').fetchone()[0]
+            for row in db.execute('SELECT key, filename, size FROM result_cache ORDER BY last_used').fetchall():
+                if total <= max_bytes:
+                    break
+                db.execute('DELETE FROM result_cache WHERE key = ?', (row['key'],))
+                total -= row['size']
+                evicted.append(row['filename'])
+        return evicted
+
+    def cache_stats(self):
+        row = self.query_one('SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM result_cache')
+        return {'entries': row['entries'], 'bytes': row['bytes']}
+
+    def cache_clear(self):
+        with self.transaction() as db:
+            db.execute('DELETE FROM result_cache')
+
+    # --- ограничение частоты ---
+
+    def update_rate_buckets(self, client_id, update, now, idle_seconds, max_clients):
+        """
+        Читает и записывает корзины токенов клиента в одной транзакции
+
+        update(state) получает {период: (токены, время обновления)} - пустой
+        для нового клиента - и возвращает (новое состояние, результат);
+        метод возвращает результат. При появлении нового клиента удаляются
+        клиенты, не обращавшиеся дольше idle_seconds (их корзины уже полны),
+        а сверх max_clients - давно не обращавшиеся.
+        """
+        with self.transaction() as db:
+            rows = db.execute('SELECT period, tokens, updated FROM rate_limits WHERE client = ?',
+                              (client_id,)).fetchall()
+            state, result = update({row['period']: (row['tokens'], row['updated']) for row in rows})
+            db.executemany('INSERT OR REPLACE INTO rate_limits (client, period, tokens, updated) VALUES (?, ?, ?, ?)',
+                           [(client_id, period, tokens, updated) for period, (tokens, updated) in state.items()])
+            if not rows:
+                db.execute('DELETE FROM rate_limits WHERE updated < ?', (now - idle_seconds,))
+                excess = db.execute('SELECT COUNT(DISTINCT client) FROM rate_limits').fetchone()[0] - max_clients
+                if excess > 0:
+                    db.execute('DELETE FROM rate_limits WHERE client IN (SELECT client FROM rate_limits '
+                               'GROUP BY client ORDER BY MAX(updated) LIMIT ?)', (excess,))
+        return result
+
+    def rate_limit_clients(self):
+        """Сколько клиентов отслеживает ограничение частоты"""
+        return self.query_one('SELECT COUNT(DISTINCT client) FROM rate_limits')[0]
+
+
+def _rekey_artifacts(conn):
+    """Переводит таблицу артефактов старой базы с ключа filename на (folder, filename)"""
+    def keyed_by_filename():
+        return [row['name'] for row in conn.execute('PRAGMA table_info(artifacts)') if row['pk']] == ['filename']
+
+    if not keyed_by_filename():
+        return
+    columns = 'folder, filename, job_id, kind, size, mtime_ns, sha256, created, expires_at'
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Другой процесс мог перевести таблицу, пока мы ждали блокировку
+        if not keyed_by_filename():
+            conn.execute('ROLLBACK')
+            return
+        conn.execute('ALTER TABLE artifacts RENAME TO artifacts_old')
+        conn.execute(ARTIFACTS_TABLE)
+        conn.execute(f'INSERT INTO artifacts ({columns}) SELECT {columns} FROM artifacts_old')
+        conn.execute('DROP TABLE artifacts_old')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    logger.info("Индекс артефактов переведен на ключ (папка, имя файла)")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
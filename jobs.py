@@ -0,0 +1,518 @@
+"""
+Очередь заданий анализа расстояний
+
+Загрузка файла только ставит задание в очередь, а сам анализ выполняется
+ограниченным пулом рабочих потоков. Статус задания хранится в памяти процесса.
+Задание можно отменить как в очереди, так и во время выполнения.
+
+Порядок выполнения определяет планировщик (см. scheduler.py): свободный поток
+берет не самое старое задание, а следующее по оценке стоимости и клиенту.
+
+Смены состояния и прогресс публикуются как события задания (publish);
+подписчики ждут новых событий в wait_events без опроса.
+
+С индексом (job_index.JobIndex) задания и смены их состояния записываются
+в SQLite: get() находит и задания, поставленные другими процессами сервиса
+или до перезапуска, - такие задания "отсоединены" (detached). Один поток
+индекса на процесс раз в INDEX_POLL_INTERVAL одним запросом перечитывает
+состояние всех незавершенных отсоединенных заданий, которые вернул get(), и
+будит их подписчиков: сколько бы клиентов ни ждали задание другого процесса,
+индекс опрашивается один раз. Тот же поток выполняет отмены: отмена
+отсоединенного задания - флаг в индексе, процесс-владелец проверяет флаги
+своих незавершенных заданий и отменяет их у себя.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import datetime
+
+from job_index import current_worker
+
+logger = logging.getLogger(__name__)
+
+# Состояния задания
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+FINISHED_STATES = {JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED}
+
+# События задания
+EVENT_STATUS = 'status'
+EVENT_PROGRESS = 'progress'
+JOB_EVENTS_HISTORY = 64  # Сколько последних событий хранит задание (для Last-Event-ID)
+INDEX_POLL_INTERVAL = 1.0  # Как часто перечитывать из индекса задания других процессов и отмены (сек)
+
+
+class QueueFullError(Exception):
+    """Очередь заданий переполнена"""
+
+
+class JobCancelled(Exception):
+    """Выполнение задания прервано отменой"""
+
+
+class Job:
+    """Задание на анализ одного файла"""
+
+    def __init__(self, file_path, file_type, original_file, file_info=None, client_id=None):
+        self.id = uuid.uuid4().hex
+        self.file_path = file_path
+        self.file_type = file_type
+        self.original_file = original_file
+        self.file_info = file_info or {}
+        self.status = JOB_QUEUED
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.cancel_requested = False
+        self.future = None
+        self.progress = None
+        self.events = deque(maxlen=JOB_EVENTS_HISTORY)
+        self.last_event_id = 0
+        self.changed = None  # threading.Condition, создается JobManager
+        self.client_id = client_id
+        self.estimated_cost = None  # Оценка секунд анализа (заполняет планировщик)
+        self.cost_unit = None
+        self.cost_units = None
+        self.queued_at = None
+        self.running_since = None  # time.monotonic() начала выполнения
+        self.quality_level = 0  # Уровень снижения качества анализа (0 - полное)
+        self.detached = False  # Задание другого процесса (или до перезапуска), прочитанное из индекса
+        self.profile = None  # Причина профилировать анализ (см. profiling.py) или None
+
+    @classmethod
+    def restore(cls, record):
+        """Задание из записи индекса (см. JobIndex.load_job)"""
+        def parse(value):
+            return datetime.fromisoformat(value) if value else None
+
+        job = cls(record['file_path'], record['file_type'], record['original_file'],
+                  record['file_info'], record['client_id'])
+        job.id = record['id']
+        job.status = record['status']
+        job.error = record['error']
+        job.result = record['result']
+        job.created_at = parse(record['created_at'])
+        job.started_at = parse(record['started_at'])
+        job.finished_at = parse(record['finished_at'])
+        job.detached = True
+        return job
+
+    @property
+    def is_finished(self):
+        return self.status in FINISHED_STATES
+
+    def to_dict(self):
+        """Возвращает JSON-совместимое описание задания"""
+        def iso(value):
+            return value.isoformat() if value else None
+
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'file_type': self.file_type,
+            'original_file': self.original_file,
+            'created_at': iso(self.created_at),
+            'started_at': iso(self.started_at),
+            'finished_at': iso(self.finished_at),
+            'progress': self.progress,
+            'estimated_seconds': round(self.estimated_cost, 1) if self.estimated_cost is not None else None,
+            'error': self.error
+        }
+
+
+class JobManager:
+    """
+    Ограниченная очередь заданий поверх пула потоков
+
+    handler(job) выполняет анализ и возвращает словарь результата;
+    исключение из handler переводит задание в состояние failed,
+    JobCancelled - в состояние cancelled. cancel_handler(job) вызывается
+    при отмене уже запущенного задания и должен прервать его выполнение.
+    finish_handler(job) вызывается после завершения задания с любым статусом.
+    scheduler (см. scheduler.Scheduler) выбирает следующее задание для
+    свободного потока; job.future завершается вместе с заданием.
+    index (job_index.JobIndex) - где хранить задания между процессами и перезапусками;
+    с индексом поток индекса выполняет отмены, запрошенные другими процессами,
+    и обновляет состояние заданий других процессов.
+    Потоки запускаются start(): задания, поставленные до него, ждут в очереди.
+    """
+
+    def __init__(self, handler, scheduler, max_workers=2, max_queue_size=32, history_size=1000,
+                 cancel_handler=None, index=None, finish_handler=None):
+        self._handler = handler
+        self._index = index
+        self._cancel_handler = cancel_handler
+        self._finish_handler = finish_handler
+        self._scheduler = scheduler
+        self._max_queue_size = max_queue_size
+        self._history_size = history_size
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._work_available = threading.Condition(self._lock)
+        self._pending = 0
+        self._running = set()  # Выполняемые задания
+        self._detached = {}  # Незавершенные задания других процессов, которые обновляет поток индекса
+        self._closed = False
+        self._stopped = threading.Event()
+        self.max_workers = max_workers
+        self._threads = []
+
+    def start(self):
+        """Запускает потоки заданий (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._threads or self._closed:
+                return
+            self._threads = [
+                threading.Thread(target=self._worker_loop, name=f'analysis_{index}', daemon=True)
+                for index in range(self.max_workers)
+            ]
+            if self._index is not None:
+                self._threads.append(threading.Thread(target=self._index_watch_loop, name='job_index_watch',
+                                                      daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def submit(self, file_path, file_type, original_file, file_info=None, client_id=None,
+               video_info=None, profile=None):
+        """
+        Ставит файл в очередь на анализ, не дожидаясь результата
+
+        client_id - от чьего имени задание (для справедливой очереди),
+        video_info - параметры видео (fps, frame_count) для оценки стоимости,
+        profile - причина профилировать анализ задания.
+        """
+        job = Job(file_path, file_type, original_file, file_info, client_id)
+        job.profile = profile
+        job.changed = threading.Condition(self._lock)
+        job.future = Future()
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Очередь заданий остановлена')
+            if self._pending >= self._max_queue_size:
+                raise QueueFullError(
+                    f'Очередь анализа заполнена ({self._max_queue_size} заданий)')
+            self._pending += 1
+
+        # Место в очереди занято; запись в индекс - без блокировки менеджера
+        try:
+            self._save(job)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+                self._slot_freed.notify_all()
+            raise
+
+        with self._lock:
+            self._scheduler.estimate(job, video_info)
+            self._scheduler.push(job)
+            self._jobs[job.id] = job
+            self._trim_history()
+            self._publish(job, EVENT_STATUS, {'status': JOB_QUEUED})
+            self._work_available.notify()
+
+        logger.info(f"Задание {job.id} поставлено в очередь: {file_path} "
+                    f"(клиент {client_id}, оценка {job.estimated_cost:.1f} сек)")
+        return job
+
+    def wait_for_slot(self, timeout=None):
+        """Ждет свободного места в очереди; возвращает False по истечении timeout"""
+        with self._slot_freed:
+            return self._slot_freed.wait_for(lambda: self._pending < self._max_queue_size, timeout)
+
+    def record_completed(self, file_path, file_type, original_file, file_info, result):
+        """Регистрирует уже готовое задание (например, результат из кеша)"""
+        job = Job(file_path, file_type, original_file, file_info)
+        job.changed = threading.Condition(self._lock)
+        job.future = Future()
+        job.future.set_result(None)
+        job.result = result
+        job.status = JOB_COMPLETED
+        job.started_at = job.finished_at = job.created_at
+        self._save(job)
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim_history()
+            self._publish(job, EVENT_STATUS, {'status': JOB_COMPLETED})
+        return job
+
+    def publish(self, job, event, data):
+        """Публикует событие задания (например, прогресс анализа) и будит подписчиков"""
+        with self._lock:
+            self._publish(job, event, data)
+
+    def wait_events(self, job, after_id=0, timeout=None):
+        """
+        События задания с номером больше after_id
+
+        Если новых событий нет, ждет их не дольше timeout; пустой список -
+        таймаут. Ожидание не занимает процессор: поток спит на условии задания.
+        Смены состояния задания другого процесса публикует поток индекса.
+        """
+        with job.changed:
+            job.changed.wait_for(lambda: job.last_event_id > after_id, timeout)
+            return [event for event in job.events if event[0] > after_id]
+
+    def get(self, job_id):
+        """
+        Возвращает задание по идентификатору или None (сначала в памяти, затем в индексе)
+
+        Незавершенное задание другого процесса - один объект на все вызовы:
+        его состояние обновляет поток индекса, подписчики ждут его событий.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id) or self._detached.get(job_id)
+        if job is not None or self._index is None:
+            return job
+
+        record = self._index.load_job(job_id)
+        if record is None:
+            return None
+        job = Job.restore(record)
+        job.changed = threading.Condition(self._lock)
+        with self._lock:
+            if not job.is_finished:
+                # Другой поток мог прочитать задание раньше - все ждут один объект
+                job = self._detached.setdefault(job_id, job)
+            if not job.last_event_id:
+                self._publish(job, EVENT_STATUS, {'status': job.status, 'error': job.error})
+        return job
+
+    def cancel(self, job_id):
+        """
+        Отменяет задание
+
+        Возвращает задание или None, если оно не найдено. Завершенные задания
+        не изменяются - вызывающий код проверяет job.status. Для задания
+        другого процесса отмена только запрашивается через индекс
+        (job.cancel_requested); дождаться ее можно через wait_events.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = self.get(job_id)
+            if job is not None and not job.is_finished and self._index.request_cancel(job.id):
+                job.cancel_requested = True
+                logger.info(f"Запрошена отмена задания {job.id} другого процесса")
+            return job
+
+        with self._lock:
+            if job.is_finished:
+                return job
+
+            job.cancel_requested = True
+            dequeued = job.status == JOB_QUEUED and job.future.cancel()
+            if dequeued:
+                # Задание еще не взято потоком - просто снимаем его с очереди
+                self._scheduler.remove(job)
+                job.status = JOB_CANCELLED
+                job.finished_at = datetime.now()
+                self._pending -= 1
+                self._slot_freed.notify_all()
+                self._publish(job, EVENT_STATUS, {'status': JOB_CANCELLED})
+
+        if dequeued:
+            self._update(job)
+            logger.info(f"Задание {job.id} снято с очереди")
+            return job
+
+        if self._cancel_handler is not None:
+            self._cancel_handler(job)
+        logger.info(f"Запрошена отмена задания {job.id}")
+        return job
+
+    def stats(self):
+        """Количество заданий по состояниям"""
+        counts = {JOB_QUEUED: 0, JOB_RUNNING: 0, JOB_COMPLETED: 0, JOB_FAILED: 0, JOB_CANCELLED: 0}
+        with self._lock:
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            counts['scheduler'] = self._scheduler.stats()
+        counts['workers'] = self.max_workers
+        counts['max_queue_size'] = self._max_queue_size
+        return counts
+
+    def load(self):
+        """
+        Загрузка очереди для контроля допуска новых заданий
+
+        pending - заданий в очереди и в работе, running - в работе; backlog_seconds - оценка
+        оставшегося анализа (очередь и остаток выполняемых заданий);
+        slot_eta - через сколько секунд ожидается завершение ближайшего
+        выполняемого задания; wait_seconds - оценка ожидания нового задания;
+        latency_p95 - p95 задержки недавно завершенных заданий (или None).
+        """
+        now = time.monotonic()
+        with self._lock:
+            remaining = [max(0.0, job.estimated_cost - (now - job.running_since)) for job in self._running]
+            backlog = self._scheduler.backlog_seconds() + sum(remaining)
+            return {
+                'pending': self._pending,
+                'running': len(self._running),
+                'max_queue_size': self._max_queue_size,
+                'backlog_seconds': backlog,
+                'slot_eta': min(remaining, default=0.0),
+                'wait_seconds': backlog / self.max_workers,
+                'latency_p95': self._scheduler.latency_p95()
+            }
+
+    def shutdown(self, wait=True):
+        self._stopped.set()
+        with self._lock:
+            self._closed = True
+            self._work_available.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _worker_loop(self):
+        while True:
+            with self._lock:
+                job = None
+                while job is None:
+                    job = self._scheduler.pop()
+                    if job is not None:
+                        break
+                    if self._closed:
+                        return
+                    self._work_available.wait()
+                # Отмененные задания планировщик уже не выдает
+                job.future.set_running_or_notify_cancel()
+                job.status = JOB_RUNNING
+                job.started_at = datetime.now()
+                job.running_since = time.monotonic()
+                self._running.add(job)
+                self._publish(job, EVENT_STATUS, {'status': JOB_RUNNING})
+
+            self._update(job)
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    self._running.discard(job)
+                    self._scheduler.complete(job, time.monotonic() - job.running_since,
+                                             job.status == JOB_COMPLETED)
+                if self._finish_handler is not None:
+                    try:
+                        self._finish_handler(job)
+                    except Exception as e:
+                        logger.error(f"Ошибка обработчика завершения задания {job.id}: {e}")
+                job.future.set_result(None)
+
+    def _index_watch_loop(self):
+        # Один поток на процесс вместо опроса индекса каждым подписчиком
+        while not self._stopped.wait(INDEX_POLL_INTERVAL):
+            self._apply_cancel_requests()
+            self._refresh_detached()
+
+    def _apply_cancel_requests(self):
+        # Отмены, запрошенные другими процессами через индекс (см. cancel)
+        with self._lock:
+            if not self._pending:
+                return
+        try:
+            job_ids = self._index.cancel_requests(current_worker())
+        except Exception as e:
+            logger.error(f"Не удалось прочитать запросы отмены из индекса: {e}")
+            return
+        for job_id in job_ids:
+            with self._lock:
+                local = job_id in self._jobs and not self._jobs[job_id].cancel_requested
+            if local:
+                self.cancel(job_id)
+
+    def _refresh_detached(self):
+        # Состояние заданий других процессов - одним запросом на все задания
+        with self._lock:
+            job_ids = list(self._detached)
+        if not job_ids:
+            return
+        try:
+            states = self._index.load_job_states(job_ids)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать состояние заданий из индекса: {e}")
+            return
+        with self._lock:
+            for job_id in job_ids:
+                job = self._detached.get(job_id)
+                state = states.get(job_id)
+                if job is None:
+                    continue
+                if state is None:
+                    # Запись удалена очисткой - обновлять больше нечего
+                    del self._detached[job_id]
+                    continue
+                if state['status'] != job.status:
+                    for name, value in state.items():
+                        setattr(job, name, value)
+                    for name in ('started_at', 'finished_at'):
+                        if isinstance(getattr(job, name), str):
+                            setattr(job, name, datetime.fromisoformat(getattr(job, name)))
+                    self._publish(job, EVENT_STATUS, {'status': job.status, 'error': job.error})
+                if job.is_finished:
+                    del self._detached[job_id]
+
+    def _run(self, job):
+        logger.info(f"Задание {job.id} запущено")
+
+        try:
+            if job.cancel_requested:
+                raise JobCancelled()
+            job.result = self._handler(job)
+            job.status = JOB_COMPLETED
+        except JobCancelled:
+            job.status = JOB_CANCELLED
+        except Exception as e:
+            logger.error(f"Задание {job.id} завершилось с ошибкой: {e}")
+            job.error = str(e)
+            job.status = JOB_FAILED
+        finally:
+            job.finished_at = datetime.now()
+            self._update(job)
+            with self._lock:
+                self._pending -= 1
+                self._slot_freed.notify_all()
+                self._publish(job, EVENT_STATUS, {'status': job.status, 'error': job.error})
+
+        duration = (job.finished_at - job.started_at).total_seconds()
+        logger.info(f"Задание {job.id} завершено со статусом {job.status} за {duration:.2f} сек")
+
+    def _save(self, job):
+        if self._index is not None:
+            self._index.save_job(job)
+
+    def _update(self, job):
+        # Ошибка записи в индекс не должна ломать выполнение задания
+        if self._index is None:
+            return
+        try:
+            self._index.update_job(job)
+        except Exception as e:
+            logger.error(f"Не удалось записать состояние задания {job.id} в индекс: {e}")
+
+    def _publish(self, job, event, data):
+        # Вызывается под _lock
+        job.last_event_id += 1
+        job.events.append((job.last_event_id, event, data))
+        if event == EVENT_PROGRESS:
+            job.progress = data
+        job.changed.notify_all()
+
+    def _trim_history(self):
+        # Удаляем самые старые завершенные задания, активные не трогаем
+        excess = len(self._jobs) - self._history_size
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.is_finished][:excess]:
+            del self._jobs[job_id]
@@ -0,0 +1,415 @@
+"""
+Метрики сервиса в текстовом формате Prometheus (/metrics)
+
+Счетчики (Counter), гистограммы (Histogram) и текущие значения (Gauge)
+хранятся в памяти процесса; запись - одна операция под блокировкой метрики,
+без ввода-вывода. Гистограммы - с фиксированными границами корзин, поэтому
+складываются между процессами без потерь.
+
+Несколько процессов сервиса (несколько воркеров WSGI-сервера) отдают
+согласованные значения через общую папку folder: каждый процесс раз в
+flush_interval и при завершении атомарно записывает туда снимок своих
+метрик ({хост}_{pid}.json), а /metrics в любом процессе складывает свои
+живые значения со снимками остальных. Текущие значения (gauge) завершенных
+процессов не учитываются, а их счетчики и гистограммы при старте следующего
+процесса переносятся в общий архив - накопленные значения не пропадают и не
+уменьшаются. Без folder метрики видны только в своем процессе.
+"""
+import bisect
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин по умолчанию (секунды): от быстрых запросов до долгого анализа видео
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+ARCHIVE_FILE = 'archive.json'  # Счетчики и гистограммы завершенных процессов
+LOCK_FILE = '.lock'  # Блокировка переноса снимков в архив
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """Метрика с фиксированным набором меток; значения - по кортежу значений меток"""
+
+    type = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        """[(значения меток, значение)] - копия текущих значений"""
+        with self._lock:
+            return [(key, list(value) if isinstance(value, list) else value) for key, value in self._values.items()]
+
+    def describe(self):
+        return {'type': self.type, 'help': self.help, 'labels': list(self.labels)}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Гистограмма: число наблюдений в каждой корзине (не накопленное,
+    последняя - выше всех границ) и сумма наблюдений
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def describe(self):
+        return {**super().describe(), 'buckets': list(self.buckets)}
+
+
+class MetricsRegistry:
+    """
+    Набор метрик процесса и их сбор между процессами
+
+    collectors - функции без аргументов, вызываемые перед каждым снимком:
+    они выставляют gauge по текущему состоянию (очередь, выполняемые задания).
+    """
+
+    def __init__(self, folder=None, flush_interval=5.0):
+        self._metrics = OrderedDict()
+        self._collectors = []
+        self._ratios = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.configure(folder, flush_interval)
+        # Дочерний процесс после fork начинает со своих нулей, иначе значения родителя учлись бы дважды
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def configure(self, folder, flush_interval=5.0):
+        """Задает папку снимков и период записи (реестр с метриками может быть создан раньше конфигурации)"""
+        self.folder = folder
+        self.flush_interval = flush_interval
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def add_ratio(self, name, help_text, counter, label='result', hit='hit'):
+        """
+        Доля попаданий по счетчику с меткой label (hit/miss)
+
+        Считается при выдаче из уже сложенных между процессами значений,
+        по остальным меткам счетчика.
+        """
+        self._ratios.append((name, help_text, counter.name, label, hit))
+
+    def start(self):
+        """Переносит снимки завершенных процессов в архив и запускает периодическую запись снимка"""
+        if not self.folder:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._loop, name='metrics_flusher', daemon=True)
+            self._thread.start()
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"Метрики: не удалось перенести снимки завершенных процессов: {e}")
+
+    def stop(self):
+        """Останавливает запись и сохраняет последний снимок процесса (один раз)"""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self.folder:
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.error(f"Метрики: не удалось сохранить снимок: {e}")
+
+    def snapshot(self):
+        """Снимок метрик процесса: описания и значения"""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Метрики: ошибка сбора значений: {e}")
+        return {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'time': time.time(),
+            'metrics': {
+                name: {**metric.describe(), 'samples': [[list(key), value] for key, value in metric.samples()]}
+                for name, metric in self._metrics.items()
+            }
+        }
+
+    def write_snapshot(self):
+        snapshot = self.snapshot()
+        path = os.path.join(self.folder, f"{snapshot['host']}_{snapshot['pid']}.json")
+        temp_path = path + '.part'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        """Метрики всех процессов, сложенные по меткам: {имя: описание с samples {метки: значение}}"""
+        own = self.snapshot()
+        snapshots = [own]
+        if self.folder:
+            # Архив читаем первым: снимки, уже перенесенные в него, но еще не удаленные, пропускаем
+            archive = self._read(ARCHIVE_FILE)
+            archived = set(archive.get('sources', [])) if archive is not None else set()
+            own_file = f"{own['host']}_{own['pid']}.json"
+            for name in self._snapshot_files():
+                if name == own_file or name in archived:
+                    continue
+                snapshot = self._read(name)
+                if snapshot is None:
+                    continue
+                if not self._process_alive(snapshot):
+                    # Текущие значения завершенного процесса уже неверны
+                    snapshot['metrics'] = {metric_name: data for metric_name, data in snapshot['metrics'].items()
+                                           if data['type'] != 'gauge'}
+                snapshots.append(snapshot)
+            if archive is not None:
+                snapshots.append(archive)
+        return merge_snapshots(snapshots, own['metrics'])
+
+    def compact(self):
+        """Переносит счетчики и гистограммы завершенных процессов этого хоста в архив"""
+        with open(os.path.join(self.folder, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                dead = []
+                for name in self._snapshot_files():
+                    snapshot = self._read(name)
+                    if snapshot is not None and not self._process_alive(snapshot):
+                        dead.append((name, snapshot))
+                if not dead:
+                    return 0
+
+                archive = self._read(ARCHIVE_FILE) or {'metrics': {}}
+                merged = merge_snapshots([archive] + [snapshot for _, snapshot in dead])
+                archive = {'host': None, 'pid': None, 'time': time.time(),
+                           'sources': [name for name, _ in dead], 'metrics': {
+                    name: {**{key: value for key, value in data.items() if key != 'samples'},
+                           'samples': [[list(labels), value] for labels, value in data['samples'].items()]}
+                    for name, data in merged.items() if data['type'] != 'gauge'
+                }}
+                temp_path = os.path.join(self.folder, ARCHIVE_FILE + '.part')
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(archive, f)
+                os.replace(temp_path, os.path.join(self.folder, ARCHIVE_FILE))
+                for name, _ in dead:
+                    try:
+                        os.remove(os.path.join(self.folder, name))
+                    except FileNotFoundError:
+                        pass
+                logger.info(f"Метрики: в архив перенесены снимки завершенных процессов: {len(dead)}")
+                return len(dead)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        merged = self.collect()
+        lines = []
+        for name, data in merged.items():
+            lines.append(f"# HELP {name} {escape_help(data['help'])}")
+            lines.append(f"# TYPE {name} {data['type']}")
+            for values, value in data['samples'].items():
+                labels = list(zip(data['labels'], values))
+                if data['type'] != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(data['buckets'] + ['+Inf'], value[:-1]):
+                    cumulative += count
+                    bucket_labels = labels + [('le', bound if bound == '+Inf' else format_value(float(bound)))]
+                    lines.append(f"{name}_bucket{format_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(value[-1])}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+        for name, help_text, counter_name, label, hit in self._ratios:
+            counter = merged.get(counter_name)
+            if counter is None:
+                continue
+            position = counter['labels'].index(label)
+            other_labels = [other for other in counter['labels'] if other != label]
+            totals = OrderedDict()
+            for values, value in counter['samples'].items():
+                group = tuple(item for index, item in enumerate(values) if index != position)
+                hits, lookups = totals.get(group, (0, 0))
+                totals[group] = (hits + (value if values[position] == hit else 0), lookups + value)
+            lines.append(f"# HELP {name} {escape_help(help_text)}")
+            lines.append(f"# TYPE {name} gauge")
+            for group, (hits, lookups) in totals.items():
+                if lookups:
+                    lines.append(f"{name}{format_labels(list(zip(other_labels, group)))} "
+                                 f"{format_value(hits / lookups)}")
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Метрика {metric.name} уже зарегистрирована')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def _snapshot_files(self):
+        try:
+            names = os.listdir(self.folder)
+        except FileNotFoundError:
+            return []
+        return [name for name in names if name.endswith('.json') and name != ARCHIVE_FILE]
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.folder, name), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Метрики: снимок {name} не прочитан: {e}")
+            return None
+
+    @staticmethod
+    def _process_alive(snapshot):
+        # Процессы другого хоста с общей папкой проверить нельзя - считаем живыми
+        if snapshot.get('host') != socket.gethostname():
+            return True
+        try:
+            os.kill(snapshot['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.error(f"Метрики: не удалось сохранить снимок: {e}")
+
+    def _after_fork(self):
+        for metric in self._metrics.values():
+            # Блокировку мог держать поток родителя, которого в дочернем процессе нет
+            metric._lock = threading.Lock()
+            metric.clear()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+
+def merge_snapshots(snapshots, described=None):
+    """
+    Складывает значения метрик из нескольких снимков
+
+    Описания (тип, метки, границы корзин) берутся из described или из первого
+    снимка с метрикой; гистограммы с другими границами корзин пропускаются.
+    """
+    merged = OrderedDict()
+    for name, data in (described or {}).items():
+        merged[name] = {**{key: value for key, value in data.items() if key != 'samples'}, 'samples': OrderedDict()}
+
+    for snapshot in snapshots:
+        for name, data in snapshot.get('metrics', {}).items():
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = {**{key: value for key, value in data.items() if key != 'samples'},
+                                         'samples': OrderedDict()}
+            if target['type'] != data['type'] or target['labels'] != data['labels'] or \
+                    target.get('buckets') != data.get('buckets'):
+                logger.warning(f"Метрики: несовместимое описание {name} в снимке процесса {snapshot.get('pid')}")
+                continue
+            for labels, value in data['samples']:
+                key = tuple(labels)
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target['samples'][key] = [left + right for left, right in zip(current, value)]
+                else:
+                    target['samples'][key] = current + value
+    return merged
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(str(value))}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    if value == int(value) and abs(value) < 1e15:
+        return f'{value:.1f}'
+    return repr(float(value))
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def escape_help(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n')
@@ -0,0 +1,301 @@
+"""
+Профилирование отдельных загрузок и заданий анализа
+
+Профиль задания включается:
+- заголовком PROFILING['header'] со значением ADMIN_TOKEN (привилегированные
+  клиенты) - профилируются и сам запрос /upload, и анализ;
+- случайно для доли PROFILING['sample_rate'] загрузок;
+- автоматически для анализа дольше PROFILING['slow_job_seconds']: по
+  истечении порога в процессе анализа запускается семплирующий профайлер
+  (стек потока анализа раз в sample_interval), поэтому быстрые задания
+  ничего за это не платят.
+
+Явный профиль - cProfile (файл pstats), профиль медленного задания - стеки в
+формате collapsed stacks (flamegraph.pl, speedscope). Вместе с ним в JSON
+сохраняются время и CPU по этапам анализа, общее время и CPU и пиковый RSS.
+Файлы лежат рядом с артефактами задания (profile_<job_id>.*) и отдаются
+только через /admin/jobs/<job_id>/profile.
+
+Без включенного профиля замеры этапов сводятся к проверке _active на None.
+"""
+import cProfile
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_PREFIX = 'profile_'
+TRIGGER_HEADER = 'header'
+TRIGGER_SAMPLE = 'sample'
+TRIGGER_SLOW = 'slow'
+TOP_ENTRIES = 25  # Сколько функций (стеков) показать в отчете
+
+_active = None  # Профиль задачи, выполняемой в этом процессе анализа
+
+
+def profile_name(job_id, suffix=''):
+    return f'{PROFILE_PREFIX}{job_id}{suffix}'
+
+
+def stage_clock():
+    """Отметка начала этапа (время и CPU потока) или None без активного профиля"""
+    if _active is None:
+        return None
+    return time.perf_counter(), time.thread_time()
+
+
+def record_stage(stage, mark):
+    """Добавляет к профилю время этапа, начатого отметкой mark из stage_clock()"""
+    if mark is None or _active is None:
+        return
+    _active.add_stage(stage, time.perf_counter() - mark[0], time.thread_time() - mark[1])
+
+
+def request_trigger(policy, header_value, admin_token):
+    """
+    Причина профилировать загрузку: TRIGGER_HEADER, TRIGGER_SAMPLE или None
+
+    Заголовок учитывается, только если задан ADMIN_TOKEN и значение совпало.
+    """
+    if admin_token and header_value and hmac.compare_digest(header_value.encode('utf-8'),
+                                                            admin_token.encode('utf-8')):
+        return TRIGGER_HEADER
+    sample_rate = policy.get('sample_rate') or 0.0
+    if sample_rate and random.random() < sample_rate:
+        return TRIGGER_SAMPLE
+    return None
+
+
+def profile_request(trigger):
+    """cProfile текущего потока для профилирования запроса или None, если профайлер недоступен"""
+    if trigger is None:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        logger.warning(f"Профиль запроса: cProfile недоступен: {e}")
+        return None
+    return profiler
+
+
+def start_profile(options):
+    """
+    Начинает профиль задачи в процессе анализа по settings['profile']
+
+    options: name, trigger (явный профиль cProfile) или slow_job_seconds
+    (семплирование после порога), sample_interval. None - профиль выключен.
+    """
+    global _active
+    if not options or not (options.get('trigger') or options.get('slow_job_seconds')):
+        return None
+    profile = JobProfile(options['name'], options.get('trigger'), options.get('slow_job_seconds'),
+                         options.get('sample_interval', 0.01))
+    profile.start()
+    _active = profile
+    return profile
+
+
+def read_peak_rss():
+    """Пиковый RSS процесса в байтах (с последнего reset_peak_rss или с запуска процесса)"""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss в Linux - килобайты, в macOS - байты
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """Сбрасывает пиковый RSS процесса (Linux); False - сброс недоступен"""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StackSampler(threading.Thread):
+    """Раз в interval снимает стек потока thread_id и считает одинаковые стеки"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profile_sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class JobProfile:
+    """
+    Профиль одной задачи анализа
+
+    trigger задан - cProfile с начала задачи; иначе через slow_seconds
+    запускается StackSampler. Времена этапов копятся всегда, но сохраняются,
+    только если профиль снят (captured).
+    """
+
+    def __init__(self, name, trigger=None, slow_seconds=None, sample_interval=0.01):
+        self.name = name
+        self.trigger = trigger
+        self.slow_seconds = slow_seconds
+        self.sample_interval = sample_interval
+        self.stages = {}
+        self._profiler = None
+        self._sampler = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread_id = None
+        self._started = None
+        self._cpu_started = None
+        self._rss_scope = 'process'
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss = None
+
+    @property
+    def captured(self):
+        return self._profiler is not None or self._sampler is not None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._rss_scope = 'task' if reset_peak_rss() else 'process'
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        if self.trigger:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self._profiler = profiler
+            except ValueError as e:
+                # Профайлер уже включен в этом потоке кем-то еще
+                logger.warning(f"Профиль {self.name}: cProfile недоступен: {e}")
+        elif self.slow_seconds:
+            self._timer = threading.Timer(self.slow_seconds, self._start_sampler)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def add_stage(self, stage, wall, cpu):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0}
+        entry['wall_seconds'] += wall
+        entry['cpu_seconds'] += cpu
+        entry['calls'] += 1
+
+    def stop(self):
+        global _active
+        if self._profiler is not None:
+            self._profiler.disable()
+        with self._lock:
+            self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._sampler is not None:
+            self._sampler.stop()
+        self.wall_seconds = time.perf_counter() - self._started
+        self.cpu_seconds = time.process_time() - self._cpu_started
+        self.peak_rss = read_peak_rss()
+        if _active is self:
+            _active = None
+
+    def save(self, folder, details=None):
+        """
+        Пишет файл профиля и JSON-отчет в folder, если профиль снят
+
+        Возвращает {'trigger', 'report', 'profile'} с именами файлов или None.
+        """
+        if not self.captured:
+            return None
+
+        if self._profiler is not None:
+            profile_file = self.name + '.prof'
+            self._profiler.dump_stats(os.path.join(folder, profile_file))
+            profile_format, top = 'pstats', self._top_functions()
+            trigger = self.trigger
+        else:
+            profile_file = self.name + '.folded'
+            with open(os.path.join(folder, profile_file), 'w', encoding='utf-8') as f:
+                for stack, count in self._sampler.stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            profile_format = 'folded'
+            top = [{'stack': stack, 'samples': count} for stack, count in self._sampler.stacks.most_common(TOP_ENTRIES)]
+            trigger = TRIGGER_SLOW
+
+        report_file = self.name + '.json'
+        report = {
+            **(details or {}),
+            'trigger': trigger,
+            'wall_seconds': round(self.wall_seconds, 4),
+            'cpu_seconds': round(self.cpu_seconds, 4),
+            'peak_rss_bytes': self.peak_rss,
+            # task - пик за время задачи, process - за всю жизнь процесса анализа
+            'peak_rss_scope': self._rss_scope,
+            'stages': {
+                stage: {'wall_seconds': round(entry['wall_seconds'], 4),
+                        'cpu_seconds': round(entry['cpu_seconds'], 4), 'calls': entry['calls']}
+                for stage, entry in self.stages.items()
+            },
+            'profile_file': profile_file,
+            'profile_format': profile_format,
+            'top': top
+        }
+        if self._sampler is not None:
+            report['sampling'] = {'interval_seconds': self.sample_interval, 'samples': self._sampler.samples,
+                                  'after_seconds': self.slow_seconds}
+        temp_path = os.path.join(folder, report_file + '.part')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, os.path.join(folder, report_file))
+        logger.info(f"Профиль {self.name} сохранен ({trigger}, {self.wall_seconds:.2f} сек)")
+        return {'trigger': trigger, 'report': report_file, 'profile': profile_file}
+
+    def _start_sampler(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._sampler = StackSampler(self._thread_id, self.sample_interval)
+            self._sampler.start()
+        logger.info(f"Профиль {self.name}: анализ дольше {self.slow_seconds} сек, включено семплирование")
+
+    def _top_functions(self):
+        stats = pstats.Stats(self._profiler, stream=io.StringIO())
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_ENTRIES]
+        return [
+            {'function': f'{os.path.basename(filename)}:{line}({name})', 'calls': calls,
+             'total_seconds': round(total, 4), 'cumulative_seconds': round(cumulative, 4)}
+            for (filename, line, name), (_, calls, total, cumulative, _) in entries
+        ]
@@ -0,0 +1,164 @@
+"""
+Ограничение частоты запросов по клиентам
+
+Для каждого клиента хранится набор корзин токенов (token bucket) - по одной
+на каждый лимит из API_CONFIG['rate_limiting'] (в минуту, в час). Запрос
+проходит, только если токен есть во всех корзинах; иначе возвращается время,
+через которое он появится (для заголовка Retry-After). Без индекса состояние
+хранится в памяти процесса, с индексом (job_index.JobIndex) - в SQLite, и
+лимит общий для всех процессов сервиса (воркеров пре-форк сервера).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# Лимиты API_CONFIG['rate_limiting']: ключ -> период в секундах
+RATE_LIMIT_PERIODS = {
+    'requests_per_minute': 60,
+    'requests_per_hour': 3600
+}
+
+
+class TokenBucket:
+    """Корзина на capacity токенов, пополняется равномерно за period секунд"""
+
+    def __init__(self, capacity, period, now):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Секунд до появления целого токена (0 - токен есть)"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    @property
+    def full(self):
+        return self.tokens >= self.capacity
+
+
+def take_token(buckets):
+    """Списывает токен из каждой корзины; если хотя бы в одной его нет - ничего не списывает и возвращает ожидание"""
+    wait = max(bucket.wait_time() for bucket in buckets)
+    if wait > 0:
+        return wait
+    for bucket in buckets:
+        bucket.tokens -= 1
+    return 0.0
+
+
+class RateLimiter:
+    """
+    Корзины токенов по клиентам
+
+    limits - [(capacity, period)]; limits пустой - ограничение отключено.
+    Клиентов с полными корзинами забываем, а число отслеживаемых клиентов
+    ограничено max_clients (вытесняются давно не обращавшиеся). index -
+    job_index.JobIndex для корзин, общих между процессами; счетчики allowed
+    и rejected - свои у каждого процесса.
+    """
+
+    def __init__(self, limits, max_clients=10000, index=None):
+        self.limits = [(capacity, period) for capacity, period in limits if capacity]
+        self.max_clients = max_clients
+        self.index = index
+        self._buckets = OrderedDict()  # client_id -> [TokenBucket]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, rate_config, max_clients=10000, index=None):
+        """Лимиты из API_CONFIG['rate_limiting']"""
+        if not rate_config.get('enabled', False):
+            return cls([], max_clients, index)
+        return cls([(rate_config.get(key), period) for key, period in RATE_LIMIT_PERIODS.items()],
+                   max_clients, index)
+
+    @property
+    def enabled(self):
+        return bool(self.limits)
+
+    def acquire(self, client_id):
+        """
+        Забирает токен клиента
+
+        Возвращает 0, если запрос разрешен, иначе число секунд до момента,
+        когда он будет разрешен (токены при отказе не списываются).
+        """
+        if not self.enabled:
+            return 0.0
+
+        if self.index is not None:
+            # Корзины общие для процессов - время по системным часам, а не monotonic процесса
+            now = time.time()
+            wait = self.index.update_rate_buckets(
+                client_id, lambda state: self._take_shared(state, now), now,
+                max(period for _, period in self.limits), self.max_clients)
+            with self._lock:
+                if wait > 0:
+                    self.rejected += 1
+                else:
+                    self.allowed += 1
+            return wait
+
+        now = time.monotonic()
+        with self._lock:
+            buckets = self._buckets.get(client_id)
+            if buckets is None:
+                buckets = [TokenBucket(capacity, period, now) for capacity, period in self.limits]
+                self._buckets[client_id] = buckets
+                self._prune(now)
+            else:
+                self._buckets.move_to_end(client_id)
+                for bucket in buckets:
+                    bucket.refill(now)
+
+            wait = take_token(buckets)
+            if wait > 0:
+                self.rejected += 1
+            else:
+                self.allowed += 1
+            return wait
+
+    def stats(self):
+        clients = self.index.rate_limit_clients() if self.index is not None else None
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'shared': self.index is not None,
+                'limits': [{'requests': capacity, 'period_seconds': period} for capacity, period in self.limits],
+                'clients': clients if clients is not None else len(self._buckets),
+                'allowed': self.allowed,
+                'rejected': self.rejected
+            }
+
+    def _take_shared(self, state, now):
+        # Вызывается индексом в транзакции: state - {период: (токены, время обновления)}
+        buckets = []
+        for capacity, period in self.limits:
+            bucket = TokenBucket(capacity, period, now)
+            if period in state:
+                bucket.tokens, bucket.updated = state[period]
+                # Часы могли сдвинуться назад - токены при этом не убывают
+                bucket.refill(max(now, bucket.updated))
+            buckets.append(bucket)
+        wait = take_token(buckets)
+        return {period: (bucket.tokens, bucket.updated) for (_, period), bucket in zip(self.limits, buckets)}, wait
+
+    def _prune(self, now):
+        # Вызывается под _lock при появлении нового клиента
+        if len(self._buckets) <= self.max_clients:
+            return
+        for client_id in list(self._buckets):
+            buckets = self._buckets[client_id]
+            for bucket in buckets:
+                bucket.refill(now)
+            if all(bucket.full for bucket in buckets):
+                del self._buckets[client_id]
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
@@ -0,0 +1,103 @@
+"""
+Кеш результатов анализа по содержимому файла
+
+Ключ кеша - SHA-256 загруженного файла, значимые для анализа разделы
+DISTANCE_ANALYSIS_CONFIG и единицы измерения. Повторная загрузка того же
+файла с теми же настройками сразу получает готовый результат без анализа.
+Объем артефактов ограничен бюджетом в байтах, вытеснение - LRU.
+Записи кеша хранятся в индексе SQLite (job_index) и общие для всех
+процессов сервиса с одним каталогом данных.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Разделы DISTANCE_ANALYSIS_CONFIG, от которых зависит результат
+RELEVANT_SECTIONS = {
+    'image': ('algorithms', 'calibration', 'image_processing', 'output'),
+    'video': ('algorithms', 'calibration', 'image_processing', 'video_processing', 'output')
+}
+
+
+def make_cache_key(content_hash, file_type, units, analysis_config):
+    """Строит ключ кеша из хеша файла, значимых настроек анализа и единиц"""
+    sections = {name: analysis_config.get(name, {}) for name in RELEVANT_SECTIONS[file_type]}
+    payload = json.dumps([content_hash, file_type, units, sections], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU-кеш результатов анализа с ограничением суммарного размера артефактов
+
+    Записи лежат в index (job_index.JobIndex); результат отдается, только если
+    его артефакт есть в индексе. Бюджет ограничивает только записи кеша:
+    файл вытесненного результата остается результатом своего задания и
+    удаляется по сроку хранения. Попадание продлевает срок хранения
+    артефакта на retention_seconds. max_bytes=0 отключает кеш.
+    """
+
+    def __init__(self, artifact_folder, max_bytes, index, retention_seconds=None):
+        self.artifact_folder = artifact_folder
+        self.max_bytes = max_bytes
+        self.index = index
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        """Возвращает сохраненный результат анализа или None"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        result = self.index.cache_get(key, now, now + self.retention_seconds if self.retention_seconds else None)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, key, result, size):
+        """Запоминает результат анализа (size - размер артефакта), вытесняя давно не использованные"""
+        if not self.enabled:
+            return
+
+        if size > self.max_bytes:
+            logger.info(f"Результат {result['processed_file']} больше бюджета кеша, не кешируем")
+            return
+
+        evicted = self.index.cache_put(key, result['processed_file'], size, result, self.max_bytes)
+        with self._lock:
+            self.evictions += len(evicted)
+        for filename in evicted:
+            logger.info(f"Результат {filename} вытеснен из кеша")
+
+    def clear(self):
+        self.index.cache_clear()
+
+    def stats(self):
+        stored = self.index.cache_stats()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'entries': stored['entries'],
+                'bytes': stored['bytes'],
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,192 @@
+"""
+Планировщик заданий анализа
+
+Задания выбираются не в порядке поступления, а по оценке стоимости (секунд
+анализа), чтобы короткие изображения не ждали за длинными видео:
+
+- стоимость изображения - по размеру файла, видео - по числу кадров, которые
+  останутся после frame_skip и fps_limit (или по размеру, если длительность
+  неизвестна); скорость анализа единицы уточняется по фактическому времени
+  завершенных заданий (скользящее среднее);
+- внутри клиента - сначала самое короткое задание, но стоимость ожидающего
+  задания уменьшается на aging_factor секунд за каждую секунду ожидания,
+  поэтому видео не ждет бесконечно;
+- между клиентами - справедливое разделение (fair queuing): следующим
+  обслуживается клиент, у которого меньше сумма уже выданного оценочного
+  времени анализа и стоимости его очередного задания.
+
+Планировщик не потокобезопасен: JobManager вызывает его под своей блокировкой.
+"""
+import time
+from collections import deque
+
+from video_pipeline import output_fps
+
+MEGABYTE = 1024 * 1024
+
+# Начальные оценки секунд анализа на единицу стоимости
+DEFAULT_RATES = {
+    'image_mb': 0.5,  # Секунд на мегабайт изображения
+    'video_frame': 0.05,  # Секунд на обработанный кадр видео
+    'video_mb': 1.0  # Секунд на мегабайт видео неизвестной длительности
+}
+JOB_OVERHEAD = 0.2  # Постоянная часть стоимости задания (секунд)
+RATE_SMOOTHING = 0.2  # Вес нового наблюдения в скользящем среднем скорости
+WAIT_HISTORY = 1000  # Сколько последних ожиданий хранить для статистики по классу
+LATENCY_WINDOW = 300  # За сколько последних секунд считать p95 задержки заданий
+
+
+def processed_frames(video_info, video_config):
+    """Сколько кадров видео будет проанализировано с учетом frame_skip и fps_limit"""
+    if not video_info or not video_info.get('frame_count') or not video_info.get('fps'):
+        return None
+    duration = video_info['frame_count'] / video_info['fps']
+    fps = output_fps(video_info['fps'], video_config.get('fps_limit'), video_config.get('frame_skip', 1))
+    return max(1, round(duration * fps))
+
+
+def percentile(values, fraction):
+    """Перцентиль отсортированного списка (ближайший ранг)"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Scheduler:
+    """Очередь заданий: справедливость между клиентами и SJF со старением внутри клиента"""
+
+    def __init__(self, video_config=None, aging_factor=1.0):
+        self.video_config = video_config or {}
+        self.aging_factor = aging_factor
+        self.rates = dict(DEFAULT_RATES)
+        self._queues = {}  # client_id -> задания в очереди
+        self._served = {}  # client_id -> оценочные секунды, выданные клиенту
+        self._running = {}  # client_id -> число выполняемых заданий
+        self._waits = {}  # класс задания -> последние ожидания в очереди (сек)
+        self._wait_totals = {}  # класс задания -> (число, сумма, максимум)
+        self._latencies = deque(maxlen=WAIT_HISTORY)  # (время завершения, от очереди до завершения)
+
+    def estimate(self, job, video_info=None):
+        """Записывает в job единицу стоимости, их число и оценку в секундах"""
+        size_mb = max(job.file_info.get('size', 0) / MEGABYTE, 0.01)
+        if job.file_type == 'video':
+            frames = processed_frames(video_info, self.video_config)
+            job.cost_unit, job.cost_units = ('video_frame', frames) if frames else ('video_mb', size_mb)
+        else:
+            job.cost_unit, job.cost_units = 'image_mb', size_mb
+        job.estimated_cost = JOB_OVERHEAD + job.cost_units * self.rates[job.cost_unit]
+        return job.estimated_cost
+
+    def push(self, job):
+        client_id = job.client_id
+        if client_id not in self._queues:
+            self._queues[client_id] = []
+            # Вновь активный клиент не получает "накопленного" права на очередь
+            active = [self._served[other] for other in self._queues if other in self._served]
+            self._served[client_id] = max(self._served.get(client_id, 0.0), min(active, default=0.0))
+        self._queues[client_id].append(job)
+        job.queued_at = time.monotonic()
+
+    def remove(self, job):
+        """Убирает задание из очереди (отмена до запуска)"""
+        queue = self._queues.get(job.client_id)
+        if queue is not None and job in queue:
+            queue.remove(job)
+            # Пустая очередь клиента сломала бы выбор кандидатов в pop()
+            if not queue:
+                del self._queues[job.client_id]
+            self._forget_idle(job.client_id)
+
+    def pop(self):
+        """Следующее задание или None, если очередь пуста"""
+        if not self._queues:
+            return None
+        now = time.monotonic()
+
+        def aged_cost(item):
+            return item.estimated_cost - self.aging_factor * (now - item.queued_at)
+
+        # Очередное задание каждого клиента и момент его "завершения" в справедливой очереди
+        candidates = {client: min(queue, key=aged_cost) for client, queue in self._queues.items()}
+        client_id = min(candidates, key=lambda client: self._served[client] + aged_cost(candidates[client]))
+        job = candidates[client_id]
+        queue = self._queues[client_id]
+        queue.remove(job)
+        if not queue:
+            del self._queues[client_id]
+
+        self._served[client_id] += job.estimated_cost
+        self._running[client_id] = self._running.get(client_id, 0) + 1
+        self._record_wait(job.file_type, now - job.queued_at)
+        return job
+
+    def complete(self, job, seconds, succeeded):
+        """
+        Задание завершено за seconds: уточняет скорость анализа его класса
+
+        Задания с пониженным качеством (job.quality_level) скорость не уточняют -
+        иначе оценка полного анализа занижалась бы после пика нагрузки.
+        """
+        now = time.monotonic()
+        self._latencies.append((now, now - job.queued_at))
+        client_id = job.client_id
+        self._running[client_id] -= 1
+        if not self._running[client_id]:
+            del self._running[client_id]
+        self._forget_idle(client_id)
+
+        if succeeded and job.cost_units and not job.quality_level:
+            observed = max(0.0, seconds - JOB_OVERHEAD) / job.cost_units
+            rate = self.rates[job.cost_unit]
+            self.rates[job.cost_unit] = rate + RATE_SMOOTHING * (observed - rate)
+
+    def latency_p95(self, window=LATENCY_WINDOW):
+        """p95 задержки заданий, завершенных за последние window секунд (или None)"""
+        since = time.monotonic() - window
+        return percentile(sorted(latency for finished, latency in self._latencies if finished >= since), 0.95)
+
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def backlog_seconds(self):
+        """Оценочное время анализа всех заданий в очереди (сек)"""
+        return sum(job.estimated_cost for queue in self._queues.values() for job in queue)
+
+    def stats(self):
+        """Очередь по классам, ожидание в очереди по классам и текущие оценки скорости"""
+        queued = {}
+        for queue in self._queues.values():
+            for job in queue:
+                queued[job.file_type] = queued.get(job.file_type, 0) + 1
+
+        queue_wait = {}
+        for job_class, waits in self._waits.items():
+            ordered = sorted(waits)
+            count, total, longest = self._wait_totals[job_class]
+            queue_wait[job_class] = {
+                'count': count,
+                'mean_seconds': round(total / count, 3),
+                'p50_seconds': round(percentile(ordered, 0.5), 3),
+                'p95_seconds': round(percentile(ordered, 0.95), 3),
+                'max_seconds': round(longest, 3)
+            }
+
+        latency = self.latency_p95()
+        return {
+            'queued': queued,
+            'clients': len(self._queues),
+            'backlog_seconds': round(self.backlog_seconds(), 1),
+            'queue_wait': queue_wait,
+            'latency_p95_seconds': round(latency, 3) if latency is not None else None,
+            'rates': {unit: round(rate, 4) for unit, rate in self.rates.items()}
+        }
+
+    def _record_wait(self, job_class, seconds):
+        self._waits.setdefault(job_class, deque(maxlen=WAIT_HISTORY)).append(seconds)
+        count, total, longest = self._wait_totals.get(job_class, (0, 0.0, 0.0))
+        self._wait_totals[job_class] = (count + 1, total + seconds, max(longest, seconds))
+
+    def _forget_idle(self, client_id):
+        # Клиент без заданий в очереди и в работе больше не учитывается
+        if client_id not in self._queues and client_id not in self._running:
+            self._served.pop(client_id, None)
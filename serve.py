@@ -0,0 +1,284 @@
+"""
+Пре-форк сервер для продакшена: python serve.py [--workers N] [--host H] [--port P]
+
+Мастер-процесс один раз создает приложение (create_app без запуска сервисов),
+загружает модули анализа, строит шаблоны эталонов калибровки и прогревает
+маршрутизацию Flask, затем открывает слушающий сокет и порождает fork'ом
+N воркеров. Загруженное в мастере воркеры разделяют copy-on-write: перед fork
+объекты мастера переводятся в постоянное поколение сборщика мусора
+(gc.freeze), чтобы сборка в воркере не трогала их страницы.
+
+Каждый воркер запускает свои процессы анализа (fork от воркера до первых
+потоков - они тоже получают готовые шаблоны), поток метрик и потоки заданий
+и принимает соединения на общем сокете многопоточным сервером Werkzeug.
+Периодическая очистка файлов работает только в первом воркере.
+ANALYSIS_WORKERS и ANALYSIS_QUEUE_SIZE действуют в каждом воркере отдельно;
+лимит частоты загрузок общий (корзины в индексе заданий), а отмену задания
+другого воркера выполняет его владелец по флагу в индексе.
+
+Время старта воркера - от вызова fork в мастере до готовности принимать
+запросы - воркер сообщает мастеру, пишет в журнал, отдает в /health (worker)
+и в метрику distance_worker_startup_seconds. Мастер перезапускает воркеры,
+упавшие после старта; воркер, упавший при первом старте, останавливает
+сервер. SIGTERM/SIGINT - остановка: воркеры получают SIGTERM, не
+завершившиеся за SERVE_SHUTDOWN_TIMEOUT добиваются SIGKILL.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import time
+from datetime import datetime
+
+from werkzeug.serving import make_server
+
+import analysis
+import app as service
+from config import get_config
+
+logger = logging.getLogger(__name__)
+
+RESPAWN_DELAY = 1.0  # Пауза перед перезапуском упавшего воркера (сек)
+
+
+def read_memory_sharing():
+    """Разделяемая и собственная память процесса в байтах (Linux) или None"""
+    try:
+        with open('/proc/self/smaps_rollup', encoding='ascii') as f:
+            values = {}
+            for line in f:
+                name, _, rest = line.partition(':')
+                parts = rest.split()
+                if len(parts) == 2 and parts[1] == 'kB':
+                    values[name] = int(parts[0]) * 1024
+    except OSError:
+        return None
+    return {
+        'rss_bytes': values.get('Rss', 0),
+        'shared_bytes': values.get('Shared_Clean', 0) + values.get('Shared_Dirty', 0),
+        'private_bytes': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)
+    }
+
+
+def preload(flask_app):
+    """Загружает в мастере то, что воркеры получат готовым: модули и шаблоны анализа, маршруты Flask"""
+    analysis.init_worker()
+    # Первый запрос собирает карту маршрутов и прочее ленивое состояние Flask
+    with flask_app.test_client() as client:
+        client.get('/')
+
+
+class PreforkServer:
+    """Мастер пре-форк сервера: порождает воркеры, собирает их отчеты о старте и перезапускает упавшие"""
+
+    def __init__(self, flask_app, settings, workers, host, port):
+        self.app = flask_app
+        self.settings = settings
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.socket = None
+        self.children = {}  # pid -> номер воркера
+        self.startup = {}  # номер воркера -> отчет о последнем старте
+        self.preload_seconds = None
+        self._stopping = False
+        self._ready_read = None
+        self._ready_write = None
+        self._buffer = b''
+
+    def run(self, preload_seconds):
+        self.preload_seconds = preload_seconds
+        self.socket = socket.create_server((self.host, self.port), backlog=self.settings.SERVE_BACKLOG)
+        # Соединение забирает один воркер, остальные не блокируются в accept
+        self.socket.setblocking(False)
+        self._ready_read, self._ready_write = os.pipe()
+
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        # Загруженное до этой точки - в постоянном поколении сборщика мусора и не копируется в воркерах
+        gc.freeze()
+        logger.info(f"Пре-форк сервер: мастер {os.getpid()}, подготовка {preload_seconds:.2f} сек, "
+                    f"запуск {self.workers} воркеров на http://{self.host}:{self.port}")
+        for index in range(self.workers):
+            self.spawn(index)
+
+        ready_reported = False
+        exit_code = 0
+        while not self._stopping:
+            self._read_reports()
+            if not ready_reported and len(self.startup) == self.workers:
+                ready_reported = True
+                self._log_summary()
+            if not self._reap(ready_reported):
+                exit_code = 1
+                break
+
+        self.stop()
+        return exit_code
+
+    def spawn(self, index):
+        forked_at = time.monotonic()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+        # Дочерний процесс: в код мастера не возвращается
+        code = 1
+        try:
+            code = self._worker_main(index, forked_at)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            logger.exception(f"Воркер {index}: аварийное завершение")
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def stop(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.settings.SERVE_SHUTDOWN_TIMEOUT
+        while self.children and time.monotonic() < deadline:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in list(self.children):
+            logger.warning(f"Воркер {self.children[pid]} (pid {pid}) не остановился за "
+                           f"{self.settings.SERVE_SHUTDOWN_TIMEOUT} сек - SIGKILL")
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.clear()
+        self.socket.close()
+        logger.info("Пре-форк сервер остановлен")
+
+    def _worker_main(self, index, forked_at):
+        os.close(self._ready_read)
+        # Останавливает воркер мастер: Ctrl+C в терминале приходит и ему
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        master_pid = os.getppid()
+        service.start_services(self.app, run_sweeper=index == 0, start_pool=True)
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=self.socket.fileno())
+
+        def check_master():
+            # Вызывается циклом сервера раз в poll_interval: мастер убит SIGKILL - воркер не остается сиротой
+            if os.getppid() != master_pid:
+                logger.error(f"Воркер {index}: мастер {master_pid} завершился - остановка")
+                sys.exit(0)
+
+        server.service_actions = check_master
+
+        startup_seconds = time.monotonic() - forked_at
+        report = {
+            'index': index,
+            'pid': os.getpid(),
+            'workers': self.workers,
+            'started_at': datetime.now().isoformat(),
+            'startup_seconds': round(startup_seconds, 4),
+            'master_preload_seconds': round(self.preload_seconds, 4),
+            'memory': read_memory_sharing()
+        }
+        services = service.get_services(self.app)
+        services.worker_info = report
+        services.metrics.worker_startup_seconds.set(startup_seconds, worker=str(index))
+        os.write(self._ready_write, (json.dumps(report) + '\n').encode('utf-8'))
+        os.close(self._ready_write)
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            service.stop_services(self.app)
+        return 0
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def _read_reports(self):
+        try:
+            readable, _, _ = select.select([self._ready_read], [], [], 0.5)
+        except InterruptedError:
+            return
+        if not readable:
+            return
+        self._buffer += os.read(self._ready_read, 65536)
+        while b'\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\n', 1)
+            report = json.loads(line)
+            self.startup[report['index']] = report
+            memory = report['memory']
+            shared = f", разделяемой памяти {memory['shared_bytes'] / 2 ** 20:.0f}MB из " \
+                     f"{memory['rss_bytes'] / 2 ** 20:.0f}MB" if memory else ''
+            logger.info(f"Воркер {report['index']} (pid {report['pid']}) готов за "
+                        f"{report['startup_seconds']:.3f} сек{shared}")
+
+    def _reap(self, started):
+        """Собирает завершившиеся воркеры; False - воркер упал при первом старте"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return True
+            if not pid:
+                return True
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            # Задания упавшего воркера остались бы в очереди и в работе навсегда
+            recovered = service.get_services(self.app).job_index.recover_interrupted('Воркер сервиса завершился аварийно')
+            logger.error(f"Воркер {index} (pid {pid}) завершился: {describe_status(status)}"
+                         + (f", прервано заданий {recovered}" if recovered else ''))
+            if self._stopping:
+                continue
+            if not started and index not in self.startup:
+                logger.error("Воркер не смог запуститься - сервер останавливается")
+                return False
+            time.sleep(RESPAWN_DELAY)
+            self.spawn(index)
+
+    def _log_summary(self):
+        times = [report['startup_seconds'] for report in self.startup.values()]
+        logger.info(f"Сервер готов: воркеров {len(times)}, старт мин {min(times):.3f} / "
+                    f"средн {sum(times) / len(times):.3f} / макс {max(times):.3f} сек "
+                    f"(подготовка в мастере {self.preload_seconds:.2f} сек)")
+
+
+def describe_status(status):
+    if os.WIFSIGNALED(status):
+        return f'сигнал {os.WTERMSIG(status)}'
+    return f'код {os.WEXITSTATUS(status)}'
+
+
+def main(argv=None):
+    settings = get_config()()
+    parser = argparse.ArgumentParser(description='Пре-форк сервер сервиса анализа расстояний')
+    parser.add_argument('--workers', type=int, default=settings.SERVE_WORKERS, help='Количество воркеров')
+    parser.add_argument('--host', default=settings.SERVE_HOST)
+    parser.add_argument('--port', type=int, default=settings.SERVE_PORT)
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('--workers должен быть не меньше 1')
+
+    started = time.monotonic()
+    # Процессы анализа порождаются fork от воркера и получают загруженное в мастере
+    settings.ANALYSIS_START_METHOD = settings.SERVE_ANALYSIS_START_METHOD
+    flask_app = service.create_app(settings, start=False)
+    preload(flask_app)
+    server = PreforkServer(flask_app, settings, args.workers, args.host, args.port)
+    return server.run(time.monotonic() - started)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
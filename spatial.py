@@ -0,0 +1,228 @@
+"""
+Пространственный индекс для расстояний между объектами
+
+Вместо полной матрицы N×N точки раскладываются по равномерной сетке, а запросы
+(ближайший сосед, k ближайших, все соседи в радиусе) обходят ячейки кольцами
+вокруг ячейки запроса. Все запросы обрабатываются пакетно: на каждом кольце
+кандидаты для всех еще не решенных точек считаются одной векторной операцией.
+
+Для малого числа объектов остается режим полной матрицы расстояний.
+"""
+import numpy as np
+
+INDEX_MODES = ('auto', 'grid', 'full')
+FULL_MATRIX_MAX_POINTS = 64  # До этого числа точек полная матрица дешевле сетки
+MAX_CELLS_PER_AXIS = 1 << 15  # Ограничивает ключи ячеек при очень малом шаге сетки
+
+
+def _expand_ranges(owners, starts, counts):
+    """Разворачивает диапазоны [start, start + count) в плоский массив индексов"""
+    total = int(counts.sum())
+    if total == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    repeated_owners = np.repeat(owners, counts)
+    # Позиция внутри диапазона: сквозной номер минус начало диапазона в плоском массиве
+    range_offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    positions = np.repeat(starts, counts) + (np.arange(total) - range_offsets)
+    return repeated_owners, positions
+
+
+def _ring_offsets(ring):
+    """Смещения ячеек на расстоянии Чебышева ring от центральной"""
+    if ring == 0:
+        return np.zeros((1, 2), dtype=np.int64)
+    side = np.arange(-ring, ring + 1)
+    top = np.stack([side, np.full_like(side, -ring)], axis=1)
+    bottom = np.stack([side, np.full_like(side, ring)], axis=1)
+    inner = np.arange(-ring + 1, ring)
+    left = np.stack([np.full_like(inner, -ring), inner], axis=1)
+    right = np.stack([np.full_like(inner, ring), inner], axis=1)
+    return np.concatenate([top, bottom, left, right])
+
+
+def _group_starts(sorted_groups):
+    return np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+
+
+class GridIndex:
+    """Равномерная сетка над набором точек (N, 2)"""
+
+    def __init__(self, points, cell_size=None):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        count = len(self.points)
+        self.origin = self.points.min(axis=0) if count else np.zeros(2)
+        extent = np.ptp(self.points, axis=0) if count else np.zeros(2)
+
+        if cell_size is None:
+            # В среднем около одной точки на ячейку
+            area = max(float(extent[0]) * float(extent[1]), float(extent.max()) ** 2 / max(count, 1), 1.0)
+            cell_size = np.sqrt(area / max(count, 1))
+        # Ячейка крупнее запрошенной не влияет на точность, только на число кандидатов
+        self.cell_size = max(float(cell_size), float(extent.max()) / MAX_CELLS_PER_AXIS, 1e-9)
+
+        cells = self._cells(self.points)
+        self.grid_size = cells.max(axis=0) + 1 if count else np.ones(2, dtype=np.int64)
+        keys = self._keys(cells)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    @property
+    def max_ring(self):
+        return int(self.grid_size.max())
+
+    def _cells(self, points):
+        return np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+
+    def _keys(self, cells):
+        return cells[:, 1] * self.grid_size[0] + cells[:, 0]
+
+    def ring_candidates(self, query_points, query_ids, ring):
+        """
+        Пары (запрос, точка индекса) для ячеек кольца ring вокруг ячеек запросов
+
+        Возвращает номера запросов (из query_ids) и номера точек индекса.
+        """
+        cells = self._cells(query_points)
+        offsets = _ring_offsets(ring)
+
+        neighbor = (cells[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+        owners = np.repeat(query_ids, len(offsets))
+        inside = ((neighbor >= 0) & (neighbor < self.grid_size)).all(axis=1)
+        neighbor, owners = neighbor[inside], owners[inside]
+
+        keys = self._keys(neighbor)
+        starts = np.searchsorted(self.sorted_keys, keys, side='left')
+        ends = np.searchsorted(self.sorted_keys, keys, side='right')
+        owners, positions = _expand_ranges(owners, starts, ends - starts)
+        return owners, self.order[positions]
+
+
+def _take_k_smallest(owners, targets, distances, k):
+    """Для каждого владельца оставляет k кандидатов с наименьшим расстоянием"""
+    order = np.lexsort((distances, owners))
+    owners, targets, distances = owners[order], targets[order], distances[order]
+    starts = _group_starts(owners) if len(owners) else np.empty(0, dtype=np.int64)
+    rank = np.arange(len(owners)) - np.repeat(starts, np.diff(np.r_[starts, len(owners)]))
+    keep = rank < k
+    return owners[keep], targets[keep], distances[keep], rank[keep]
+
+
+def _pairwise(points):
+    diff = points[:, None, :] - points[None, :, :]
+    return np.sqrt((diff * diff).sum(axis=-1))
+
+
+def _use_full_matrix(count, mode, full_matrix_max):
+    if mode not in INDEX_MODES:
+        raise ValueError(f'Неизвестный режим индекса расстояний: {mode}')
+    return mode == 'full' or (mode == 'auto' and count <= full_matrix_max)
+
+
+def k_nearest(points, k, mode='auto', full_matrix_max=FULL_MATRIX_MAX_POINTS):
+    """
+    k ближайших соседей каждой точки (сама точка не учитывается)
+
+    Возвращает (indices, distances) формы (N, k); недостающие соседи
+    (если точек меньше k + 1) обозначаются индексом -1 и расстоянием inf.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    count = len(points)
+    indices = np.full((count, k), -1, dtype=np.int64)
+    result = np.full((count, k), np.inf)
+    if count < 2 or k < 1:
+        return indices, result
+
+    if _use_full_matrix(count, mode, full_matrix_max):
+        matrix = _pairwise(points)
+        np.fill_diagonal(matrix, np.inf)
+        take = min(k, count - 1)
+        nearest = np.argsort(matrix, axis=1, kind='stable')[:, :take]
+        indices[:, :take] = nearest
+        result[:, :take] = np.take_along_axis(matrix, nearest, axis=1)
+        return indices, result
+
+    index = GridIndex(points)
+    needed = min(k, count - 1)
+    best_owner = np.empty(0, dtype=np.int64)
+    best_target = np.empty(0, dtype=np.int64)
+    best_distance = np.empty(0)
+    active = np.arange(count)
+
+    for ring in range(index.max_ring + 1):
+        owners, targets = index.ring_candidates(points[active], active, ring)
+        not_self = owners != targets
+        owners, targets = owners[not_self], targets[not_self]
+        delta = points[owners] - points[targets]
+        distances = np.sqrt((delta * delta).sum(axis=1))
+
+        best_owner, best_target, best_distance, rank = _take_k_smallest(
+            np.r_[best_owner, owners], np.r_[best_target, targets], np.r_[best_distance, distances], needed)
+
+        # Точки за пределами кольца ring находятся не ближе ring * cell_size
+        kth = np.full(count, np.inf)
+        last = rank == needed - 1
+        kth[best_owner[last]] = best_distance[last]
+        active = np.flatnonzero(kth > ring * index.cell_size)
+        if len(active) == 0:
+            break
+
+    indices[best_owner, rank] = best_target
+    result[best_owner, rank] = best_distance
+    return indices, result
+
+
+def nearest_neighbors(points, mode='auto', full_matrix_max=FULL_MATRIX_MAX_POINTS):
+    """Ближайший сосед каждой точки: (indices, distances) формы (N,)"""
+    indices, distances = k_nearest(points, 1, mode, full_matrix_max)
+    return indices[:, 0], distances[:, 0]
+
+
+def within_radius(points, radius, mode='auto', full_matrix_max=FULL_MATRIX_MAX_POINTS):
+    """
+    Все пары точек на расстоянии не больше radius
+
+    Возвращает (first, second, distances), first < second.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    count = len(points)
+    if count < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0)
+
+    if _use_full_matrix(count, mode, full_matrix_max):
+        matrix = _pairwise(points)
+        first, second = np.nonzero(np.triu(matrix <= radius, k=1))
+        return first, second, matrix[first, second]
+
+    index = GridIndex(points, cell_size=max(radius, 1e-9))
+    owners_all, targets_all = [], []
+    # Все точки в радиусе лежат в ячейках на расстоянии Чебышева не больше 1
+    for ring in (0, 1):
+        owners, targets = index.ring_candidates(points, np.arange(count), ring)
+        keep = owners < targets
+        owners_all.append(owners[keep])
+        targets_all.append(targets[keep])
+
+    first, second = np.concatenate(owners_all), np.concatenate(targets_all)
+    delta = points[first] - points[second]
+    distances = np.sqrt((delta * delta).sum(axis=1))
+    keep = distances <= radius
+    order = np.lexsort((second[keep], first[keep]))
+    return first[keep][order], second[keep][order], distances[keep][order]
+
+
+def full_distance_matrix(points):
+    """Полная матрица расстояний N×N (только для малого N)"""
+    return _pairwise(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+
+
+def unique_pairs(first, second, distances):
+    """Убирает дубликаты неориентированных пар (i, j) / (j, i)"""
+    if len(first) == 0:
+        return first, second, distances
+    low, high = np.minimum(first, second), np.maximum(first, second)
+    order = np.lexsort((high, low))
+    low, high, distances = low[order], high[order], distances[order]
+    keep = np.r_[True, (low[1:] != low[:-1]) | (high[1:] != high[:-1])]
+    return low[keep], high[keep], distances[keep]
@@ -0,0 +1,163 @@
+"""
+Кеш промежуточных результатов этапов анализа
+
+Анализ изображения разбит на именованные этапы (STAGES). Ключ этапа - хеш
+ключа этапа, результат которого он использует, и параметров самого этапа,
+а ключ первого этапа строится от SHA-256 файла. Обычно это предыдущий этап,
+но calibration зависит только от resize, а overlay - от distances. Поэтому
+при повторном анализе с другим canny_low_threshold этапы decode, resize,
+blur и calibration берутся из кеша, а заново считаются edges, contours,
+distances и overlay.
+
+Кеш живет в памяти процесса анализа; объем ограничен max_bytes, вытеснение - LRU.
+"""
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from profiling import record_stage, stage_clock
+
+logger = logging.getLogger(__name__)
+
+# Промах кеша: результат этапа может быть None (эталон калибровки не найден)
+MISSING = object()
+
+STAGES = ('decode', 'resize', 'blur', 'edges', 'contours', 'distances', 'calibration', 'overlay')
+
+
+def stage_key(stage, parent_key, params):
+    """Ключ этапа: предыдущий ключ + имя этапа + его параметры"""
+    payload = json.dumps([parent_key, stage, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def estimate_size(value):
+    """Примерный объем значения в памяти (байт)"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class StageCache:
+    """LRU-кеш результатов этапов с ограничением объема; max_bytes=0 отключает кеш"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions
+            }
+
+
+class StageRunner:
+    """
+    Выполняет этапы одного анализа по цепочке ключей
+
+    Без cache или root_key этапы просто выполняются и замеряются.
+    on_stage(stage) вызывается перед каждым этапом (для прогресса задания).
+    """
+
+    def __init__(self, cache=None, root_key=None, on_stage=None):
+        self.cache = cache if cache is not None and cache.enabled and root_key else None
+        self.key = root_key
+        self.keys = {}
+        self.on_stage = on_stage
+        self.timings = {}
+        self.cached = []
+
+    def run(self, stage, params, compute, after=None, store=True):
+        """
+        Результат этапа stage: из кеша или compute()
+
+        after - этап, результат которого использует stage (по умолчанию -
+        выполненный последним); ключ stage строится от его ключа.
+        store=False - результат не ищется и не запоминается в кеше
+        (полноразмерные изображения крупных файлов), но ключ строится.
+        """
+        if self.on_stage is not None:
+            self.on_stage(stage)
+        started = time.perf_counter()
+        mark = stage_clock()
+        value = MISSING
+        if self.cache is not None:
+            parent_key = self.keys[after] if after is not None else self.key
+            self.key = self.keys[stage] = stage_key(stage, parent_key, params)
+            if store:
+                value = self.cache.get(self.key, MISSING)
+
+        if value is MISSING:
+            value = compute()
+            if self.cache is not None and store:
+                self.cache.put(self.key, value)
+        else:
+            self.cached.append(stage)
+
+        self.timings[stage] = round((time.perf_counter() - started) * 1000, 2)
+        record_stage(stage, mark)
+        return value
@@ -0,0 +1,215 @@
+"""
+Фоновое удаление файлов с истекшим сроком хранения
+
+Каждый загруженный файл и артефакт результата записан в индекс (job_index)
+со сроком хранения. Фоновый поток раз в interval выбирает из индекса
+просроченные файлы по возрастанию срока (без обхода каталогов) и удаляет их
+небольшими пачками, ограниченными по числу и по времени, с паузой между
+пачками - диск и индекс не заняты надолго. Файлы заданий в очереди или в
+работе не удаляются никогда. Записи старых заданий удаляются так же, пачками.
+
+Каталоги обходятся только при старте: файлы, которых нет в индексе (созданные
+до него), ставятся в индекс со сроком от времени изменения, а брошенные
+временные файлы (*.part) старше grace_seconds удаляются.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+PART_MARKER = '.part'  # Временные файлы analysis.run_analysis и artifacts.materialize
+
+
+class RetentionSweeper:
+    """
+    Поток удаления просроченных файлов
+
+    folders - {имя папки в индексе: путь}; retention_seconds - срок хранения
+    файлов, которых не было в индексе, и записей заданий.
+    """
+
+    def __init__(self, index, folders, retention_seconds, interval, batch_size=200, batch_seconds=0.25,
+                 pause_seconds=0.05, grace_seconds=3600):
+        self.index = index
+        self.folders = folders
+        self.retention_seconds = retention_seconds
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.pause_seconds = pause_seconds
+        self.grace_seconds = grace_seconds
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._expire_all = False
+        self.running = False
+        self.last_sweep = None
+        self.totals = {'sweeps': 0, 'files_deleted': 0, 'bytes_reclaimed': 0, 'jobs_deleted': 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name='retention_sweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self, wait=True):
+        self._stopped.set()
+        self._wakeup.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def request_sweep(self, expire_all=False):
+        """
+        Запускает проход вне расписания; expire_all - удалить все файлы неактивных заданий
+
+        Если периодический поток в этом процессе не запущен (он работает в
+        другом воркере сервиса), проход выполняет разовый поток.
+        """
+        with self._lock:
+            self._expire_all = self._expire_all or expire_all
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, args=(True,), name='retention_sweeper',
+                                                daemon=True)
+                self._thread.start()
+            self._wakeup.set()
+
+    def sweep(self, expire_all=False):
+        """Один проход: просроченные файлы, затем записи старых заданий; возвращает его статистику"""
+        started = time.monotonic()
+        report = {'started_at': datetime.now().isoformat(), 'expire_all': expire_all,
+                  'files_deleted': 0, 'bytes_reclaimed': 0, 'jobs_deleted': 0, 'batches': 0}
+        with self._lock:
+            self.running = True
+
+        try:
+            while not self._stopped.is_set():
+                deleted, reclaimed = self._sweep_batch(expire_all)
+                if not deleted:
+                    break
+                report['batches'] += 1
+                report['files_deleted'] += deleted
+                report['bytes_reclaimed'] += reclaimed
+                self._stopped.wait(self.pause_seconds)
+
+            created_before = datetime.now() - timedelta(seconds=self.retention_seconds)
+            while not self._stopped.is_set():
+                deleted = self.index.delete_jobs_before(created_before, self.batch_size)
+                report['jobs_deleted'] += deleted
+                if deleted < self.batch_size:
+                    break
+                self._stopped.wait(self.pause_seconds)
+        finally:
+            report['duration_seconds'] = round(time.monotonic() - started, 3)
+            with self._lock:
+                self.running = False
+                self.last_sweep = report
+                self.totals['sweeps'] += 1
+                for name in ('files_deleted', 'bytes_reclaimed', 'jobs_deleted'):
+                    self.totals[name] += report[name]
+
+        logger.info(f"Очистка: удалено файлов {report['files_deleted']} "
+                    f"({report['bytes_reclaimed'] / (1024 * 1024):.1f}MB), заданий {report['jobs_deleted']} "
+                    f"за {report['duration_seconds']:.2f} сек")
+        return report
+
+    def adopt_untracked(self):
+        """
+        Разовый обход каталогов: ставит в индекс файлы, которых в нем нет
+
+        Срок хранения таких файлов отсчитывается от времени изменения. Файлы
+        моложе grace_seconds не трогаем - их может прямо сейчас записывать
+        другой процесс сервиса. Возвращает (поставлено в индекс, удалено *.part).
+        """
+        now = time.time()
+        adopted = removed = 0
+        for name, folder in self.folders.items():
+            known = self.index.artifact_names(name)
+            try:
+                entries = list(os.scandir(folder))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name in known or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime < self.grace_seconds:
+                    continue
+                if PART_MARKER in entry.name:
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+                    continue
+                self.index.put_artifact(entry.name, stat.st_size, stat.st_mtime_ns, kind='untracked',
+                                        expires_at=stat.st_mtime + self.retention_seconds, folder=name)
+                adopted += 1
+        if adopted or removed:
+            logger.info(f"Очистка: в индекс добавлено файлов {adopted}, удалено временных файлов {removed}")
+        return adopted, removed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self.running,
+                'interval_seconds': self.interval,
+                'retention_seconds': self.retention_seconds,
+                'last_sweep': self.last_sweep,
+                'totals': dict(self.totals)
+            }
+
+    def _sweep_batch(self, expire_all):
+        # Пачка не больше batch_size файлов и не дольше batch_seconds
+        rows = self.index.expired_artifacts(time.time(), self.batch_size, expire_all)
+        started = time.monotonic()
+        processed, reclaimed = {}, 0
+        for row in rows:
+            if processed and time.monotonic() - started > self.batch_seconds:
+                break
+            folder = self.folders.get(row['folder'])
+            if folder is not None:
+                try:
+                    os.remove(os.path.join(folder, row['filename']))
+                    reclaimed += row['size']
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error(f"Очистка: не удалось удалить {row['filename']}: {e}")
+                    continue
+            processed.setdefault(row['folder'], []).append(row['filename'])
+        for name, filenames in processed.items():
+            self.index.delete_artifacts(filenames, name)
+        return sum(len(filenames) for filenames in processed.values()), reclaimed
+
+    def _loop(self, once=False):
+        if not once:
+            try:
+                self.adopt_untracked()
+            except Exception as e:
+                logger.error(f"Очистка: ошибка обхода каталогов: {e}")
+
+        while not self._stopped.is_set():
+            # Запрос, пришедший во время прохода, разбудит поток сразу после него
+            self._wakeup.clear()
+            with self._lock:
+                expire_all, self._expire_all = self._expire_all, False
+            try:
+                self.sweep(expire_all)
+            except Exception as e:
+                logger.error(f"Очистка: ошибка прохода: {e}")
+            if once:
+                # Разовый поток завершается, если за время прохода не пришел новый запрос
+                with self._lock:
+                    if not self._wakeup.is_set():
+                        self._thread = None
+                        return
+                continue
+            self._wakeup.wait(self.interval)
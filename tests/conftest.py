@@ -0,0 +1,19 @@
+"""Общие фикстуры тестов; модули сервиса лежат в корне репозитория"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_index import JobIndex  # noqa: E402
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / 'index.sqlite3')
+
+
+@pytest.fixture
+def job_index(index_path):
+    return JobIndex(index_path)
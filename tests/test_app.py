@@ -0,0 +1,61 @@
+import io
+import os
+
+import pytest
+
+import app as service
+from config import get_config
+
+
+def make_config(folder):
+    folder.mkdir()
+    settings = get_config()()
+    settings.UPLOAD_FOLDER = str(folder / 'uploads')
+    settings.PROCESSED_FOLDER = str(folder / 'processed')
+    settings.JOB_INDEX_PATH = str(folder / 'index.sqlite3')
+    settings.METRICS_FOLDER = None
+    settings.LOG_FILE = str(folder / 'service.log')
+    return settings
+
+
+@pytest.fixture
+def apps(tmp_path):
+    # Без start: потоки и процессы сервисов тестам не нужны
+    return [service.create_app(make_config(tmp_path / name), start=False) for name in ('first', 'second')]
+
+
+def test_each_call_creates_independent_app(apps):
+    first, second = apps
+    assert first is not second
+    assert service.get_services(first) is not service.get_services(second)
+    assert service.get_services(first).job_index is not service.get_services(second).job_index
+
+    for flask_app in apps:
+        response = flask_app.test_client().get('/health')
+        assert response.status_code == 200
+        assert response.json['upload_folder'] == service.get_services(flask_app).config.UPLOAD_FOLDER
+
+
+def test_routes_come_from_blueprint(apps):
+    for flask_app in apps:
+        endpoints = {rule.endpoint for rule in flask_app.url_map.iter_rules()}
+        assert {'api.upload_file', 'api.upload_batch', 'api.download_processed'} <= endpoints
+
+
+def test_unsupported_upload_is_rejected_before_queueing(apps):
+    flask_app = apps[0]
+    response = flask_app.test_client().post('/upload', data={'file': (io.BytesIO(b'text'), 'notes.txt')},
+                                            content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.json['success'] is False
+    services = service.get_services(flask_app)
+    assert services.job_manager.load()['pending'] == 0
+    assert os.listdir(services.config.UPLOAD_FOLDER) == []
+
+
+def test_metrics_are_per_app(apps):
+    first, second = apps
+    first.test_client().get('/health')
+    text = second.test_client().get('/metrics').data.decode()
+    assert 'endpoint="health_check"' not in text
+    assert 'endpoint="health_check"' in first.test_client().get('/metrics').data.decode()
@@ -0,0 +1,104 @@
+import time
+
+from result_cache import ResultCache
+
+RESULT = {'success': True, 'processed_file': 'result.png', 'measurements': {'objects': []}}
+
+
+def put_result(index, filename='result.png', expires_at=None, folder='processed', size=100):
+    index.put_artifact(filename, size, 0, 'sha', 'job', 'result', expires_at, folder)
+
+
+def expires_at(index, filename='result.png', folder='processed'):
+    return index.get_artifact(filename, folder)['expires_at']
+
+
+def test_cache_hit_requires_indexed_artifact(job_index):
+    job_index.cache_put('key', 'result.png', 100, RESULT, max_bytes=1000)
+    assert job_index.cache_get('key', time.time()) is None
+
+    put_result(job_index)
+    assert job_index.cache_get('key', time.time()) == RESULT
+    assert job_index.cache_get('missing', time.time()) is None
+
+
+def test_expired_artifact_is_a_miss(job_index):
+    now = time.time()
+    put_result(job_index, expires_at=now - 1)
+    job_index.cache_put('key', 'result.png', 100, RESULT, max_bytes=1000)
+
+    assert job_index.cache_get('key', now, now + 3600) is None
+    # Промах не продлевает срок просроченного артефакта
+    assert expires_at(job_index) == now - 1
+
+
+def test_hit_extends_expiry_but_never_shortens(job_index):
+    now = time.time()
+    put_result(job_index, expires_at=now + 10)
+    job_index.cache_put('key', 'result.png', 100, RESULT, max_bytes=1000)
+
+    assert job_index.cache_get('key', now, now + 3600) == RESULT
+    assert expires_at(job_index) == now + 3600
+    assert job_index.cache_get('key', now, now + 60) == RESULT
+    assert expires_at(job_index) == now + 3600
+
+
+def test_artifact_without_expiry_stays_unlimited(job_index):
+    put_result(job_index, expires_at=None)
+    job_index.cache_put('key', 'result.png', 100, RESULT, max_bytes=1000)
+
+    assert job_index.cache_get('key', time.time(), time.time() + 60) == RESULT
+    assert expires_at(job_index) is None
+
+
+def test_same_filename_in_other_folder_does_not_serve_cache(job_index):
+    now = time.time()
+    put_result(job_index, folder='uploads', expires_at=now + 3600)
+    job_index.cache_put('key', 'result.png', 100, RESULT, max_bytes=1000)
+    assert job_index.cache_get('key', now) is None
+
+    put_result(job_index, folder='processed', expires_at=now + 10, size=200)
+    assert job_index.cache_get('key', now, now + 60) == RESULT
+    # Записи двух папок независимы
+    assert job_index.get_artifact('result.png', 'uploads')['size'] == 100
+    assert expires_at(job_index, folder='uploads') == now + 3600
+
+    job_index.delete_artifacts(folder='processed')
+    assert job_index.get_artifact('result.png', 'uploads') is not None
+    assert job_index.cache_stats()['entries'] == 0
+
+
+def test_cache_put_evicts_least_recently_used(job_index):
+    for name in ('a', 'b', 'c'):
+        put_result(job_index, f'{name}.png')
+        job_index.cache_put(name, f'{name}.png', 40, dict(RESULT, processed_file=f'{name}.png'), max_bytes=100)
+    # c вытеснил самую старую запись a
+    assert job_index.cache_stats() == {'entries': 2, 'bytes': 80}
+    assert job_index.cache_get('a', time.time()) is None
+
+    job_index.cache_get('b', time.time())
+    put_result(job_index, 'd.png')
+    evicted = job_index.cache_put('d', 'd.png', 40, dict(RESULT, processed_file='d.png'), max_bytes=100)
+    assert evicted == ['c.png']
+    assert job_index.cache_get('b', time.time()) is not None
+
+
+def test_result_cache_get_extends_by_retention(job_index):
+    cache = ResultCache('/nonexistent', 1000, job_index, retention_seconds=3600)
+    now = time.time()
+    put_result(job_index, expires_at=now + 5)
+    cache.put('key', RESULT, 100)
+
+    assert cache.get('key') == RESULT
+    assert expires_at(job_index) >= now + 3600
+    assert cache.get('other') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+
+def test_disabled_result_cache_stores_nothing(job_index):
+    cache = ResultCache('/nonexistent', 0, job_index)
+    put_result(job_index)
+    cache.put('key', RESULT, 100)
+    assert cache.get('key') is None
+    assert job_index.cache_stats()['entries'] == 0
@@ -0,0 +1,76 @@
+import pytest
+
+from job_index import JobIndex
+from rate_limit import RateLimiter, TokenBucket, take_token
+
+
+def test_token_bucket_refills_evenly():
+    bucket = TokenBucket(2, 10, now=0.0)
+    assert take_token([bucket]) == 0.0
+    assert take_token([bucket]) == 0.0
+    assert take_token([bucket]) == pytest.approx(5.0)
+
+    bucket.refill(2.5)
+    assert bucket.tokens == pytest.approx(0.5)
+    bucket.refill(100.0)
+    assert bucket.full and bucket.tokens == 2
+
+
+def test_take_token_spends_nothing_when_any_bucket_is_empty():
+    minute, hour = TokenBucket(5, 60, now=0.0), TokenBucket(1, 3600, now=0.0)
+    assert take_token([minute, hour]) == 0.0
+    assert take_token([minute, hour]) == pytest.approx(3600.0)
+    assert minute.tokens == 4
+
+
+def test_limit_per_client_in_memory():
+    limiter = RateLimiter([(3, 60)])
+    assert [limiter.acquire('a') for _ in range(3)] == [0.0, 0.0, 0.0]
+    wait = limiter.acquire('a')
+    assert 0 < wait <= 20.0
+    assert limiter.acquire('b') == 0.0
+    assert limiter.stats()['allowed'] == 4 and limiter.stats()['rejected'] == 1
+
+
+def test_disabled_limiter_allows_everything():
+    limiter = RateLimiter.from_config({'enabled': False, 'requests_per_minute': 1})
+    assert not limiter.enabled
+    assert all(limiter.acquire('a') == 0.0 for _ in range(10))
+
+
+def test_from_config_skips_missing_limits():
+    limiter = RateLimiter.from_config({'enabled': True, 'requests_per_minute': 10})
+    assert limiter.limits == [(10, 60)]
+
+
+def test_shared_index_limit_is_common_to_processes(index_path):
+    # Два лимитера с отдельными соединениями к одному индексу - как два воркера
+    first = RateLimiter([(3, 60)], index=JobIndex(index_path))
+    second = RateLimiter([(3, 60)], index=JobIndex(index_path))
+
+    assert first.acquire('client') == 0.0
+    assert second.acquire('client') == 0.0
+    assert first.acquire('client') == 0.0
+    assert second.acquire('client') > 0
+    assert first.acquire('client') > 0
+    # Другой клиент - свои корзины
+    assert second.acquire('other') == 0.0
+
+    assert first.stats()['shared'] and first.stats()['clients'] == 2
+    assert (first.stats()['allowed'], first.stats()['rejected']) == (2, 1)
+    assert (second.stats()['allowed'], second.stats()['rejected']) == (2, 1)
+
+
+def test_shared_buckets_refill_by_wall_clock(job_index, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('rate_limit.time.time', lambda: now[0])
+    limiter = RateLimiter([(2, 60)], index=job_index)
+
+    assert limiter.acquire('a') == 0.0
+    assert limiter.acquire('a') == 0.0
+    assert limiter.acquire('a') == pytest.approx(30.0)
+    now[0] += 30.0
+    assert limiter.acquire('a') == 0.0
+    # Часы ушли назад - токены не убывают и не появляются
+    now[0] -= 100.0
+    assert limiter.acquire('a') == pytest.approx(30.0)
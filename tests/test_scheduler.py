@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+
+import pytest
+
+from scheduler import JOB_OVERHEAD, MEGABYTE, Scheduler
+
+
+def make_job(client_id, size_mb=1.0, file_type='image'):
+    return SimpleNamespace(client_id=client_id, file_type=file_type, file_info={'size': int(size_mb * MEGABYTE)},
+                           quality_level=None)
+
+
+def submit(scheduler, job, video_info=None):
+    scheduler.estimate(job, video_info)
+    scheduler.push(job)
+    return job
+
+
+def drain(scheduler):
+    order = []
+    while True:
+        job = scheduler.pop()
+        if job is None:
+            return order
+        order.append(job)
+
+
+def test_shortest_job_first_within_client():
+    scheduler = Scheduler(aging_factor=0)
+    large = submit(scheduler, make_job('a', 20))
+    small = submit(scheduler, make_job('a', 1))
+    medium = submit(scheduler, make_job('a', 5))
+
+    assert drain(scheduler) == [small, medium, large]
+
+
+def test_clients_alternate_instead_of_first_come_first_served():
+    scheduler = Scheduler(aging_factor=0)
+    first = [submit(scheduler, make_job('a')) for _ in range(5)]
+    second = submit(scheduler, make_job('b'))
+
+    order = drain(scheduler)
+    # Задание b не ждет все пять заданий a
+    assert order.index(second) == 1
+    assert [job for job in order if job is not second] == first
+
+
+def test_returning_client_gets_no_accumulated_credit():
+    scheduler = Scheduler(aging_factor=0)
+    for _ in range(6):
+        submit(scheduler, make_job('a'))
+    for _ in range(3):
+        scheduler.pop()
+
+    late = [submit(scheduler, make_job('b')) for _ in range(3)]
+    clients = [job.client_id for job in drain(scheduler)]
+    # Клиент b начинает с уровня a, а не с нуля: задания чередуются
+    assert clients[:2] != ['b', 'b']
+    assert sorted(clients) == ['a'] * 3 + ['b'] * 3
+    assert all(job.client_id == 'b' for job in late)
+
+
+def test_aging_lets_long_job_overtake():
+    scheduler = Scheduler(aging_factor=1.0)
+    large = submit(scheduler, make_job('a', 20))
+    small = submit(scheduler, make_job('a', 1))
+    # Большое задание ждет дольше, чем разница оценок
+    large.queued_at -= large.estimated_cost - small.estimated_cost + 1
+
+    assert scheduler.pop() is large
+    assert scheduler.pop() is small
+
+
+def test_without_aging_long_job_keeps_waiting():
+    scheduler = Scheduler(aging_factor=0)
+    large = submit(scheduler, make_job('a', 20))
+    small = submit(scheduler, make_job('a', 1))
+    large.queued_at -= 3600
+
+    assert scheduler.pop() is small
+    assert scheduler.pop() is large
+
+
+def test_video_cost_uses_processed_frames():
+    scheduler = Scheduler({'frame_skip': 2}, aging_factor=0)
+    job = make_job('a', 50, 'video')
+    cost = scheduler.estimate(job, {'frame_count': 300, 'fps': 30})
+
+    assert job.cost_unit == 'video_frame'
+    assert job.cost_units == 150
+    assert cost == pytest.approx(JOB_OVERHEAD + 150 * scheduler.rates['video_frame'])
+
+
+def test_complete_refines_rate_but_not_for_degraded_jobs():
+    scheduler = Scheduler(aging_factor=0)
+    job = submit(scheduler, make_job('a', 2))
+    scheduler.pop()
+    initial = scheduler.rates['image_mb']
+    scheduler.complete(job, JOB_OVERHEAD + 2 * 3.0, succeeded=True)
+    assert initial < scheduler.rates['image_mb'] < 3.0
+
+    degraded = submit(scheduler, make_job('a', 2))
+    degraded.quality_level = 1
+    scheduler.pop()
+    refined = scheduler.rates['image_mb']
+    scheduler.complete(degraded, 100.0, succeeded=True)
+    assert scheduler.rates['image_mb'] == refined
+
+
+def test_remove_and_backlog():
+    scheduler = Scheduler(aging_factor=0)
+    kept = submit(scheduler, make_job('a', 1))
+    removed = submit(scheduler, make_job('b', 1))
+    scheduler.remove(removed)
+
+    assert scheduler.queued() == 1
+    assert scheduler.backlog_seconds() == pytest.approx(kept.estimated_cost)
+    assert drain(scheduler) == [kept]
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from spatial import full_distance_matrix, k_nearest, nearest_neighbors, unique_pairs, within_radius
+
+
+def brute_force(points):
+    matrix = full_distance_matrix(points)
+    np.fill_diagonal(matrix, np.inf)
+    return matrix
+
+
+def point_sets():
+    rng = np.random.default_rng(7)
+    uniform = rng.uniform(0, 1000, size=(400, 2))
+    # Плотные скопления и пустые области: ячейки сетки заполнены неравномерно
+    clustered = np.concatenate([rng.normal(center, 5, size=(100, 2)) for center in ((50, 50), (900, 120), (400, 800))])
+    line = np.stack([np.linspace(0, 500, 150), np.full(150, 3.0)], axis=1)
+    return {'uniform': uniform, 'clustered': clustered, 'line': line}
+
+
+@pytest.mark.parametrize('name', ['uniform', 'clustered', 'line'])
+@pytest.mark.parametrize('mode', ['grid', 'auto'])
+def test_k_nearest_matches_brute_force(name, mode):
+    points = point_sets()[name]
+    matrix = brute_force(points)
+    indices, distances = k_nearest(points, 4, mode=mode)
+
+    expected = np.sort(matrix, axis=1)[:, :4]
+    np.testing.assert_allclose(distances, expected)
+    np.testing.assert_allclose(np.take_along_axis(matrix, indices, axis=1), distances)
+
+
+@pytest.mark.parametrize('name', ['uniform', 'clustered', 'line'])
+def test_nearest_neighbors_grid_equals_full(name):
+    points = point_sets()[name]
+    grid_indices, grid_distances = nearest_neighbors(points, mode='grid')
+    full_indices, full_distances = nearest_neighbors(points, mode='full')
+
+    np.testing.assert_allclose(grid_distances, full_distances)
+    np.testing.assert_allclose(brute_force(points)[np.arange(len(points)), grid_indices], full_distances)
+
+
+@pytest.mark.parametrize('name', ['uniform', 'clustered', 'line'])
+@pytest.mark.parametrize('radius', [1.0, 15.0, 120.0])
+def test_within_radius_matches_brute_force(name, radius):
+    points = point_sets()[name]
+    first, second, distances = within_radius(points, radius, mode='grid')
+
+    matrix = full_distance_matrix(points)
+    expected_first, expected_second = np.nonzero(np.triu(matrix <= radius, k=1))
+    assert list(zip(first, second)) == list(zip(expected_first, expected_second))
+    np.testing.assert_allclose(distances, matrix[first, second])
+
+
+def test_fewer_points_than_k():
+    indices, distances = k_nearest([[0, 0], [3, 4]], 3, mode='grid')
+    assert indices.tolist() == [[1, -1, -1], [0, -1, -1]]
+    assert distances[:, 0].tolist() == [5.0, 5.0]
+    assert np.isinf(distances[:, 1:]).all()
+
+
+def test_duplicate_points_are_neighbors_at_zero_distance():
+    points = np.array([[10.0, 10.0], [10.0, 10.0], [500.0, 500.0]] * 30)
+    _, distances = nearest_neighbors(points, mode='grid')
+    assert (distances == 0).all()
+
+
+def test_unique_pairs_drops_reversed_duplicates():
+    first, second, distances = unique_pairs(np.array([2, 0, 1, 0]), np.array([0, 2, 0, 1]),
+                                            np.array([5.0, 5.0, 1.0, 1.0]))
+    assert list(zip(first, second)) == [(0, 1), (0, 2)]
+    assert distances.tolist() == [1.0, 5.0]
@@ -0,0 +1,101 @@
+import numpy as np
+
+from stage_cache import StageCache, StageRunner, stage_key
+
+
+class Pipeline:
+    """Цепочка этапов как в анализе изображения; calls - какие этапы реально считались"""
+
+    def __init__(self, cache, root_key='file-sha256'):
+        self.runner = StageRunner(cache, root_key)
+        self.calls = []
+
+    def stage(self, name, params, after=None, store=True):
+        def compute():
+            self.calls.append(name)
+            return np.full(4, len(self.calls))
+        return self.runner.run(name, params, compute, after=after, store=store)
+
+    def run(self, blur=5, low=50, decode_store=True):
+        self.stage('decode', {}, store=decode_store)
+        self.stage('resize', {'max_side': 1024})
+        self.stage('blur', {'kernel': blur})
+        self.stage('edges', {'low': low})
+        self.stage('calibration', {'template': 'a4'}, after='resize')
+        self.stage('overlay', {}, after='edges')
+        return self
+
+
+def test_repeated_analysis_takes_every_stage_from_cache():
+    cache = StageCache(10 * 1024 * 1024)
+    first = Pipeline(cache).run()
+    second = Pipeline(cache).run()
+
+    assert first.calls == ['decode', 'resize', 'blur', 'edges', 'calibration', 'overlay']
+    assert second.calls == []
+    assert second.runner.cached == first.calls
+    assert second.runner.keys == first.runner.keys
+
+
+def test_changed_parameter_recomputes_only_dependent_stages():
+    cache = StageCache(10 * 1024 * 1024)
+    first = Pipeline(cache).run(low=50)
+    second = Pipeline(cache).run(low=70)
+
+    # calibration зависит только от resize, overlay - от edges
+    assert second.calls == ['edges', 'overlay']
+    assert second.runner.cached == ['decode', 'resize', 'blur', 'calibration']
+    assert second.runner.keys['blur'] == first.runner.keys['blur']
+    assert second.runner.keys['edges'] != first.runner.keys['edges']
+    assert second.runner.keys['calibration'] == first.runner.keys['calibration']
+
+
+def test_upstream_change_propagates_down_the_chain():
+    cache = StageCache(10 * 1024 * 1024)
+    Pipeline(cache).run(blur=5)
+    second = Pipeline(cache).run(blur=7)
+    assert second.calls == ['blur', 'edges', 'overlay']
+
+
+def test_keys_chain_from_parent_key():
+    runner = Pipeline(StageCache(1024 * 1024)).run().runner
+    keys = runner.keys
+    assert keys['decode'] == stage_key('decode', 'file-sha256', {})
+    assert keys['resize'] == stage_key('resize', keys['decode'], {'max_side': 1024})
+    assert keys['calibration'] == stage_key('calibration', keys['resize'], {'template': 'a4'})
+    assert keys['overlay'] == stage_key('overlay', keys['edges'], {})
+
+
+def test_store_false_builds_key_without_caching():
+    cache = StageCache(10 * 1024 * 1024)
+    Pipeline(cache).run(decode_store=False)
+    second = Pipeline(cache).run(decode_store=False)
+
+    # Полноразмерное изображение считается заново, но следующие этапы находят свои ключи
+    assert second.calls == ['decode']
+    assert 'decode' not in second.runner.cached
+    assert cache.get(second.runner.keys['decode']) is None
+
+
+def test_other_file_misses_cache():
+    cache = StageCache(10 * 1024 * 1024)
+    Pipeline(cache, 'file-a').run()
+    assert len(Pipeline(cache, 'file-b').run().calls) == 6
+
+
+def test_without_cache_stages_just_run():
+    for cache, root_key in ((None, 'file'), (StageCache(0), 'file'), (StageCache(1024), None)):
+        pipeline = Pipeline(cache, root_key).run()
+        assert len(pipeline.calls) == 6
+        assert pipeline.runner.keys == {}
+        assert set(pipeline.runner.timings) == set(pipeline.calls)
+
+
+def test_cache_evicts_least_recently_used_by_size():
+    cache = StageCache(100)
+    cache.put('a', np.zeros(40, dtype=np.uint8))
+    cache.put('b', np.zeros(40, dtype=np.uint8))
+    cache.get('a')
+    cache.put('c', np.zeros(40, dtype=np.uint8))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
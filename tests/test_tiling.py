@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import distance_analyzer
+from tiling import canny_tiled, halo_size, tile_boxes
+
+LOW, HIGH = 30, 80
+
+
+def make_image(width=230, height=170, seed=3):
+    """Фигуры разной яркости поверх шума: контуры пересекают границы тайлов"""
+    rng = np.random.default_rng(seed)
+    background = rng.integers(90, 110, size=(height, width, 3), dtype=np.uint8)
+    image = Image.fromarray(background)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((20, 15, 120, 90), fill=(230, 230, 230))
+    draw.ellipse((100, 60, 200, 150), fill=(30, 30, 30))
+    draw.line((0, 160, 229, 5), fill=(200, 60, 60), width=3)
+    # Слабый контраст: гистерезис должен сохранить его только рядом с сильными границами
+    draw.rectangle((150, 10, 215, 45), fill=(125, 125, 125))
+    return image
+
+
+def untiled(image, blur_kernel_size):
+    blurred = distance_analyzer.gaussian_blur(distance_analyzer.to_grayscale(image), blur_kernel_size)
+    return distance_analyzer.canny(blurred, LOW, HIGH)
+
+
+def components(ys, xs, labels):
+    """Разбиение пикселей границ на контуры, не зависящее от нумерации"""
+    groups = {}
+    for y, x, label in zip(ys.tolist(), xs.tolist(), labels.tolist()):
+        groups.setdefault(label, set()).add((y, x))
+    return {frozenset(pixels) for pixels in groups.values()}
+
+
+@pytest.mark.parametrize('tile_size', [16, 37, 64, 1000])
+@pytest.mark.parametrize('blur_kernel_size', [1, 5])
+def test_tiled_edges_equal_untiled(tile_size, blur_kernel_size):
+    image = make_image()
+    ys, xs, labels, count = untiled(image, blur_kernel_size)
+    tiled_ys, tiled_xs, tiled_labels, tiled_count, info = canny_tiled(
+        image, blur_kernel_size, LOW, HIGH, tile_size, workers=3)
+
+    assert count > 0
+    assert tiled_count == count
+    assert sorted(zip(tiled_ys.tolist(), tiled_xs.tolist())) == sorted(zip(ys.tolist(), xs.tolist()))
+    assert components(tiled_ys, tiled_xs, tiled_labels) == components(ys, xs, labels)
+    assert info['tiles'] == len(tile_boxes(image.height, image.width, tile_size))
+    assert info['halo'] == halo_size(blur_kernel_size)
+
+
+def test_flat_image_has_no_edges():
+    image = Image.new('RGB', (100, 80), (128, 128, 128))
+    ys, xs, labels, count, _ = canny_tiled(image, 5, LOW, HIGH, 32)
+    assert count == 0 and len(ys) == len(xs) == len(labels) == 0
+
+
+def test_tile_boxes_cover_image_once():
+    covered = np.zeros((50, 70), dtype=int)
+    for y0, y1, x0, x1 in tile_boxes(50, 70, 16):
+        covered[y0:y1, x0:x1] += 1
+    assert (covered == 1).all()
@@ -0,0 +1,119 @@
+"""
+Обработка крупных изображений по тайлам
+
+Изображение делится на тайлы tile_size×tile_size; каждый тайл вырезается из
+изображения PIL с ореолом (halo) шириной радиус ядра размытия + 1 пиксель для
+Собеля + 1 для подавления немаксимумов, поэтому границы внутри тайла
+получаются такими же, как при обработке изображения целиком. Яркость,
+размытие и градиенты считаются внутри тайла и занимают память
+пропорционально размеру тайла, а не изображения. Само изображение
+декодируется целиком (декодеры PNG и JPEG в PIL не читают файл по частям)
+и остается в памяти до наложения измерений.
+
+Тайлы обрабатываются параллельно в потоках: NumPy отпускает GIL на больших
+операциях, а процессы пула анализа - демоны и не могут порождать свои процессы.
+
+Контуры сшиваются на швах: компоненты связности находятся внутри каждого
+тайла, затем пиксели на краях тайлов соединяются с соседями из других тайлов
+и компоненты объединяются union-find. Гистерезис Canny применяется к уже
+сшитым компонентам - слабая граница сохраняется, даже если сильный пиксель
+ее контура лежит в соседнем тайле.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Модуль, а не имена: distance_analyzer сам импортирует tiling
+import distance_analyzer
+
+
+def halo_size(blur_kernel_size):
+    """Ширина ореола тайла для размытия, Собеля и подавления немаксимумов"""
+    blur_radius = (blur_kernel_size | 1) // 2 if blur_kernel_size and blur_kernel_size > 1 else 0
+    return blur_radius + 2
+
+
+def tile_boxes(height, width, tile_size):
+    """Тайлы (y0, y1, x0, x1), покрывающие изображение без перекрытия"""
+    return [
+        (y, min(y + tile_size, height), x, min(x + tile_size, width))
+        for y in range(0, height, tile_size)
+        for x in range(0, width, tile_size)
+    ]
+
+
+def _process_tile(image, box, halo, blur_kernel_size, low_threshold):
+    """Кандидаты в границы внутри тайла и их компоненты связности"""
+    width, height = image.size
+    y0, y1, x0, x1 = box
+    hy0, hy1 = max(y0 - halo, 0), min(y1 + halo, height)
+    hx0, hx1 = max(x0 - halo, 0), min(x1 + halo, width)
+
+    gray = distance_analyzer.to_grayscale(image.crop((hx0, hy0, hx1, hy1)))
+    blurred = distance_analyzer.gaussian_blur(gray, blur_kernel_size)
+    del gray
+    gx, gy = distance_analyzer.sobel(blurred)
+    flat, magnitude = distance_analyzer.non_maximum_suppression(gx, gy, low_threshold)
+    del blurred, gx, gy
+
+    ys, xs = np.divmod(flat, hx1 - hx0)
+    ys += hy0
+    xs += hx0
+    inside = (ys >= y0) & (ys < y1) & (xs >= x0) & (xs < x1)
+    ys, xs, magnitude = ys[inside], xs[inside], magnitude[inside]
+
+    # Порядок сохраняется: плоские индексы внутри тайла остаются отсортированными
+    labels, count = distance_analyzer.label_components((ys - y0) * (x1 - x0) + (xs - x0), x1 - x0)
+    edge = (ys == y0) | (ys == y1 - 1) | (xs == x0) | (xs == x1 - 1)
+    return ys * width + xs, magnitude, labels, count, edge
+
+
+def canny_tiled(image, blur_kernel_size, low_threshold, high_threshold, tile_size, workers=None):
+    """
+    Яркость, размытие и детектор Canny по тайлам изображения PIL с сшиванием контуров
+
+    Возвращает (ys, xs, labels, count, info) - как canny(), плюс сведения
+    о разбиении.
+    """
+    width, height = image.size
+    halo = halo_size(blur_kernel_size)
+    boxes = tile_boxes(height, width, tile_size)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(boxes)))
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tile') as executor:
+        tiles = list(executor.map(
+            lambda box: _process_tile(image, box, halo, blur_kernel_size, low_threshold), boxes))
+
+    info = {'tiles': len(boxes), 'tile_size': tile_size, 'halo': halo, 'workers': workers}
+
+    # Номера компонент тайлов переводятся в общую нумерацию
+    label_offsets = np.cumsum([0] + [tile[3] for tile in tiles])
+    total = int(label_offsets[-1])
+    if total == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, 0, info
+
+    flat = np.concatenate([tile[0] for tile in tiles])
+    magnitude = np.concatenate([tile[1] for tile in tiles])
+    labels = np.concatenate([tile[2] + offset for tile, offset in zip(tiles, label_offsets)])
+    edge = np.concatenate([tile[4] for tile in tiles])
+    del tiles
+
+    # Сшивание: соседние пиксели на краях тайлов объединяют компоненты
+    seam_flat, seam_labels = flat[edge], labels[edge]
+    order = np.argsort(seam_flat, kind='stable')
+    first, second = distance_analyzer.neighbor_pairs(seam_flat[order], width)
+    roots = distance_analyzer.union_find(total, seam_labels[order][first], seam_labels[order][second])
+    _, components = np.unique(roots, return_inverse=True)
+    labels = components[labels]
+    count = int(components.max()) + 1
+
+    # Гистерезис по сшитым компонентам
+    strong = magnitude > high_threshold
+    has_strong = np.bincount(labels, weights=strong, minlength=count) > 0
+    keep = has_strong[labels]
+
+    ys, xs = np.divmod(flat[keep], width)
+    _, labels = np.unique(labels[keep], return_inverse=True)
+    return ys, xs, labels, int(has_strong.sum()), info
@@ -0,0 +1,139 @@
+"""
+Слежение за объектами между кадрами видео
+
+Полная детекция (Canny + контуры) выполняется только на ключевых кадрах:
+первом, каждом keyframe_interval-м после предыдущей детекции и на кадрах, где
+средняя разница яркости с ключевым кадром (change_score) превышает
+scene_change_threshold. На остальных кадрах объекты ключевого кадра
+сопровождаются: смещение каждого находится поиском участка ключевого кадра
+(сумма абсолютных разностей) на уменьшенной копии текущего кадра, а
+расстояния пересчитываются для тех же пар объектов.
+
+Если участки перестают находиться (невязка больше порога), кадр
+детектируется заново.
+"""
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+THUMBNAIL_FACTOR = 4  # Поиск и оценка изменений - на кадре, уменьшенном в 4 раза
+MAX_PATCH_SAMPLES = 32  # Участок прореживается до 32×32 отсчетов
+
+MODE_DETECTED = 'detected'
+MODE_TRACKED = 'tracked'
+
+
+def thumbnail(image, factor=THUMBNAIL_FACTOR):
+    """Яркость изображения PIL, уменьшенного усреднением блоков factor×factor (float32)"""
+    return np.asarray(image.convert('L').reduce(factor), dtype=np.float32)
+
+
+def change_score(previous, current):
+    """Средняя абсолютная разница яркости двух уменьшенных кадров (0-255)"""
+    if previous.shape != current.shape:
+        return math.inf
+    return float(np.abs(current - previous).mean())
+
+
+def match_offset(reference, current, box, guess, radius):
+    """
+    Смещение участка box ключевого кадра в текущем кадре
+
+    Поиск по окну ±radius вокруг предыдущего смещения guess. Все величины -
+    в пикселях уменьшенного кадра. Возвращает (смещение, невязка).
+    """
+    x, y, w, h = box
+    patch = reference[y:y + h, x:x + w]
+    if patch.size == 0:
+        return guess, math.inf
+
+    height, width = current.shape
+    x0, y0 = max(x + guess[0] - radius, 0), max(y + guess[1] - radius, 0)
+    x1, y1 = min(x + guess[0] + radius + w, width), min(y + guess[1] + radius + h, height)
+    window = current[y0:y1, x0:x1]
+    if window.shape[0] < h or window.shape[1] < w:
+        return guess, math.inf
+
+    step = max(1, math.ceil(max(w, h) / MAX_PATCH_SAMPLES))
+    views = sliding_window_view(window, (h, w))[:, :, ::step, ::step]
+    sad = np.abs(views - patch[::step, ::step]).mean(axis=(2, 3))
+    best_y, best_x = np.unravel_index(int(sad.argmin()), sad.shape)
+    return (x0 + int(best_x) - x, y0 + int(best_y) - y), float(sad[best_y, best_x])
+
+
+class ObjectTracker:
+    """Выбирает для каждого кадра детекцию или слежение и возвращает измерения"""
+
+    def __init__(self, analyzer, video_config):
+        self.analyzer = analyzer
+        self.keyframe_interval = max(1, int(video_config.get('keyframe_interval', 15)))
+        self.threshold = float(video_config.get('scene_change_threshold', 6.0))
+        self.radius = max(1, round(video_config.get('tracking_search_radius', 32) / THUMBNAIL_FACTOR))
+        self._keyframe = None
+        self._objects = []
+        self._distances = []
+        self._offsets = []
+        self._since_keyframe = 0
+
+    def process(self, image):
+        """
+        Измерения для очередного кадра
+
+        Возвращает словарь analyze_image с полями mode (detected/tracked)
+        и change_score.
+        """
+        current = thumbnail(image)
+        score = None if self._keyframe is None else change_score(self._keyframe, current)
+        self._since_keyframe += 1
+
+        if score is not None and score <= self.threshold and self._since_keyframe < self.keyframe_interval:
+            tracked = self._track(current)
+            if tracked is not None:
+                tracked['change_score'] = round(score, 3)
+                return tracked
+
+        measurements = self.analyzer.analyze_image(image)
+        self._keyframe = current
+        self._objects = measurements['objects']
+        self._distances = measurements['distances']
+        self._offsets = [(0, 0)] * len(self._objects)
+        self._since_keyframe = 0
+
+        measurements['mode'] = MODE_DETECTED
+        measurements['change_score'] = None if score is None else round(score, 3)
+        return measurements
+
+    def _track(self, current):
+        """Сопровождает объекты ключевого кадра; None - объекты потеряны"""
+        factor = THUMBNAIL_FACTOR
+        offsets, residuals = [], []
+        for obj, guess in zip(self._objects, self._offsets):
+            x, y, w, h = obj['bbox']
+            box = (x // factor, y // factor, max(1, math.ceil(w / factor)), max(1, math.ceil(h / factor)))
+            offset, residual = match_offset(self._keyframe, current, box, guess, self.radius)
+            offsets.append(offset)
+            residuals.append(residual)
+
+        if residuals and float(np.median(residuals)) > self.threshold:
+            return None
+        self._offsets = offsets
+
+        objects = []
+        for obj, (dx, dy) in zip(self._objects, offsets):
+            dx, dy = dx * factor, dy * factor
+            x, y, w, h = obj['bbox']
+            objects.append({**obj, 'bbox': [x + dx, y + dy, w, h],
+                            'center': [obj['center'][0] + dx, obj['center'][1] + dy]})
+
+        centers = {obj['id']: obj['center'] for obj in objects}
+        distances = [
+            {**item, 'distance_px': round(math.dist(centers[item['from']], centers[item['to']]), 2)}
+            for item in self._distances
+        ]
+
+        return {
+            'objects': objects,
+            'distances': distances,
+            'mode': MODE_TRACKED
+        }
@@ -0,0 +1,441 @@
+"""
+Покадровое чтение и запись видео
+
+Основной путь - ffmpeg через каналы (pipe): декодер отдает сырые кадры RGB24
+в stdout, кодировщик принимает их из stdin. Процесс держит в памяти один кадр,
+сколько бы ни весил исходный файл.
+
+Без ffmpeg работает реализация на чистом Python для AVI с Motion JPEG:
+контейнер RIFF разбирается потоково, кадры декодируются и кодируются Pillow.
+Для остальных форматов без ffmpeg open_reader() возвращает None.
+"""
+import io
+import json
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+from array import array
+from fractions import Fraction
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Кодеки из DISTANCE_ANALYSIS_CONFIG['video_processing']['codec'] -> кодировщики ffmpeg
+FFMPEG_ENCODERS = {
+    'h264': 'libx264',
+    'h265': 'libx265',
+    'hevc': 'libx265',
+    'vp9': 'libvpx-vp9',
+    'mpeg4': 'mpeg4',
+    'mjpeg': 'mjpeg'
+}
+# Контейнеры, которые принимают не любой кодек
+CONTAINER_ENCODERS = {'.webm': 'libvpx-vp9'}
+
+MJPEG_FOURCCS = {b'MJPG', b'AVRN', b'LJPG', b'JPEG', b'DMB1'}
+MJPEG_QUALITY = 90
+AVI_MAX_BYTES = (1 << 32) - (1 << 24)  # Размеры в AVI 1.0 - 32-битные
+AVIIF_KEYFRAME = 0x10
+AVIF_HASINDEX = 0x10
+
+
+class VideoError(Exception):
+    """Ошибка чтения или записи видео"""
+
+
+def ffmpeg_available():
+    return shutil.which('ffmpeg') is not None and shutil.which('ffprobe') is not None
+
+
+def fps_fraction(fps):
+    """Частота кадров как дробь (30000/1001 вместо 29.97002997)"""
+    return Fraction(fps).limit_denominator(1001)
+
+
+class Frame:
+    """Кадр видео; изображение декодируется при первом обращении к image"""
+
+    __slots__ = ('index', 'timestamp', '_decode', '_image')
+
+    def __init__(self, index, timestamp, decode):
+        self.index = index
+        self.timestamp = timestamp
+        self._decode = decode
+        self._image = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = self._decode()
+            self._decode = None
+        return self._image
+
+
+def _even_size(width, height, max_resolution):
+    """Размер кадра в пределах max_resolution, четный (требование yuv420p)"""
+    scale = 1.0
+    if max_resolution:
+        scale = min(1.0, max_resolution[0] / width, max_resolution[1] / height)
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+def probe(path):
+    """Параметры первого видеопотока по данным ffprobe"""
+    cmd = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate,nb_frames:'
+                         'stream_tags=rotate:stream_side_data=rotation',
+        '-of', 'json', path
+    ]
+    completed = subprocess.run(cmd, capture_output=True, check=False)
+    if completed.returncode != 0:
+        raise VideoError(f'ffprobe: {completed.stderr.decode(errors="replace").strip()}')
+
+    streams = json.loads(completed.stdout or b'{}').get('streams') or []
+    if not streams:
+        raise VideoError(f'В файле нет видеопотока: {path}')
+    stream = streams[0]
+
+    fps = 0.0
+    for key in ('avg_frame_rate', 'r_frame_rate'):
+        try:
+            fps = float(Fraction(stream.get(key, '0/1')))
+        except (ValueError, ZeroDivisionError):
+            fps = 0.0
+        if fps > 0:
+            break
+
+    rotation = int(float(stream.get('tags', {}).get('rotate', 0) or 0))
+    for side_data in stream.get('side_data_list', []):
+        rotation = int(side_data.get('rotation', rotation))
+
+    width, height = int(stream['width']), int(stream['height'])
+    # ffmpeg поворачивает кадры при декодировании - размеры меняются местами
+    if abs(rotation) % 180 == 90:
+        width, height = height, width
+
+    frame_count = stream.get('nb_frames')
+    return {
+        'width': width,
+        'height': height,
+        'fps': fps or 25.0,
+        'frame_count': int(frame_count) if str(frame_count or '').isdigit() else None
+    }
+
+
+class FFmpegReader:
+    """Декодирование через ffmpeg: кадры RGB24 читаются из канала по одному"""
+
+    decoder = 'ffmpeg'
+
+    def __init__(self, path, max_resolution=None):
+        self.path = path
+        info = probe(path)
+        self.fps = info['fps']
+        self.frame_count = info['frame_count']
+        self.source_size = (info['width'], info['height'])
+        self.width, self.height = _even_size(info['width'], info['height'], max_resolution)
+
+    def __iter__(self):
+        cmd = [
+            'ffmpeg', '-v', 'error', '-nostdin', '-i', self.path,
+            '-map', '0:v:0', '-vf', f'scale={self.width}:{self.height}',
+            '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'
+        ]
+        frame_bytes = self.width * self.height * 3
+        size = (self.width, self.height)
+
+        # stderr во временный файл: заполненный канал stderr остановил бы ffmpeg
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+            finished = False
+            try:
+                index = 0
+                while True:
+                    data = process.stdout.read(frame_bytes)
+                    if len(data) < frame_bytes:
+                        finished = True
+                        break
+                    yield Frame(index, index / self.fps,
+                                lambda data=data: Image.frombuffer('RGB', size, data, 'raw', 'RGB', 0, 1))
+                    index += 1
+            finally:
+                # При досрочной остановке ffmpeg получит EPIPE, но ждать этого незачем
+                process.stdout.close()
+                if not finished:
+                    process.kill()
+                process.wait()
+
+            if finished and process.returncode != 0:
+                stderr.seek(0)
+                raise VideoError(f'ffmpeg: {stderr.read().decode(errors="replace").strip()}')
+
+
+class FFmpegWriter:
+    """Кодирование через ffmpeg: кадры RGB24 пишутся в канал по одному"""
+
+    encoder = 'ffmpeg'
+
+    def __init__(self, path, width, height, fps, codec='h264'):
+        extension = os.path.splitext(path)[1].lower()
+        encoder = CONTAINER_ENCODERS.get(extension) or FFMPEG_ENCODERS.get(codec, codec)
+        self.size = (width, height)
+        cmd = [
+            'ffmpeg', '-v', 'error', '-y', '-nostdin',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}',
+            '-r', str(fps_fraction(fps)), '-i', '-',
+            '-an', '-c:v', encoder, '-pix_fmt', 'yuv420p'
+        ]
+        if extension in ('.mp4', '.mov'):
+            cmd += ['-movflags', '+faststart']
+        cmd.append(path)
+
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self._stderr)
+
+    def write(self, image):
+        if image.size != self.size or image.mode != 'RGB':
+            image = image.convert('RGB').resize(self.size)
+        try:
+            self._process.stdin.write(image.tobytes())
+        except BrokenPipeError:
+            self._process.wait()
+            raise VideoError(f'ffmpeg: {self._error_text()}')
+
+    def close(self):
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._process.wait()
+        try:
+            if self._process.returncode != 0:
+                raise VideoError(f'ffmpeg: {self._error_text()}')
+        finally:
+            self._stderr.close()
+
+    def abort(self):
+        self._process.kill()
+        self._process.wait()
+        self._stderr.close()
+
+    def _error_text(self):
+        self._stderr.seek(0)
+        return self._stderr.read().decode(errors='replace').strip()
+
+
+def _read_chunk_header(f):
+    header = f.read(8)
+    if len(header) < 8:
+        return None, 0
+    fourcc, size = struct.unpack('<4sI', header)
+    return fourcc, size
+
+
+def _iter_chunks(f, start, end):
+    """Чанки RIFF в диапазоне [start, end): (fourcc, size, смещение данных)"""
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        fourcc, size = _read_chunk_header(f)
+        if fourcc is None:
+            return
+        yield fourcc, size, position + 8
+        position += 8 + size + (size & 1)
+
+
+class MJPEGAviReader:
+    """Потоковое чтение AVI с Motion JPEG без внешних программ"""
+
+    decoder = 'mjpeg-avi'
+
+    def __init__(self, path):
+        self.path = path
+        self._movi = []
+        video = None
+        streams = 0
+
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            for riff, riff_size, riff_data in _iter_chunks(f, 0, file_size):
+                f.seek(riff_data)
+                form = f.read(4)
+                if riff != b'RIFF' or form not in (b'AVI ', b'AVIX'):
+                    break
+                riff_end = min(riff_data + riff_size, file_size)
+                for fourcc, size, data in _iter_chunks(f, riff_data + 4, riff_end):
+                    if fourcc != b'LIST':
+                        continue
+                    f.seek(data)
+                    list_type = f.read(4)
+                    if list_type == b'movi':
+                        self._movi.append((data + 4, min(data + size, riff_end)))
+                    elif list_type == b'hdrl':
+                        for strl, strl_size, strl_data in _iter_chunks(f, data + 4, data + size):
+                            f.seek(strl_data)
+                            if strl != b'LIST' or f.read(4) != b'strl':
+                                continue
+                            stream = self._read_stream(f, strl_data + 4, strl_data + strl_size)
+                            if video is None and stream is not None:
+                                video = (streams, *stream)
+                            streams += 1
+
+        if video is None:
+            raise VideoError(f'AVI без видеопотока Motion JPEG: {path}')
+        stream_index, self.fps, self.frame_count, self.width, self.height = video
+        self.source_size = (self.width, self.height)
+        self._chunk_ids = {b'%02ddc' % stream_index, b'%02ddb' % stream_index}
+
+    @staticmethod
+    def _read_stream(f, start, end):
+        header = bitmap = None
+        for fourcc, size, data in _iter_chunks(f, start, end):
+            f.seek(data)
+            if fourcc == b'strh' and size >= 48:
+                header = f.read(48)
+            elif fourcc == b'strf' and size >= 20:
+                bitmap = f.read(20)
+        if header is None or bitmap is None or header[:4] != b'vids':
+            return None
+
+        handler = header[4:8].upper()
+        scale, rate, _, length = struct.unpack('<4I', header[20:36])
+        _, width, height, _, _, compression = struct.unpack('<Iii2H4s', bitmap)
+        if handler not in MJPEG_FOURCCS and compression.upper() not in MJPEG_FOURCCS:
+            return None
+        fps = rate / scale if scale and rate else 25.0
+        return fps, length or None, width, abs(height)
+
+    def __iter__(self):
+        index = 0
+        previous = None
+        with open(self.path, 'rb') as f:
+            for start, end in self._movi:
+                for data in self._iter_frames(f, start, end):
+                    # Пустой чанк - повтор предыдущего кадра
+                    data = data or previous
+                    previous = data
+                    if data is None:
+                        continue
+                    yield Frame(index, index / self.fps,
+                                lambda data=data: Image.open(io.BytesIO(data)).convert('RGB'))
+                    index += 1
+
+    def _iter_frames(self, f, start, end):
+        for fourcc, size, data in _iter_chunks(f, start, end):
+            f.seek(data)
+            if fourcc == b'LIST':
+                if f.read(4) == b'rec ':
+                    yield from self._iter_frames(f, data + 4, data + size)
+            elif fourcc in self._chunk_ids:
+                # Позицию файла восстанавливать не нужно: _iter_chunks выполняет seek
+                # перед каждым чанком
+                yield f.read(size)
+
+
+class MJPEGAviWriter:
+    """Запись AVI с Motion JPEG без внешних программ (AVI 1.0, до 4 ГБ)"""
+
+    encoder = 'mjpeg-avi'
+
+    def __init__(self, path, width, height, fps, quality=MJPEG_QUALITY):
+        self.size = (width, height)
+        self.quality = quality
+        self._index = array('I')
+        self._file = open(path, 'wb')
+
+        rate = fps_fraction(fps)
+        avih = struct.pack('<14I', round(1_000_000 / fps), 0, 0, AVIF_HASINDEX, 0, 0, 1,
+                           0, width, height, 0, 0, 0, 0)
+        strh = struct.pack('<4s4sI2H8I4h', b'vids', b'MJPG', 0, 0, 0, 0, rate.denominator,
+                           rate.numerator, 0, 0, 0, 0xFFFFFFFF, 0, 0, 0, width, height)
+        strf = struct.pack('<Iii2H4s5I', 40, width, height, 1, 24, b'MJPG', width * height * 3, 0, 0, 0, 0)
+        strl = b'strl' + self._chunk(b'strh', strh) + self._chunk(b'strf', strf)
+        hdrl = b'hdrl' + self._chunk(b'avih', avih) + self._chunk(b'LIST', strl)
+
+        header = b'RIFF' + b'\0' * 4 + b'AVI ' + self._chunk(b'LIST', hdrl)
+        # Поля, которые известны только в конце записи
+        self._total_frames_at = 12 + 12 + 8 + 16
+        self._length_at = 12 + 12 + 8 + len(avih) + 12 + 8 + 32
+        self._movi_at = len(header)
+        self._file.write(header + b'LIST' + b'\0' * 4 + b'movi')
+
+    @staticmethod
+    def _chunk(fourcc, data):
+        return fourcc + struct.pack('<I', len(data)) + data + b'\0' * (len(data) & 1)
+
+    def write(self, image):
+        buffer = io.BytesIO()
+        image.convert('RGB').save(buffer, 'JPEG', quality=self.quality)
+        data = buffer.getvalue()
+
+        position = self._file.tell()
+        if position + len(data) + 16 * (len(self._index) // 3 + 2) > AVI_MAX_BYTES:
+            raise VideoError('Результат превышает предельный размер AVI (4 ГБ)')
+        # Смещения в idx1 отсчитываются от поля 'movi'
+        self._index.extend((AVIIF_KEYFRAME, position - self._movi_at - 8, len(data)))
+        self._file.write(self._chunk(b'00dc', data))
+
+    def close(self):
+        f = self._file
+        movi_end = f.tell()
+        frames = len(self._index) // 3
+
+        f.write(b'idx1' + struct.pack('<I', 16 * frames))
+        for i in range(frames):
+            flags, offset, size = self._index[3 * i:3 * i + 3]
+            f.write(struct.pack('<4s3I', b'00dc', flags, offset, size))
+        file_end = f.tell()
+
+        for position, value in ((4, file_end - 8), (self._movi_at + 4, movi_end - self._movi_at - 8),
+                                (self._total_frames_at, frames), (self._length_at, frames)):
+            f.seek(position)
+            f.write(struct.pack('<I', value))
+        f.close()
+
+    def abort(self):
+        self._file.close()
+
+
+def is_mjpeg_avi(path):
+    try:
+        MJPEGAviReader(path)
+    except (OSError, VideoError, struct.error):
+        return False
+    return True
+
+
+def open_reader(path, max_resolution=None):
+    """Декодер для файла или None, если прочитать его нечем"""
+    if ffmpeg_available():
+        return FFmpegReader(path, max_resolution)
+    if is_mjpeg_avi(path):
+        return MJPEGAviReader(path)
+    return None
+
+
+def probe_video(path):
+    """Параметры видео (fps, frame_count, width, height) без декодирования кадров или None"""
+    try:
+        if ffmpeg_available():
+            return probe(path)
+        if is_mjpeg_avi(path):
+            reader = MJPEGAviReader(path)
+            return {'width': reader.width, 'height': reader.height,
+                    'fps': reader.fps, 'frame_count': reader.frame_count}
+    except (OSError, VideoError, ValueError, KeyError, struct.error):
+        pass
+    return None
+
+
+def open_writer(path, width, height, fps, codec='h264'):
+    """Кодировщик для пути результата"""
+    if ffmpeg_available():
+        return FFmpegWriter(path, width, height, fps, codec)
+    if os.path.splitext(path)[1].lower() == '.avi':
+        return MJPEGAviWriter(path, width, height, fps)
+    raise VideoError(f'ffmpeg не найден, запись {os.path.splitext(path)[1]} недоступна')
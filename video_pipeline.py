@@ -0,0 +1,303 @@
+"""
+Потоковый конвейер анализа видео
+
+decode -> sample -> analyze -> overlay -> encode - цепочка генераторов: каждый
+этап запрашивает следующий кадр у предыдущего, только когда готов его
+обработать, поэтому в памяти одновременно находятся единицы кадров независимо
+от длины ролика. Измерения по кадрам сразу дописываются в JSON-файл метаданных.
+
+Прореживание: из исходного потока берется каждый frame_skip-й кадр, а затем
+не более fps_limit кадров в секунду (DISTANCE_ANALYSIS_CONFIG['video_processing']).
+При включенном tracking полная детекция выполняется только на ключевых кадрах
+(см. tracking.py); в метаданных каждый кадр помечен как detected или tracked.
+Масштаб, найденный по эталону на первом кадре, используется до смены сцены
+(calibration.SceneCalibration).
+"""
+import csv
+import json
+import logging
+import os
+import time
+
+from calibration import SceneCalibration, distance_label
+from distance_analyzer import DistanceAnalyzer, fit_resolution, render_overlay
+from profiling import record_stage, stage_clock
+from tracking import MODE_DETECTED, ObjectTracker
+from video_io import VideoError, open_reader, open_writer
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 0.5  # Прогресс по кадрам отправляется не чаще раза в 0.5 сек
+
+
+class VideoDecoderUnavailable(VideoError):
+    """Нет декодера для формата (ffmpeg не установлен)"""
+
+
+def sample_frames(frames, source_fps, fps_limit=None, frame_skip=1):
+    """Оставляет каждый frame_skip-й кадр и не более fps_limit кадров в секунду"""
+    frame_skip = max(1, int(frame_skip or 1))
+    interval = 1.0 / fps_limit if fps_limit else 0.0
+    next_time = 0.0
+
+    for frame in frames:
+        if frame.index % frame_skip:
+            continue
+        if interval:
+            # Допуск на погрешность округления временных меток
+            if frame.timestamp < next_time - 1e-6:
+                continue
+            next_time = max(next_time + interval, frame.timestamp)
+        yield frame
+
+
+def output_fps(source_fps, fps_limit=None, frame_skip=1):
+    """Частота кадров результата после прореживания"""
+    fps = source_fps / max(1, int(frame_skip or 1))
+    return min(fps, fps_limit) if fps_limit else fps
+
+
+def analyze_frames(frames, analyzer, max_resolution, timings, tracker=None,
+                   scene_calibration=None, units='pixels'):
+    """Находит объекты и расстояния на каждом кадре (детекцией или слежением)"""
+    for frame in frames:
+        started = time.perf_counter()
+        mark = stage_clock()
+        image, _ = fit_resolution(frame.image, max_resolution)
+        timings['decode'] += time.perf_counter() - started
+        record_stage('decode', mark)
+
+        started = time.perf_counter()
+        mark = stage_clock()
+        if tracker is not None:
+            measurements = tracker.process(image)
+        else:
+            measurements = analyzer.analyze_image(image)
+            measurements['mode'] = MODE_DETECTED
+        stage = 'detection' if measurements['mode'] == MODE_DETECTED else 'tracking'
+        timings[stage] += time.perf_counter() - started
+        record_stage(stage, mark)
+
+        scale_result = None
+        if scene_calibration is not None:
+            started = time.perf_counter()
+            mark = stage_clock()
+            scale_result = scene_calibration.process(image)
+            timings['calibration'] += time.perf_counter() - started
+            record_stage('calibration', mark)
+        analyzer.apply_units(measurements, scale_result, units)
+
+        record = {
+            'frame': frame.index,
+            'timestamp': round(frame.timestamp, 3),
+            'mode': measurements['mode'],
+            'change_score': measurements.get('change_score'),
+            'units': measurements['units'],
+            'units_per_pixel': measurements['units_per_pixel'],
+            'meters_per_pixel': scale_result['meters_per_pixel'] if scale_result else None,
+            'objects': measurements['objects'],
+            'distances': measurements['distances']
+        }
+        yield record, image
+
+
+def render_frames(analyzed, output_config, timings):
+    """Накладывает измерения на кадры"""
+    overlay = output_config.get('overlay_measurements', True)
+    for record, image in analyzed:
+        if overlay:
+            started = time.perf_counter()
+            mark = stage_clock()
+            image = render_overlay(image, record['objects'], record['distances'], output_config,
+                                   distance_label(record['units'], record['units_per_pixel']))
+            timings['overlay'] += time.perf_counter() - started
+            record_stage('overlay', mark)
+        yield record, image
+
+
+class FramesMetadataWriter:
+    """Пишет JSON {"frames": [...], "summary": {...}} по мере обработки кадров"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w', encoding='utf-8')
+        self._file.write('{"frames": [')
+        self._count = 0
+
+    def write(self, record):
+        if self._count:
+            self._file.write(', ')
+        json.dump(record, self._file, ensure_ascii=False)
+        self._count += 1
+
+    def close(self, summary):
+        self._file.write('], "summary": ')
+        json.dump(summary, self._file, ensure_ascii=False)
+        self._file.write('}')
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class FramesCsvWriter(FramesMetadataWriter):
+    """Пишет по строке CSV на обработанный кадр"""
+
+    COLUMNS = ('frame', 'timestamp', 'mode', 'change_score', 'objects', 'distances',
+               'min_distance_px', 'mean_distance_px', 'meters_per_pixel')
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.COLUMNS)
+
+    def write(self, record):
+        distances = [item['distance_px'] for item in record['distances']]
+        self._writer.writerow([
+            record['frame'], record['timestamp'], record['mode'],
+            '' if record['change_score'] is None else record['change_score'],
+            len(record['objects']), len(distances),
+            min(distances) if distances else '',
+            round(sum(distances) / len(distances), 2) if distances else '',
+            '' if record['meters_per_pixel'] is None else record['meters_per_pixel']
+        ])
+
+    def close(self, summary):
+        self._file.close()
+
+
+def frame_progress(frames_processed, record, reader):
+    """Прогресс видео: обработанные кадры и доля ролика по времени кадра"""
+    data = {'stage': 'frames', 'frames_processed': frames_processed, 'frame': record['frame'],
+            'frames_total': reader.frame_count, 'percent': None}
+    duration = reader.frame_count / reader.fps if reader.frame_count and reader.fps else None
+    if duration:
+        data['percent'] = round(min(100.0, 100 * (record['timestamp'] + 1 / reader.fps) / duration), 1)
+    return data
+
+
+def process_video(file_path, output_path, config, units, calibrator=None, progress=None):
+    """
+    Анализирует видео и сохраняет ролик с наложенными измерениями
+
+    Измерения по кадрам пишутся в JSON рядом с результатом, если включен
+    output.include_metadata, и в CSV, если 'csv' есть в output.formats.
+    calibrator - calibration.ReferenceCalibrator для перевода в units.
+    progress(data) получает число обработанных кадров (не чаще PROGRESS_INTERVAL).
+    Возвращает сводку по ролику.
+    """
+    image_config = config.get('image_processing', {})
+    video_config = config.get('video_processing', {})
+    output_config = config.get('output', {})
+    max_resolution = image_config.get('max_resolution')
+    fps_limit = video_config.get('fps_limit')
+    frame_skip = video_config.get('frame_skip', 1)
+
+    reader = open_reader(file_path, max_resolution)
+    if reader is None:
+        raise VideoDecoderUnavailable(f'Нет декодера для {file_path}')
+
+    fps = output_fps(reader.fps, fps_limit, frame_skip)
+    analyzer = DistanceAnalyzer(config=config)
+    tracker = ObjectTracker(analyzer, video_config) if video_config.get('tracking', False) else None
+    scene_calibration = None
+    if calibrator is not None and calibrator.enabled:
+        scene_calibration = SceneCalibration(calibrator, float(video_config.get('scene_change_threshold', 6.0)),
+                                             int(video_config.get('keyframe_interval', 15)))
+    timings = {'decode': 0.0, 'detection': 0.0, 'tracking': 0.0, 'calibration': 0.0,
+               'overlay': 0.0, 'encode': 0.0}
+
+    sidecars = []
+    base_path = os.path.splitext(output_path)[0]
+    if output_config.get('include_metadata', True):
+        sidecars.append(FramesMetadataWriter(base_path + '.json'))
+    if 'csv' in output_config.get('formats', []):
+        sidecars.append(FramesCsvWriter(base_path + '.csv'))
+
+    writer = None
+    reported_at = time.monotonic()
+    frames_processed = 0
+    frames_detected = 0
+    frames_calibrated = 0
+    objects_total = 0
+    objects_max = 0
+    image_size = None
+    try:
+        frames = sample_frames(iter(reader), reader.fps, fps_limit, frame_skip)
+        analyzed = analyze_frames(frames, analyzer, max_resolution, timings, tracker, scene_calibration, units)
+        rendered = render_frames(analyzed, output_config, timings)
+
+        for record, image in rendered:
+            if writer is None:
+                image_size = [image.width, image.height]
+                writer = open_writer(output_path, image.width, image.height, fps,
+                                     video_config.get('codec', 'h264'))
+
+            started = time.perf_counter()
+            mark = stage_clock()
+            writer.write(image)
+            timings['encode'] += time.perf_counter() - started
+            record_stage('encode', mark)
+
+            for sidecar in sidecars:
+                sidecar.write(record)
+            frames_processed += 1
+            frames_detected += record['mode'] == MODE_DETECTED
+            frames_calibrated += record['meters_per_pixel'] is not None
+            objects_total += len(record['objects'])
+            objects_max = max(objects_max, len(record['objects']))
+
+            if progress is not None and time.monotonic() - reported_at >= PROGRESS_INTERVAL:
+                reported_at = time.monotonic()
+                progress(frame_progress(frames_processed, record, reader))
+
+        if writer is None:
+            raise VideoError(f'В видео нет кадров: {file_path}')
+        writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        for sidecar in sidecars:
+            sidecar.abort()
+        raise
+
+    summary = {
+        'frames_processed': frames_processed,
+        'frames_total': reader.frame_count,
+        'frames_detected': frames_detected,
+        'frames_tracked': frames_processed - frames_detected,
+        'tracking': tracker is not None,
+        'source_fps': round(reader.fps, 3),
+        'output_fps': round(fps, 3),
+        'fps_limit': fps_limit,
+        'frame_skip': frame_skip,
+        'source_size': list(reader.source_size),
+        'image_size': image_size,
+        'resize_scale': round(image_size[0] / reader.source_size[0], 6),
+        'decoder': reader.decoder,
+        'encoder': writer.encoder,
+        'objects_per_frame': {
+            'mean': round(objects_total / frames_processed, 2),
+            'max': objects_max
+        },
+        'timings_ms': {stage: round(seconds * 1000, 2) for stage, seconds in timings.items()},
+        'calibration': {
+            'calibrations': scene_calibration.calibrations if scene_calibration else 0,
+            'rejections': scene_calibration.rejections if scene_calibration else 0,
+            'frames_calibrated': frames_calibrated
+        },
+        # Единицы расстояний всех кадров: без масштаба хотя бы на одном кадре - пиксели
+        'units': units if frames_calibrated == frames_processed else 'pixels',
+        'requested_units': units
+    }
+    for sidecar in sidecars:
+        sidecar.close(summary)
+
+    logger.info(f"Обработано кадров: {frames_processed} ({reader.decoder} -> {writer.encoder}), "
+                f"{file_path}")
+    return summary